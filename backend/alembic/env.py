@@ -14,6 +14,7 @@ from src.chats.models import *
 from src.folders.models import *
 from src.join_requests.models import *
 from src.invitations.models import *
+from src.search.models import *
 from src.database import Base
 
 config = context.config
@@ -0,0 +1,78 @@
+"""read watermarks
+
+Revision ID: d41f0b6e8a23
+Revises: 7c1e5a9d2f40
+Create Date: 2026-10-18 10:03:27.904116
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41f0b6e8a23'
+down_revision: Union[str, None] = '7c1e5a9d2f40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('user_chat_associations', sa.Column('last_read_message_id', sa.Integer(), nullable=True))
+    op.add_column('user_chat_associations', sa.Column('last_read_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_foreign_key(
+        'user_chat_associations_last_read_message_id_fkey', 'user_chat_associations',
+        'messages', ['last_read_message_id'], ['id'], ondelete='SET NULL'
+    )
+
+    # the newest read message of every (user, chat) in (created_at, id) order becomes the watermark
+    op.execute("""
+        UPDATE user_chat_associations AS a
+        SET last_read_message_id = w.message_id,
+            last_read_at = w.read_at
+        FROM (
+            SELECT DISTINCT ON (rs.user_id, m.chat_id)
+                   rs.user_id, m.chat_id, m.id AS message_id,
+                   MAX(rs.updated_at) OVER (PARTITION BY rs.user_id, m.chat_id) AS read_at
+            FROM read_statuses AS rs
+            JOIN messages AS m ON m.id = rs.message_id
+            WHERE rs.is_read
+            ORDER BY rs.user_id, m.chat_id, m.created_at DESC, m.id DESC
+        ) AS w
+        WHERE a.user_id = w.user_id AND a.chat_id = w.chat_id
+    """)
+
+    op.drop_table('read_statuses')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table('read_statuses',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('is_read', sa.Boolean(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    # one row per message and member (except the sender), read up to the watermark
+    # in (created_at, id) order, or up to last_read_at if the watermark was deleted
+    op.execute("""
+        INSERT INTO read_statuses (updated_at, is_read, user_id, message_id)
+        SELECT COALESCE(a.last_read_at, m.created_at),
+               COALESCE((m.created_at, m.id) <= (w.created_at, w.id), m.created_at <= a.last_read_at, FALSE),
+               a.user_id,
+               m.id
+        FROM messages AS m
+        JOIN user_chat_associations AS a ON a.chat_id = m.chat_id AND a.user_id <> m.user_id
+        LEFT JOIN messages AS w ON w.id = a.last_read_message_id
+    """)
+
+    op.drop_constraint('user_chat_associations_last_read_message_id_fkey', 'user_chat_associations', type_='foreignkey')
+    op.drop_column('user_chat_associations', 'last_read_at')
+    op.drop_column('user_chat_associations', 'last_read_message_id')
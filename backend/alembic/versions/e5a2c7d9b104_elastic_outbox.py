@@ -0,0 +1,35 @@
+"""elastic outbox
+
+Revision ID: e5a2c7d9b104
+Revises: d41f0b6e8a23
+Create Date: 2026-10-18 12:41:09.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a2c7d9b104'
+down_revision: Union[str, None] = 'd41f0b6e8a23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('elastic_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('index', sa.String(length=50), nullable=False),
+    sa.Column('doc_uuid', sa.UUID(), nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('elastic_outbox')
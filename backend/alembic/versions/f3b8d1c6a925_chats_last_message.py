@@ -0,0 +1,51 @@
+"""chats last message
+
+Revision ID: f3b8d1c6a925
+Revises: e5a2c7d9b104
+Create Date: 2026-10-18 15:22:47.510386
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3b8d1c6a925'
+down_revision: Union[str, None] = 'e5a2c7d9b104'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_foreign_key(
+        'chats_last_message_id_fkey', 'chats',
+        'messages', ['last_message_id'], ['id'], ondelete='SET NULL'
+    )
+
+    # the newest message of every chat, in the (created_at, id) order of create_message_in_db
+    op.execute("""
+        UPDATE chats AS c
+        SET last_message_id = m.id,
+            last_message_at = m.created_at
+        FROM (
+            SELECT DISTINCT ON (chat_id) chat_id, id, created_at
+            FROM messages
+            ORDER BY chat_id, created_at DESC, id DESC
+        ) AS m
+        WHERE m.chat_id = c.id
+    """)
+
+    op.create_index(op.f('ix_chats_last_message_at'), 'chats', ['last_message_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_chats_last_message_at'), table_name='chats')
+    op.drop_constraint('chats_last_message_id_fkey', 'chats', type_='foreignkey')
+    op.drop_column('chats', 'last_message_at')
+    op.drop_column('chats', 'last_message_id')
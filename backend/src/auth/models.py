@@ -9,7 +9,7 @@ from src.models import TimestampMixin, uuid_type
 if TYPE_CHECKING:
     from src.chats.models import UserChatAssociationModel
     from src.folders.models import FolderModel
-    from src.messages.models import MessageModel, ReadStatusModel
+    from src.messages.models import MessageModel
     from src.join_requests.models import JoinRequestModel
     from src.invitations.models import InvitationModel
 
@@ -35,9 +35,6 @@ class UserModel(Base, TimestampMixin):
     folders: Mapped[list["FolderModel"]] = relationship(
         back_populates='user', cascade='all, delete-orphan'
     )
-    read_statuses: Mapped[list["ReadStatusModel"]] = relationship(
-        back_populates='user', cascade='all, delete-orphan'
-    )
     sent_join_requests: Mapped[list["JoinRequestModel"]] = relationship(
         back_populates="sender_user", foreign_keys="[JoinRequestModel.sender_user_id]"
     )
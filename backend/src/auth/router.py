@@ -1,7 +1,6 @@
 from typing import Annotated
 from uuid import uuid4, UUID
 import logging
-import json
 
 from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks, \
     Request, Cookie, Response, Body
@@ -9,15 +8,15 @@ from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 from authlib.integrations.starlette_client import OAuth
 from redis.asyncio import Redis
-from elasticsearch import AsyncElasticsearch
 
-from src.database import get_db, get_redis, get_es
+from src.database import get_db, get_redis
 from src.utils import save_to_db, wrap_list_response, get_object_or_404
+from src.cache import cached_hash
 from src.dependencies import get_current_user, get_active_current_user
 from src.settings import HOST, GOOGLE_CLIENT_SECRET, GOOGLE_CLIENT_ID, FRONTEND_HOST, \
-    REDIS_CACHE_EXPIRE_SECONDS, REDIS_USERS_KEY
+    REDIS_USERS_KEY
 from src.auth.utils import create_access_token, create_refresh_token, send_html_email, \
-    decode_jwt_token, create_token_response, create_state, validate_state, add_user_to_elastic
+    decode_jwt_token, create_token_response, create_state, validate_state, sync_user_to_elastic
 from src.auth.schemas import UserRegisterSchema, UserSchema
 from src.auth.services import authenticate_user, create_user, create_email_activation_token, \
     activate_user, get_user_or_none, get_all_users_from_db
@@ -56,7 +55,6 @@ async def get_google_oauth_redirect_uri(
 async def google_callback(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     code: Annotated[str, Body(...)],
     state: Annotated[str, Body(...)],
 ):
@@ -83,6 +81,9 @@ async def google_callback(
             avatar=user_info['picture'],
             is_active=user_info['verified_email']
         )
+        db.add(new_user)
+        await db.flush() # uuid for the outbox
+        sync_user_to_elastic(db, new_user)
         user = (await save_to_db(db, [new_user]))[0]
 
         # creates all folder types (except custom)
@@ -91,8 +92,6 @@ async def google_callback(
         await create_folder_in_db(db=db, user=user, folder_type=FolderType.GROUPS)
         await create_folder_in_db(db=db, user=user, folder_type=FolderType.NEW)
 
-        await add_user_to_elastic(es, user)
-
         logging.info(f'{user.username} registered in by google')
     else:
         logging.info(f'{user.username} logged in by google')
@@ -128,7 +127,6 @@ async def login(
 @router.post('/register')
 async def register(
     db: Annotated[AsyncSession, Depends(get_db)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     background_tasks: BackgroundTasks,
     user_data: UserRegisterSchema
 ):
@@ -148,8 +146,6 @@ async def register(
         """
     )
 
-    await add_user_to_elastic(es, user)
-
     logging.info(f'{user.username} registration completed')
     access_token = create_access_token({'sub': user.username})
     refresh_token = create_refresh_token({'sub': user.username})
@@ -200,20 +196,13 @@ async def get_all_users(
     r: Annotated[Redis, Depends(get_redis)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
 ):
-    redis_key = REDIS_USERS_KEY.format(current_user.uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-
-    users = await get_all_users_from_db(db, current_user)
-    user_schemas = [UserSchema.model_validate(user) for user in users]
-    user_dict = [user.model_dump() for user in user_schemas]
-    data = wrap_list_response(user_dict)
-
-    await r.set(
-        redis_key,
-        json.dumps(data, default=str),
-        REDIS_CACHE_EXPIRE_SECONDS
-    )
+    async def load():
+        users = await get_all_users_from_db(db, current_user)
+        user_schemas = [UserSchema.model_validate(user) for user in users]
+        return [user.model_dump(mode='json') for user in user_schemas], {}
+
+    # a hash by user uuid, profile changes patch it in place
+    user_dict, _ = await cached_hash(r, REDIS_USERS_KEY.format(current_user.uuid), load)
 
-    return data
+    return wrap_list_response(user_dict)
    
\ No newline at end of file
@@ -2,18 +2,19 @@ from datetime import datetime, timezone, timedelta
 from uuid import UUID
 
 from fastapi import HTTPException, status
+from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import or_, select
 from sqlalchemy.orm import selectinload, aliased
 from sqlalchemy.exc import IntegrityError
 
 from src.utils import save_to_db, get_object_or_404
-from src.settings import EMAIL_ACTIVATION_EXPIRE_MINUTES
+from src.cache import patch_hash_cache, set_fields
+from src.settings import EMAIL_ACTIVATION_EXPIRE_MINUTES, REDIS_USERS_KEY
 from src.auth.models import UserModel, EmailActivationTokenModel
-from src.auth.schemas import UserRegisterSchema
-from src.auth.utils import verify_password, get_password_hash
-from src.chats.models import UserChatAssociationModel, ChatModel
-from src.chats.enums import ChatType
+from src.auth.schemas import UserRegisterSchema, UserSchema
+from src.auth.utils import verify_password, get_password_hash, sync_user_to_elastic
+from src.chats.models import UserChatAssociationModel
 from src.folders.services import create_folder_in_db
 from src.folders.enums import FolderType
 
@@ -47,6 +48,9 @@ async def create_user(db: AsyncSession, user_data: UserRegisterSchema, is_active
             password=get_password_hash(user_data.password),
             is_active=is_active
         )
+        db.add(user)
+        await db.flush() # uuid for the outbox
+        sync_user_to_elastic(db, user)
         user = (await save_to_db(db, [user]))[0]
 
         # creates all folder types (except custom)
@@ -107,6 +111,7 @@ async def activate_user(
         raise token_error
     
     user.is_active = True
+    sync_user_to_elastic(db, user)
     await db.delete(token)
     await db.commit()
 
@@ -132,24 +137,11 @@ async def get_all_users_from_db(
     result = await db.execute(stmt)
     return result.scalars().all()
 
-async def get_all_users_connected_by_normal_chat(
-    db: AsyncSession,
-    user: UserModel
-) -> list[UserModel]:
-    """ Returns all connected via NORMAL chat users to 'user' """
-    ChatAssoc = UserChatAssociationModel
-    OtherAssoc = aliased(UserChatAssociationModel)
-
-    stmt = (
-        select(UserModel)
-        .join(OtherAssoc, UserModel.id == OtherAssoc.user_id)
-        .join(ChatAssoc, ChatAssoc.chat_id == OtherAssoc.chat_id)
-        .join(ChatModel, ChatModel.id == OtherAssoc.chat_id)
-        .where(ChatAssoc.user_id == user.id)
-        .where(UserModel.id != user.id)
-        .where(ChatModel.chat_type == ChatType.NORMAL)
-        .distinct()
-    )
-
-    result = await db.execute(stmt)
-    return result.scalars().all()
+async def patch_user_in_caches(db: AsyncSession, r: Redis, user: UserModel) -> None:
+    """ The cached user lists of everyone connected to 'user' get his new profile """
+    connected_users = await get_all_users_from_db(db, user)
+    profile = UserSchema.model_validate(user).model_dump(mode='json')
+    await patch_hash_cache(r, [
+        (REDIS_USERS_KEY.format(other.uuid), str(user.uuid), set_fields(**profile))
+        for other in connected_users
+    ])
@@ -4,18 +4,19 @@ from email.mime.multipart import MIMEMultipart
 from secrets import token_urlsafe
 
 from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
 import jwt
 from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
 import aiosmtplib
 from fastapi import HTTPException, status
 from fastapi.responses import JSONResponse
-from elasticsearch import AsyncElasticsearch
 
 from src.settings import SECRET_KEY, ALGORITHM, \
     SMTP_SERVER, SMTP_PORT, SENDER_EMAIL, SENDER_EMAIL_PASSWORD, \
     ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS, HTTPS, \
     REDIS_GOOGLE_STATE_KEY, GOOGLE_STATE_LIFETIME, ELASTIC_USERS_INDEX_NAME
+from src.search.utils import add_to_elastic_outbox
 from src.auth.schemas import TokenDataSchema
 from src.auth.models import UserModel
 
@@ -119,18 +120,18 @@ async def validate_state(r: Redis, state: str) -> bool:
         return True
     return False
     
-async def add_user_to_elastic(es: AsyncElasticsearch, user: UserModel) -> None:
-    await es.index(
-        index=ELASTIC_USERS_INDEX_NAME,
-        id=str(user.uuid),
-        document={
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "username": user.username,
-            "description": user.description,
-            "avatar": user.avatar,
-            "is_open_for_messages": user.is_open_for_messages,
-            "is_visible": user.is_visible,
-            "is_active": user.is_active,
-        }
-    )
+def sync_user_to_elastic(db: AsyncSession, user: UserModel) -> None:
+    """ The user must be flushed, so it has an uuid """
+    add_to_elastic_outbox(db, ELASTIC_USERS_INDEX_NAME, user.uuid)
+
+def user_to_elastic_doc(user: UserModel) -> dict:
+    return {
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "username": user.username,
+        "description": user.description,
+        "avatar": user.avatar,
+        "is_open_for_messages": user.is_open_for_messages,
+        "is_visible": user.is_visible,
+        "is_active": user.is_active,
+    }
@@ -0,0 +1,292 @@
+"""
+Read-through caches in redis. A key is rebuilt by one request at a time (a redis
+lock, so across workers), the others get the stale value meanwhile or, on a miss,
+wait for the rebuild. Ttls are jittered, keys filled together expire apart.
+"""
+from typing import Awaitable, Callable, Iterable, TypeVar
+from uuid import uuid4
+import asyncio
+import json
+import random
+import time
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from redis.exceptions import ResponseError
+
+from src.settings import REDIS_CACHE_EXPIRE_SECONDS, REDIS_CACHE_TTL_JITTER, REDIS_CACHE_STALE_SECONDS, \
+    REDIS_CACHE_LOCK_KEY, REDIS_CACHE_LOCK_TIMEOUT, REDIS_CACHE_LOCK_WAIT, REDIS_CACHE_LOCK_POLL_INTERVAL, \
+    REDIS_CACHE_VERSION_KEY
+
+T = TypeVar('T')
+
+# in process, the task of a key is shared by concurrent calls
+_in_flight: dict[str, asyncio.Task] = {}
+
+def jittered_ttl(seconds: int = REDIS_CACHE_EXPIRE_SECONDS) -> int:
+    return round(seconds * random.uniform(1 - REDIS_CACHE_TTL_JITTER, 1 + REDIS_CACHE_TTL_JITTER))
+
+async def coalesce(key: str, func: Callable[[], Awaitable[T]]) -> T:
+    """
+    Concurrent calls with the same key await one execution. 'func' must not
+    use the request's db session, it can outlive the request that started it.
+    """
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(func())
+        _in_flight[key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    return await asyncio.shield(task) # a cancelled caller does not cancel the others
+
+async def read_through(
+    r: Redis,
+    key: str,
+    read: Callable[[], Awaitable[tuple[T, bool] | None]],
+    rebuild: Callable[[], Awaitable[T]]
+) -> T:
+    """
+    'read' returns (value, is fresh) or None on a miss,
+    'rebuild' loads the value, stores it and returns it.
+    """
+    cached = await read()
+    if cached is not None and cached[1]:
+        return cached[0]
+
+    lock_key = REDIS_CACHE_LOCK_KEY.format(key)
+    token = uuid4().hex
+    if await r.set(lock_key, token, nx=True, ex=REDIS_CACHE_LOCK_TIMEOUT):
+        try:
+            return await rebuild()
+        finally:
+            if await r.get(lock_key) == token: # else it timed out and is someone else's
+                await r.delete(lock_key)
+
+    if cached is not None:
+        return cached[0] # stale while revalidating
+
+    deadline = time.monotonic() + REDIS_CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(REDIS_CACHE_LOCK_POLL_INTERVAL)
+        if (cached := await read()) is not None:
+            return cached[0]
+        if not await r.exists(lock_key): # done without a value (e.g. nothing to cache) or failed
+            break
+    return await rebuild()
+
+async def cached_json(
+    r: Redis,
+    key: str,
+    load: Callable[[], Awaitable[T]],
+    *,
+    ttl: int = REDIS_CACHE_EXPIRE_SECONDS,
+    stale: int = REDIS_CACHE_STALE_SECONDS
+) -> T:
+    """ 'load' returns anything json serializable """
+    async def read():
+        if (data := await r.get(key)) is None:
+            return None
+        entry = json.loads(data)
+        if not isinstance(entry, dict) or 'fresh_until' not in entry: # written before this cache
+            return None
+        return entry['data'], entry['fresh_until'] > time.time()
+
+    async def rebuild():
+        value = await load()
+        fresh = jittered_ttl(ttl)
+        entry = {'data': value, 'fresh_until': time.time() + fresh}
+        await r.set(key, json.dumps(entry, default=str), ex=fresh + stale)
+        return value
+
+    return await read_through(r, key, read, rebuild)
+
+# Hash caches (chats, folders, users of a user): one field per item uuid with its json
+# and HASH_CACHE_META_FIELD. Events patch single items in place instead of dropping
+# the hash. Every patch or drop bumps the version of the hash (REDIS_CACHE_VERSION_KEY),
+# a rebuild is only written if the version did not change while it read the db.
+HASH_CACHE_META_FIELD = '_meta'
+
+# KEYS: the hash and its version key per item, ARGV[1]: json [[field, patch], ...],
+# ARGV[2]: 1 drops a hash that misses its item, ARGV[3]: ttl of the version keys.
+# A patch is a list of [op, item field, value], see set_fields.
+PATCH_HASH_CACHE_SCRIPT = """
+local function encode(item)
+    -- cjson encodes an empty array as an object, cached items are flat
+    local parts = {}
+    for name, value in pairs(item) do
+        local encoded = (type(value) == 'table' and next(value) == nil) and '[]' or cjson.encode(value)
+        parts[#parts + 1] = cjson.encode(name) .. ':' .. encoded
+    end
+    return '{' .. table.concat(parts, ',') .. '}'
+end
+
+local function list(item, name)
+    return type(item[name]) == 'table' and item[name] or {}
+end
+
+local function filter(values, keep)
+    local kept = {}
+    for _, value in ipairs(values) do
+        if keep(value) then kept[#kept + 1] = value end
+    end
+    return kept
+end
+
+for i, patch in ipairs(cjson.decode(ARGV[1])) do
+    local key, version_key = KEYS[2 * i - 1], KEYS[2 * i]
+    redis.call('INCR', version_key)
+    redis.call('EXPIRE', version_key, ARGV[3])
+
+    local data = redis.pcall('HGET', key, patch[1])
+    if type(data) == 'table' and data.err then -- a string written before the hash caches
+        redis.call('DEL', key)
+    elseif data then
+        local item = cjson.decode(data)
+        for _, op in ipairs(patch[2]) do
+            local name, field, value = op[1], op[2], op[3]
+            if name == 'set' then
+                item[field] = value
+            elseif name == 'add' then -- appended if missing
+                local values = filter(list(item, field), function(v) return v ~= value end)
+                if #values == #list(item, field) then
+                    values[#values + 1] = value
+                    item[field] = values
+                end
+            elseif name == 'remove' then
+                item[field] = filter(list(item, field), function(v) return v ~= value end)
+            elseif name == 'keep' then -- only the values that are in 'value'
+                local allowed = {}
+                for _, v in ipairs(value) do allowed[v] = true end
+                item[field] = filter(list(item, field), function(v) return allowed[v] end)
+            end
+        end
+        redis.call('HSET', key, patch[1], encode(item))
+    elseif ARGV[2] == '1' then
+        redis.call('DEL', key)
+    end
+end
+"""
+
+# KEYS[1]: the hash, KEYS[2]: its version key, ARGV[1]: the version read before the
+# db, ARGV[2]: ttl, ARGV[3..]: field, value pairs. Returns 0 if it was not written.
+SET_HASH_CACHE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0 -- changed meanwhile, the snapshot may miss the change
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 1000 do -- unpack is limited by the lua stack
+    redis.call('HSET', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+def set_fields(**fields) -> list[list]:
+    """ A patch that replaces item fields """
+    return [['set', name, value] for name, value in fields.items()]
+
+async def get_hash_cache(r: Redis, key: str) -> tuple[list[dict], dict] | None:
+    """ Returns (items, meta) or None on a miss """
+    try:
+        data = await r.hgetall(key)
+    except ResponseError: # a string written before the hash caches, the rebuild replaces it
+        return None
+    if HASH_CACHE_META_FIELD not in data:
+        return None
+    meta = json.loads(data.pop(HASH_CACHE_META_FIELD))
+    return [json.loads(item) for item in data.values()], meta
+
+async def get_hash_cache_version(r: Redis, key: str) -> str:
+    """ Read before the db, then passed to set_hash_cache """
+    return await r.get(REDIS_CACHE_VERSION_KEY.format(key)) or ''
+
+async def set_hash_cache(
+    r: Redis,
+    key: str,
+    items: list[dict],
+    meta: dict | None = None,
+    *,
+    version: str,
+    ex: int | None = None
+) -> bool:
+    """ Items are keyed by their 'uuid'. Not written if the hash changed since 'version'. """
+    args = [version, ex or jittered_ttl()]
+    for item in items:
+        args += [str(item['uuid']), json.dumps(item, default=str)]
+    args += [HASH_CACHE_META_FIELD, json.dumps(meta or {}, default=str)]
+
+    written = await r.eval(SET_HASH_CACHE_SCRIPT, 2, key, REDIS_CACHE_VERSION_KEY.format(key), *args)
+    return bool(written)
+
+async def drop_hash_cache(r: Redis, *keys: str) -> None:
+    """ Instead of a plain delete, so a rebuild that already read the db is not written """
+    if not keys:
+        return
+
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.delete(*keys)
+        for key in keys:
+            pipe.incr(REDIS_CACHE_VERSION_KEY.format(key))
+            pipe.expire(REDIS_CACHE_VERSION_KEY.format(key), REDIS_CACHE_EXPIRE_SECONDS)
+        await pipe.execute()
+
+async def cached_hash(
+    r: Redis,
+    key: str,
+    load: Callable[[], Awaitable[tuple[list[dict], dict]]],
+    *,
+    ttl: int = REDIS_CACHE_EXPIRE_SECONDS,
+    stale: int = REDIS_CACHE_STALE_SECONDS
+) -> tuple[list[dict], dict]:
+    """ 'load' returns (items, meta), hashes are unordered, the caller sorts the items """
+    async def read():
+        if (cached := await get_hash_cache(r, key)) is None:
+            return None
+        return cached, cached[1].get('fresh_until', 0) > time.time()
+
+    async def rebuild():
+        version = await get_hash_cache_version(r, key)
+        items, meta = await load()
+        fresh = jittered_ttl(ttl)
+        await set_hash_cache(
+            r, key, items, {**meta, 'fresh_until': time.time() + fresh},
+            version=version, ex=fresh + stale
+        )
+        return items, meta
+
+    return await read_through(r, key, read, rebuild)
+
+def queue_hash_cache_patch(
+    pipe: Pipeline,
+    patches: Iterable[tuple[str, str, list[list]]],
+    *,
+    drop_missing: bool = False
+) -> None:
+    """
+    Changes cached items in place, 'patches' are (key, field, patch). One atomic
+    script for any number of keys, queued on 'pipe'. Not cached items are skipped, with
+    'drop_missing' their whole hash is dropped instead (e.g. a chat that moves into the
+    cached first page). EVAL, not EVALSHA: a NOSCRIPT after a redis restart could not be
+    retried inside the caller's transaction, redis caches the compiled script anyway.
+    """
+    keys, items = [], []
+    for key, field, patch in patches:
+        keys += [key, REDIS_CACHE_VERSION_KEY.format(key)]
+        items.append([field, patch])
+    if not items:
+        return
+
+    pipe.eval(
+        PATCH_HASH_CACHE_SCRIPT, len(keys), *keys,
+        json.dumps(items, default=str), int(drop_missing), REDIS_CACHE_EXPIRE_SECONDS
+    )
+
+async def patch_hash_cache(
+    r: Redis,
+    patches: Iterable[tuple[str, str, list[list]]],
+    *,
+    drop_missing: bool = False
+) -> None:
+    """ queue_hash_cache_patch in its own round trip """
+    async with r.pipeline(transaction=False) as pipe:
+        queue_hash_cache_patch(pipe, patches, drop_missing=drop_missing)
+        await pipe.execute()
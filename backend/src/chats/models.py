@@ -1,7 +1,8 @@
 from typing import TYPE_CHECKING
+from datetime import datetime
 
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey, String
+from sqlalchemy import ForeignKey, String, DateTime
 
 from src.database import Base
 from src.models import TimestampMixin, uuid_type
@@ -22,6 +23,13 @@ class UserChatAssociationModel(Base):
     chat: Mapped['ChatModel'] = relationship(back_populates='user_associations')
     chat_id: Mapped[int] = mapped_column(ForeignKey('chats.id'), primary_key=True)
 
+    # read watermark: every message of the chat up to this one in (created_at, id) order is
+    # read by the user. If it is deleted, everything created before last_read_at is read.
+    last_read_message_id: Mapped[int | None] = mapped_column(
+        ForeignKey('messages.id', ondelete='SET NULL'), nullable=True
+    )
+    last_read_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
 class ChatModel(Base, TimestampMixin):
     __tablename__ = 'chats'
 
@@ -37,8 +45,17 @@ class ChatModel(Base, TimestampMixin):
     is_visible: Mapped[bool] = mapped_column(default=False, nullable=True) # search
     avatar: Mapped[str] = mapped_column(nullable=True) # avatar will be set later in settings
 
+    # the newest message in (created_at, id) order, like the messages and the chat list
+    # (by last_message_at). Set with every new message, the chat list needs no subquery
+    last_message_id: Mapped[int | None] = mapped_column(
+        ForeignKey('messages.id', ondelete='SET NULL', use_alter=True, name='chats_last_message_id_fkey'),
+        nullable=True
+    )
+    last_message_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True, index=True)
+
     messages: Mapped[list["MessageModel"]] = relationship(
         back_populates="chat",
+        foreign_keys="MessageModel.chat_id",
         cascade="all, delete-orphan",
         passive_deletes=True
     )
@@ -1,64 +1,81 @@
 import logging
 from typing import Annotated
 from uuid import UUID
-import json
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query
 from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
-from elasticsearch import AsyncElasticsearch
 
 from src.folders.services import get_folder_chat_assoc_or_404
+from src.folders.utils import add_chat_to_cached_folder, remove_chat_from_cached_folder, \
+    pin_chat_in_cached_folder
 from src.chats.services import create_chat_in_db, delete_chat_in_db,\
     quit_group_in_db, set_users_in_group, get_chat_or_404, get_chat_schemas, \
     pin_chat_in_folder, set_chat_folder_in_db, add_user_to_group_in_db
-from src.chats.utils import chat_to_schema, add_chat_to_elastic
+from src.chats.utils import chat_to_schema, invalidate_user_chat_uuids, encode_chat_cursor, \
+    decode_chat_cursor, chat_activity_key
 from src.chats.schemas import CreateChatSchema, SetChatFoldersSchema, \
     AddUserToGroupSchema
 from src.dependencies import get_active_current_user
-from src.utils import invalidate_cache, wrap_list_response
-from src.settings import ELASTIC_CHATS_INDEX_NAME, REDIS_CHATS_KEY, REDIS_CACHE_EXPIRE_SECONDS, \
-    REDIS_FOLDERS_KEY
+from src.utils import wrap_page_response
+from src.cache import cached_hash, patch_hash_cache
+from src.settings import REDIS_CHATS_KEY, REDIS_FOLDERS_KEY, CHATS_PAGE_SIZE, \
+    CHATS_MAX_PAGE_SIZE, CHATS_MAX_MEMBERS_PREVIEW
 from src.auth.models import UserModel
-from src.database import get_db, get_redis, get_es
+from src.database import get_db, get_redis
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix='/chats', tags=['chats'])
 
+# recent activity first, keyset pagination: cursor is from the previous page
 @router.get('/')
 async def get_all_chats(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
+    cursor: str | None = Query(None, description="From the previous page, none for the first one"),
+    limit: int = Query(CHATS_PAGE_SIZE, ge=1, le=CHATS_MAX_PAGE_SIZE),
+    members_preview: int | None = Query(
+        None, ge=1, le=CHATS_MAX_MEMBERS_PREVIEW,
+        description="Only the first members of a group, members_count has them all"
+    ),
 ):
-    redis_key = REDIS_CHATS_KEY.format(current_user.uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-
-    chats_schemas = await get_chat_schemas(db, current_user)
-    chats = [chat.model_dump() for chat in chats_schemas]
-    data = wrap_list_response(chats)
-
-    await r.set(
-        redis_key,
-        json.dumps(data, default=str),
-        REDIS_CACHE_EXPIRE_SECONDS
-    )
-
-    return data
+    # only the first page with the default parameters is cached
+    is_cached_page = cursor is None and limit == CHATS_PAGE_SIZE and members_preview is None
+
+    after = decode_chat_cursor(cursor) if cursor is not None else None
+
+    async def load():
+        chats_schemas, last_chat = await get_chat_schemas(
+            db, current_user, after=after, limit=limit, members_preview=members_preview
+        )
+        chats = [chat.model_dump(mode='json') for chat in chats_schemas]
+        page = {
+            'has_more': last_chat is not None,
+            'cursor': encode_chat_cursor(last_chat) if last_chat is not None else None,
+        }
+        return chats, page
+
+    if is_cached_page:
+        # a hash by chat uuid, new messages patch it in place
+        chats, page = await cached_hash(r, REDIS_CHATS_KEY.format(current_user.uuid), load)
+        # the cursor stays valid while the same chats are cached, only their order changes
+        chats.sort(key=chat_activity_key, reverse=True)
+    else:
+        chats, page = await load()
+
+    return {**wrap_page_response(chats, page['has_more']), 'cursor': page['cursor']}
 
 @router.post('/')
 async def create_chat(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     chat_info: CreateChatSchema
 ):
     chat = await create_chat_in_db(db, current_user, chat_info)
-    await invalidate_cache(r, REDIS_CHATS_KEY, current_user.uuid)
-    await add_chat_to_elastic(es, chat, current_user.username, chat_info.name)
+    await invalidate_user_chat_uuids(r, *[assoc.user.uuid for assoc in chat.user_associations])
     logger.info(f"Chat '{chat.uuid}' created by '{current_user.username}'")
     return chat_to_schema(current_user, chat, None)
 
@@ -66,14 +83,13 @@ async def create_chat(
 async def delete_chat(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     chat_uuid: UUID
 ):
     chat = await get_chat_or_404(db, chat_uuid)
+    member_uuids = [assoc.user.uuid for assoc in chat.user_associations]
     await delete_chat_in_db(db, current_user, chat)
-    await invalidate_cache(r, REDIS_CHATS_KEY, current_user.uuid)
-    await es.delete(index=ELASTIC_CHATS_INDEX_NAME, id=str(chat_uuid))
+    await invalidate_user_chat_uuids(r, *member_uuids)
 
     logger.info(f"Chat '{chat.name}' deleted by '{current_user.username}'")
     return {'success': True}
@@ -83,13 +99,12 @@ async def delete_chat(
 async def quit_group(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     group_uuid: UUID
 ):
     group = await get_chat_or_404(db, group_uuid)
-    await quit_group_in_db(db, es, current_user, group)
-    await invalidate_cache(r, REDIS_CHATS_KEY, current_user.uuid)
+    await quit_group_in_db(db, current_user, group)
+    await invalidate_user_chat_uuids(r, current_user.uuid)
 
     logger.info(f"'{current_user.username}' quit group '{group.name}'")
     return {'success': True}
@@ -98,20 +113,19 @@ async def quit_group(
 async def add_user_to_group(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     uuids: AddUserToGroupSchema
 ):
     group = await get_chat_or_404(db, uuids.group_uuid)
-    await set_users_in_group(db, es, current_user, group, uuids.user_uuids)
-    await invalidate_cache(r, REDIS_CHATS_KEY, current_user.uuid)
+    old_member_uuids = [assoc.user.uuid for assoc in group.user_associations]
+    await set_users_in_group(db, current_user, group, uuids.user_uuids)
+    await invalidate_user_chat_uuids(r, *set(old_member_uuids) | set(uuids.user_uuids))
     return {'success': True }
 
 @router.put('/join_group/{group_uuid}')
 async def join_group(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     group_uuid: UUID
 ):
@@ -121,8 +135,8 @@ async def join_group(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
                             detail='Group is not open for messages')
 
-    await add_user_to_group_in_db(db, es, group, current_user)
-    await invalidate_cache(r, REDIS_CHATS_KEY, current_user.uuid)
+    await add_user_to_group_in_db(db, group, current_user)
+    await invalidate_user_chat_uuids(r, current_user.uuid)
     return chat_to_schema(current_user, group, None)
 
 # # only for custom
@@ -172,8 +186,13 @@ async def set_chat_folders(
     folder_uuids: SetChatFoldersSchema
 ):
     chat = await get_chat_or_404(db, chat_uuid)
-    await set_chat_folder_in_db(db, current_user, chat, folder_uuids.folder_uuids)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+    added, removed = await set_chat_folder_in_db(db, current_user, chat, folder_uuids.folder_uuids)
+
+    redis_key = REDIS_FOLDERS_KEY.format(current_user.uuid)
+    await patch_hash_cache(r, [
+        *[(redis_key, str(uuid), add_chat_to_cached_folder(chat_uuid)) for uuid in added],
+        *[(redis_key, str(uuid), remove_chat_from_cached_folder(chat_uuid)) for uuid in removed],
+    ])
     logger.info(f'Folders of the chat {chat_uuid} were setted')
     return {'success': True}
 
@@ -188,6 +207,9 @@ async def pin_chat(
 ):
     assoc = await get_folder_chat_assoc_or_404(db, current_user, folder_uuid, chat_uuid)
     is_pinned = await pin_chat_in_folder(db, assoc)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+    await patch_hash_cache(r, [(
+        REDIS_FOLDERS_KEY.format(current_user.uuid), str(folder_uuid),
+        pin_chat_in_cached_folder(chat_uuid, is_pinned)
+    )])
     logger.info(f'Chat pinned in folder {assoc.folder.name} by {current_user.username}')
     return {'is_pinned': is_pinned}
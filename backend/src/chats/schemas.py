@@ -28,7 +28,9 @@ class ChatSchema(BaseModel):
     created_at: datetime
     updated_at: datetime
     last_message: str | None = Field(default=None) # optional
-    user_uuids: list[UUID]
+    last_message_at: datetime | None = Field(default=None)
+    user_uuids: list[UUID] # every member, or the first ones with a members preview
+    members_count: int
 
     model_config = ConfigDict(from_attributes=True, use_enum_values=True)
 
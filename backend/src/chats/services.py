@@ -1,69 +1,200 @@
 from uuid import UUID
+from datetime import datetime
 import logging
 
 from fastapi import HTTPException, status
+from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete, insert
+from sqlalchemy import select, delete, insert, exists, and_, or_, tuple_, func
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import selectinload, aliased
-from elasticsearch import AsyncElasticsearch
+from sqlalchemy.orm import selectinload, aliased, raiseload
 
+from src.settings import REDIS_USER_CHAT_UUIDS_KEY, REDIS_USER_CHAT_PARTNERS_KEY, CHATS_PAGE_SIZE
 from src.utils import save_to_db, get_object_or_404
+from src.cache import jittered_ttl
 from src.auth.models import UserModel
 from src.messages.models import MessageModel
-from src.chats.schemas import CreateChatSchema
+from src.chats.schemas import CreateChatSchema, ChatSchema
 from src.chats.models import ChatModel, UserChatAssociationModel
 from src.chats.enums import ChatType
 from src.chats.utils import group_folders_by_type, ensure_user_in_chat_or_403,\
-    update_group_members_in_elastic, ensure_no_normal_chat_or_403, chat_to_schema
+    sync_chat_to_elastic, sync_user_scope_to_elastic, ensure_no_normal_chat_or_403, \
+    group_and_message_model_to_schema, other_user_to_chat_schema
 from src.chats.utils import is_user_in_chat
 from src.folders.models import FolderChatAssociationModel, FolderModel
 from src.folders.enums import FolderType
 
 logger = logging.getLogger(__name__)
 
-async def get_all_chats_with_last_message(
-    db: AsyncSession, user: UserModel
-) -> list[tuple[ChatModel, MessageModel]]:
-
-    # subquery: last message for every chat
-    last_message_subq = (
-        select(MessageModel.id)
-        .where(MessageModel.chat_id == ChatModel.id)
-        .order_by(MessageModel.created_at.desc())
-        .limit(1)
-        .correlate(ChatModel)
-        .scalar_subquery()
+def chats_after(last_message_at: datetime | None, created_at: datetime, chat_id: int):
+    """ Chats behind the cursor in the (last_message_at desc nulls last, created_at desc, id desc) order """
+    older = tuple_(ChatModel.created_at, ChatModel.id) < tuple_(created_at, chat_id)
+    if last_message_at is None: # already in the chats without messages
+        return and_(ChatModel.last_message_at.is_(None), older)
+    return or_(
+        ChatModel.last_message_at < last_message_at,
+        and_(ChatModel.last_message_at == last_message_at, older),
+        ChatModel.last_message_at.is_(None),
     )
 
-    LastMessage = aliased(MessageModel)
-
+async def get_chats_page(
+    db: AsyncSession,
+    user: UserModel,
+    *,
+    after: tuple[datetime | None, datetime, int] | None = None,
+    limit: int = CHATS_PAGE_SIZE,
+) -> tuple[list[tuple[ChatModel, str | None]], bool]:
+    """
+    Returns up to 'limit' (chat, last message) rows, recent activity first,
+    and whether there are more. 'after' is the position of the last chat of
+    the previous page, see decode_chat_cursor. Members are not loaded.
+    """
     stmt = (
         select(
             ChatModel,
-            LastMessage.content
+            MessageModel.content
         )
         .join(UserChatAssociationModel, ChatModel.id == UserChatAssociationModel.chat_id)
-        .outerjoin(LastMessage, LastMessage.id == last_message_subq)
+        # denormalized pointer, no per chat subquery
+        .outerjoin(MessageModel, MessageModel.id == ChatModel.last_message_id)
         .where(UserChatAssociationModel.user_id == user.id)
-        .order_by(ChatModel.created_at.desc())
-        .options(
-            selectinload(ChatModel.user_associations)
-            .selectinload(UserChatAssociationModel.user)
+        # recent activity first, chats without messages last
+        .order_by(
+            ChatModel.last_message_at.desc().nulls_last(),
+            ChatModel.created_at.desc(),
+            ChatModel.id.desc()
         )
     )
+    if after is not None:
+        stmt = stmt.where(chats_after(*after))
+
+    result = await db.execute(stmt.limit(limit + 1)) # +1 to know if there is more
+    rows = list(result.all())
+    return rows[:limit], len(rows) > limit
+
+async def get_members_preview(
+    db: AsyncSession,
+    chat_ids: list[int],
+    size: int | None = None
+) -> dict[int, tuple[list[UUID], int]]:
+    """ chat id -> (uuids of the first 'size' members or all, members count), one query for a whole page """
+    ranked = (
+        select(
+            UserChatAssociationModel.chat_id,
+            UserModel.uuid,
+            func.row_number().over(
+                partition_by=UserChatAssociationModel.chat_id,
+                order_by=UserChatAssociationModel.user_id
+            ).label('position'),
+            func.count().over(partition_by=UserChatAssociationModel.chat_id).label('members_count')
+        )
+        .join(UserModel, UserModel.id == UserChatAssociationModel.user_id)
+        .where(UserChatAssociationModel.chat_id.in_(chat_ids))
+        .subquery()
+    )
+    stmt = (
+        select(ranked.c.chat_id, ranked.c.uuid, ranked.c.members_count)
+        .order_by(ranked.c.chat_id, ranked.c.position)
+    )
+    if size is not None:
+        stmt = stmt.where(ranked.c.position <= size)
 
     result = await db.execute(stmt)
-    rows = result.all()
-    return rows
 
-async def get_chat_schemas(db: AsyncSession, user: UserModel):
-    chats = await get_all_chats_with_last_message(db, user)
-    schemas = []
+    previews: dict[int, tuple[list[UUID], int]] = {}
+    for chat_id, user_uuid, members_count in result:
+        previews.setdefault(chat_id, ([], members_count))[0].append(user_uuid)
+    return previews
+
+async def get_chat_partners(db: AsyncSession, user: UserModel, chat_ids: list[int]) -> dict[int, UserModel]:
+    """ chat id -> the other user of each normal chat """
+    result = await db.execute(
+        select(UserChatAssociationModel.chat_id, UserModel)
+        .join(UserModel, UserModel.id == UserChatAssociationModel.user_id)
+        .where(UserChatAssociationModel.chat_id.in_(chat_ids))
+        .where(UserChatAssociationModel.user_id != user.id)
+    )
+    return {chat_id: other_user for chat_id, other_user in result}
+
+# an empty redis set does not exist, so every cached set also holds USER_SET_CACHE_FILLED
+# and a user without chats or partners is not looked up in the db on every request
+USER_SET_CACHE_FILLED = ''
+
+async def get_user_chat_uuids(db: AsyncSession, r: Redis, user: UserModel) -> list[UUID]:
+    """ Only the uuids, cached as a redis set """
+    redis_key = REDIS_USER_CHAT_UUIDS_KEY.format(user.uuid)
+    if cached := await r.smembers(redis_key):
+        return [UUID(chat_uuid) for chat_uuid in cached if chat_uuid != USER_SET_CACHE_FILLED]
+
+    chat_uuids = list(await db.scalars(
+        select(ChatModel.uuid)
+        .join(UserChatAssociationModel, ChatModel.id == UserChatAssociationModel.chat_id)
+        .where(UserChatAssociationModel.user_id == user.id)
+    ))
+
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.sadd(redis_key, USER_SET_CACHE_FILLED, *[str(chat_uuid) for chat_uuid in chat_uuids])
+        pipe.expire(redis_key, jittered_ttl())
+        await pipe.execute()
+
+    return chat_uuids
+
+async def get_user_chat_partner_uuids(db: AsyncSession, r: Redis, user: UserModel) -> list[UUID]:
+    """ Users connected to 'user' via NORMAL chat, cached as a redis set """
+    redis_key = REDIS_USER_CHAT_PARTNERS_KEY.format(user.uuid)
+    if cached := await r.smembers(redis_key):
+        return [UUID(user_uuid) for user_uuid in cached if user_uuid != USER_SET_CACHE_FILLED]
+
+    ChatAssoc = UserChatAssociationModel
+    OtherAssoc = aliased(UserChatAssociationModel)
+    partner_uuids = list(await db.scalars(
+        select(UserModel.uuid)
+        .join(OtherAssoc, UserModel.id == OtherAssoc.user_id)
+        .join(ChatAssoc, ChatAssoc.chat_id == OtherAssoc.chat_id)
+        .join(ChatModel, ChatModel.id == OtherAssoc.chat_id)
+        .where(ChatAssoc.user_id == user.id)
+        .where(UserModel.id != user.id)
+        .where(ChatModel.chat_type == ChatType.NORMAL)
+        .distinct()
+    ))
+
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.sadd(redis_key, USER_SET_CACHE_FILLED, *[str(user_uuid) for user_uuid in partner_uuids])
+        pipe.expire(redis_key, jittered_ttl())
+        await pipe.execute()
+
+    return partner_uuids
+
+async def get_chat_schemas(
+    db: AsyncSession,
+    user: UserModel,
+    *,
+    after: tuple[datetime | None, datetime, int] | None = None,
+    limit: int = CHATS_PAGE_SIZE,
+    members_preview: int | None = None,
+) -> tuple[list[ChatSchema], ChatModel | None]:
+    """
+    One page of the chat list and its last chat, None on the last page.
+    With 'members_preview' a group lists only its first members, else all of them.
+    """
+    rows, has_more = await get_chats_page(db, user, after=after, limit=limit)
+    normal_chat_ids = [chat.id for chat, _ in rows if chat.chat_type == ChatType.NORMAL]
+
+    group_ids = [chat.id for chat, _ in rows if chat.chat_type == ChatType.GROUP]
+
+    partners = await get_chat_partners(db, user, normal_chat_ids) if normal_chat_ids else {}
+    previews = await get_members_preview(db, group_ids, members_preview) if group_ids else {}
 
-    for chat, last_message in chats:
-        schemas.append(chat_to_schema(user, chat, last_message))
-    return schemas
+    schemas = []
+    for chat, last_message in rows:
+        if chat.chat_type == ChatType.NORMAL:
+            if chat.id not in partners: # the other user is gone
+                continue
+            schemas.append(other_user_to_chat_schema(user, chat, last_message, partners[chat.id]))
+        else:
+            member_uuids, members_count = previews.get(chat.id, ([], 0))
+            schemas.append(group_and_message_model_to_schema(chat, last_message, member_uuids, members_count))
+    return schemas, rows[-1][0] if has_more else None
 
 # is shorter in that way
 async def get_chat_or_404(db: AsyncSession, chat_uuid: UUID) -> ChatModel:
@@ -93,6 +224,50 @@ async def get_chat_or_none(
     )
     return result.scalar_one_or_none()
 
+# for hot paths (websocket events, message pages): the chat row only,
+# members are checked with is_chat_member instead of being loaded
+async def get_slim_chat_or_none(db: AsyncSession, chat_uuid: UUID) -> ChatModel | None:
+    """ Relationships raise instead of lazy loading """
+    result = await db.execute(
+        select(ChatModel)
+        .where(ChatModel.uuid == chat_uuid)
+        .options(raiseload('*'))
+    )
+    return result.scalar_one_or_none()
+
+async def get_slim_chat_or_404(db: AsyncSession, chat_uuid: UUID) -> ChatModel:
+    return await get_object_or_404(
+        db, ChatModel, ChatModel.uuid == chat_uuid, detail='Chat not found',
+        options=[raiseload('*')]
+    )
+
+async def is_chat_member(db: AsyncSession, user: UserModel, chat: ChatModel) -> bool:
+    """ Primary key lookup on user_chat_associations, no association is loaded """
+    return await db.scalar(select(exists().where(
+        UserChatAssociationModel.user_id == user.id,
+        UserChatAssociationModel.chat_id == chat.id
+    )))
+
+async def ensure_chat_member_or_403(
+    db: AsyncSession,
+    user: UserModel,
+    chat: ChatModel,
+    detail: str = "You must be in the chat"
+) -> None:
+    if not await is_chat_member(db, user, chat):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail=detail
+        )
+
+async def get_chat_member_uuids(db: AsyncSession, chat: ChatModel) -> list[UUID]:
+    """ Only the uuids, no UserModel per member """
+    return list(await db.scalars(
+        select(UserModel.uuid)
+        .join(UserChatAssociationModel, UserChatAssociationModel.user_id == UserModel.id)
+        .where(UserChatAssociationModel.chat_id == chat.id)
+    ))
+
 async def create_chat_in_db(
     db: AsyncSession,
     current_user: UserModel,
@@ -134,6 +309,10 @@ async def create_chat_in_db(
         group_folder_assoc = FolderChatAssociationModel(folder=folders[FolderType.GROUPS], chat=chat)
         db.add(group_folder_assoc)
 
+    await db.flush() # uuid for the outbox
+    sync_chat_to_elastic(db, chat.uuid)
+    sync_user_scope_to_elastic(db, *[assoc.user.uuid for assoc in chat.user_associations])
+
     # commit and flush
     chat = (await save_to_db(db, [chat]))[0]
     # loads user and folder associations
@@ -151,12 +330,13 @@ async def delete_chat_in_db(
     # folders = [assoc.folder for assoc in chat.folder_associations]
     # await invalidate_chat_cache(r, *folders, user=user)
 
+    sync_chat_to_elastic(db, chat.uuid)
+    sync_user_scope_to_elastic(db, *[assoc.user.uuid for assoc in chat.user_associations])
     await db.delete(chat)
     await db.commit()
 
 async def quit_group_in_db(
     db: AsyncSession,
-    es: AsyncElasticsearch,
     current_user: UserModel,
     group: ChatModel
 ) -> None:
@@ -186,14 +366,22 @@ async def quit_group_in_db(
             )
         )
     )
+    sync_chat_to_elastic(db, group.uuid)
+    sync_user_scope_to_elastic(db, current_user.uuid)
     await db.commit()
 
-    await db.refresh(group)
-    await update_group_members_in_elastic(es, group)
+def newest_message_id_subquery(chat_id: int):
+    """ The newest message of the chat in (created_at, id) order, where a read watermark is put """
+    return (
+        select(MessageModel.id)
+        .where(MessageModel.chat_id == chat_id)
+        .order_by(MessageModel.created_at.desc(), MessageModel.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
 
 async def add_user_to_group_in_db(
     db: AsyncSession,
-    es: AsyncElasticsearch,
     group: ChatModel,
     user: UserModel,
 ) -> ChatModel:
@@ -214,19 +402,25 @@ async def add_user_to_group_in_db(
 
     folders = group_folders_by_type(await get_folders_list(db, user))
 
-    chat_association = UserChatAssociationModel(user=user, chat=group)
+    # the history before the join is not unread
+    chat_association = UserChatAssociationModel(
+        user=user,
+        chat=group,
+        last_read_message_id=newest_message_id_subquery(group.id),
+        last_read_at=func.now(),
+    )
     all_folder_assoc = FolderChatAssociationModel(folder=folders[FolderType.ALL], chat=group)
     group_folder_assoc = FolderChatAssociationModel(folder=folders[FolderType.GROUPS], chat=group)
     db.add_all([chat_association, all_folder_assoc, group_folder_assoc])
+    sync_chat_to_elastic(db, group.uuid)
+    sync_user_scope_to_elastic(db, user.uuid)
     await db.commit()
 
     await db.refresh(group)
-    await update_group_members_in_elastic(es, group)
     return group
 
 async def user_add_user_to_group_in_db(
     db: AsyncSession,
-    es: AsyncElasticsearch,
     group: ChatModel,
     other_user: UserModel,
     user: UserModel
@@ -234,14 +428,13 @@ async def user_add_user_to_group_in_db(
     """ User add other user into group """
 
     ensure_user_in_chat_or_403(user, group, 'Only group members can add new users')
-    group = await add_user_to_group_in_db(db, es, group, other_user)
+    group = await add_user_to_group_in_db(db, group, other_user)
     logger.info(f"'{other_user.username}' added to group '{group.name}' by {user.username}")
 
     return group
 
 async def set_users_in_group(
     db: AsyncSession,
-    es: AsyncElasticsearch,
     user: UserModel,
     group: ChatModel,
     user_uuids: list[UUID]
@@ -327,27 +520,35 @@ async def set_users_in_group(
             ],
         )
 
+    sync_chat_to_elastic(db, group.uuid)
+    if to_add or to_remove:
+        changed_user_uuids = await db.scalars(
+            select(UserModel.uuid).where(UserModel.id.in_(to_add | to_remove))
+        )
+        sync_user_scope_to_elastic(db, *changed_user_uuids)
     await db.commit()
 
-    await db.refresh(group)
-    await update_group_members_in_elastic(es, group)
-
 async def set_chat_folder_in_db(
     db: AsyncSession,
     user: UserModel,
     chat: ChatModel,
     folder_uuids: list[UUID]
-) -> None:
+) -> tuple[list[UUID], list[UUID]]:
+    """ Returns the uuids of the folders the chat was added to and removed from """
     ensure_user_in_chat_or_403(user, chat, 'Not your Chat')
 
-    # get current folder ids
-    current_folder_ids = set(
-        await db.scalars(
-            select(FolderChatAssociationModel.folder_id).where(
-                FolderChatAssociationModel.chat_id == chat.id
-            )
+    # get current custom folders of the user, other folders are not touched
+    result = await db.execute(
+        select(FolderModel.id, FolderModel.uuid)
+        .join(FolderChatAssociationModel, FolderChatAssociationModel.folder_id == FolderModel.id)
+        .where(
+            FolderChatAssociationModel.chat_id == chat.id,
+            FolderModel.user_id == user.id,
+            FolderModel.folder_type == FolderType.CUSTOM,
         )
     )
+    current_folder_uuids = dict(result.all())
+    current_folder_ids = set(current_folder_uuids)
 
     # take new folders
     result = await db.execute(
@@ -390,6 +591,9 @@ async def set_chat_folder_in_db(
 
     await db.commit()
 
+    folder_uuids_by_id = {f.id: f.uuid for f in new_folders} | current_folder_uuids
+    return [folder_uuids_by_id[fid] for fid in to_add], [folder_uuids_by_id[fid] for fid in to_remove]
+
 # True - was pinned up | False - was unpinned
 async def pin_chat_in_folder(
     db: AsyncSession,
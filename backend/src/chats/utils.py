@@ -1,9 +1,19 @@
+from uuid import UUID
+from datetime import datetime
+import base64
+import binascii
+import json
+
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from elasticsearch import AsyncElasticsearch
 from fastapi import HTTPException, status
+from redis.asyncio import Redis
 
-from src.settings import ELASTIC_CHATS_INDEX_NAME
+from src.settings import ELASTIC_CHATS_INDEX_NAME, ELASTIC_USER_SCOPES_INDEX_NAME, \
+    REDIS_USER_CHAT_UUIDS_KEY, REDIS_USER_CHAT_PARTNERS_KEY, REDIS_CHATS_KEY, REDIS_FOLDERS_KEY, \
+    REDIS_USERS_KEY
+from src.cache import patch_hash_cache, set_fields, drop_hash_cache
+from src.search.utils import add_to_elastic_outbox
 from src.auth.models import UserModel
 from src.folders.models import FolderModel
 from src.folders.enums import FolderType
@@ -14,9 +24,15 @@ from src.messages.models import MessageModel
 
 def group_and_message_model_to_schema(
     chat: ChatModel,
-    last_message: str
+    last_message: str,
+    member_uuids: list[UUID] | None = None,
+    members_count: int | None = None
 ) -> ChatSchema:
-    print(chat.avatar)
+    """ Without 'member_uuids' the members come from the loaded user_associations """
+    if member_uuids is None:
+        member_uuids = [assoc.user.uuid for assoc in chat.user_associations]
+        members_count = len(member_uuids)
+
     return ChatSchema(
         uuid=chat.uuid,
         chat_type=chat.chat_type,
@@ -26,21 +42,25 @@ def group_and_message_model_to_schema(
         is_open_for_messages=chat.is_open_for_messages,
         is_visible=chat.is_visible,
         last_message=last_message if last_message is not None else None,
+        last_message_at=chat.last_message_at,
         created_at=chat.created_at,
         updated_at=chat.updated_at,
-        user_uuids=[assoc.user.uuid for assoc in chat.user_associations]
+        user_uuids=member_uuids,
+        members_count=members_count
     )
 
 def other_user_to_chat_schema(
     user: UserModel,
     chat: ChatModel,
-    last_message: str
+    last_message: str,
+    other_user: UserModel | None = None
 ) -> ChatSchema:
     # finds the other user
-    other_user = next(
-        (assoc.user for assoc in chat.user_associations if assoc.user_id != user.id),
-        None
-    )
+    if other_user is None:
+        other_user = next(
+            (assoc.user for assoc in chat.user_associations if assoc.user_id != user.id),
+            None
+        )
     if not other_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Something went wrong")
 
@@ -53,9 +73,11 @@ def other_user_to_chat_schema(
         is_open_for_messages=other_user.is_open_for_messages,
         is_visible=other_user.is_visible,
         last_message=last_message if last_message is not None else None,
+        last_message_at=chat.last_message_at,
         created_at=chat.created_at,
         updated_at=chat.updated_at,
-        user_uuids=[assoc.user.uuid for assoc in chat.user_associations]
+        user_uuids=[user.uuid, other_user.uuid],
+        members_count=2
     )
 
 def chat_to_schema(user: UserModel, chat: ChatModel, last_message: MessageModel) -> ChatSchema:
@@ -63,6 +85,49 @@ def chat_to_schema(user: UserModel, chat: ChatModel, last_message: MessageModel)
         return group_and_message_model_to_schema(chat, last_message)
     return other_user_to_chat_schema(user, chat, last_message)
 
+def encode_chat_cursor(chat: ChatModel) -> str:
+    """ Opaque for the client: the position of the last chat of a page """
+    last_message_at = chat.last_message_at.isoformat() if chat.last_message_at else None
+    data = json.dumps([last_message_at, chat.created_at.isoformat(), chat.id]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+def decode_chat_cursor(cursor: str) -> tuple[datetime | None, datetime, int]:
+    try:
+        last_message_at, created_at, chat_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (
+            datetime.fromisoformat(last_message_at) if last_message_at else None,
+            datetime.fromisoformat(created_at),
+            int(chat_id)
+        )
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+def chat_activity_key(chat: dict) -> tuple:
+    """ Sorts cached chats like get_chats_page (reversed): recent activity first, chats without messages last """
+    last_message_at = chat['last_message_at']
+    return (
+        last_message_at is not None,
+        datetime.fromisoformat(last_message_at or chat['created_at']),
+        datetime.fromisoformat(chat['created_at']),
+    )
+
+async def patch_group_in_caches(r: Redis, group: ChatModel) -> None:
+    """ The cached chat lists of the members get the new group settings, user_associations must be loaded """
+    settings = {
+        'name': group.name,
+        'description': group.description,
+        'avatar': group.avatar,
+        'is_open_for_messages': group.is_open_for_messages,
+        'is_visible': group.is_visible,
+    }
+    await patch_hash_cache(r, [
+        (REDIS_CHATS_KEY.format(assoc.user.uuid), str(group.uuid), set_fields(**settings))
+        for assoc in group.user_associations
+    ])
+
 def group_folders_by_type(folders: list[FolderModel]) -> dict[FolderType, FolderModel]:
     return {f.folder_type: f for f in folders}
 
@@ -71,6 +136,16 @@ def group_folders_by_type(folders: list[FolderModel]) -> dict[FolderType, Folder
 #         invalidate_cache(r, REDIS_CHATS_KEY, folder.uuid, user.uuid) for folder in folders
 #     ])
 
+# a chat joins or leaves the lists, that can not be patched in place
+MEMBERSHIP_CACHE_KEYS = (REDIS_USER_CHAT_UUIDS_KEY, REDIS_USER_CHAT_PARTNERS_KEY)
+MEMBERSHIP_HASH_CACHE_KEYS = (REDIS_CHATS_KEY, REDIS_FOLDERS_KEY, REDIS_USERS_KEY)
+
+async def invalidate_user_chat_uuids(r: Redis, *user_uuids: UUID) -> None:
+    """ Must be called for every user whose memberships changed, drops his chat, folder and user lists too """
+    if user_uuids:
+        await r.delete(*[key.format(uuid) for key in MEMBERSHIP_CACHE_KEYS for uuid in user_uuids])
+        await drop_hash_cache(r, *[key.format(uuid) for key in MEMBERSHIP_HASH_CACHE_KEYS for uuid in user_uuids])
+
 def get_group_users_uuids(chat: ChatModel) -> list[str]:
     return [str(assoc.user.uuid) for assoc in chat.user_associations]
 
@@ -113,33 +188,29 @@ def ensure_user_in_chat_or_403(
             detail=detail
         )
 
-async def update_group_members_in_elastic(es: AsyncElasticsearch, chat: ChatModel) -> None:
-    await es.update(
-        index=ELASTIC_CHATS_INDEX_NAME,
-        id=str(chat.uuid),
-        doc={
-            "members": get_group_users_uuids(chat),
-        }
-    )
+def sync_chat_to_elastic(db: AsyncSession, *chat_uuids: UUID) -> None:
+    """ For created, changed and deleted chats """
+    add_to_elastic_outbox(db, ELASTIC_CHATS_INDEX_NAME, *chat_uuids)
 
-async def add_chat_to_elastic(
-    es: AsyncElasticsearch,
-    chat: ChatModel,
-    username: str = None,
-    other_username: str = None,
-    avatar: str = None
-) -> None:
-    await es.index(
-        index=ELASTIC_CHATS_INDEX_NAME,
-        id=str(chat.uuid),
-        document={
-            "chat_type": chat.chat_type.value,
-            "name": chat.name if chat.chat_type == ChatType.GROUP else None,
-            "description": chat.description,
-            "avatar": avatar, # if group creation, than None (later in settings) else over uuid
-            "members": get_group_users_uuids(chat),
-            "user_names": [username, other_username] if chat.chat_type == ChatType.NORMAL else None,
-            "is_visible": chat.is_visible,
-            "is_open_for_messages": chat.is_open_for_messages,
-        }
-    )
+def sync_user_scope_to_elastic(db: AsyncSession, *user_uuids: UUID) -> None:
+    """ For users who joined or left a chat """
+    add_to_elastic_outbox(db, ELASTIC_USER_SCOPES_INDEX_NAME, *user_uuids)
+
+def user_scope_to_elastic_doc(user: UserModel) -> dict:
+    """ chat_associations with their chats must be loaded """
+    return {"chats": [str(assoc.chat.uuid) for assoc in user.chat_associations]}
+
+def chat_to_elastic_doc(chat: ChatModel) -> dict:
+    """ user_associations with their users must be loaded """
+    return {
+        "chat_type": chat.chat_type.value,
+        "name": chat.name if chat.chat_type == ChatType.GROUP else None,
+        "description": chat.description,
+        "avatar": chat.avatar,
+        "members": get_group_users_uuids(chat),
+        "user_names": [
+            assoc.user.username for assoc in chat.user_associations
+        ] if chat.chat_type == ChatType.NORMAL else None,
+        "is_visible": chat.is_visible,
+        "is_open_for_messages": chat.is_open_for_messages,
+    }
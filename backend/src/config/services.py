@@ -1,14 +1,12 @@
-from uuid import UUID
-
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from elasticsearch import AsyncElasticsearch
 from fastapi import HTTPException, status
 
-from src.settings import ELASTIC_CHATS_INDEX_NAME, ELASTIC_USERS_INDEX_NAME
-from src.chats.models import ChatModel
+from src.chats.models import ChatModel, UserChatAssociationModel
 from src.auth.models import UserModel
 from src.chats.enums import ChatType
-from src.chats.utils import ensure_user_in_chat_or_403
+from src.chats.utils import ensure_user_in_chat_or_403, sync_chat_to_elastic
+from src.auth.utils import sync_user_to_elastic
 from src.config.schemas import UserConfigSchema, GroupConfigSchema
 
 async def update_user_config_in_db(
@@ -16,6 +14,8 @@ async def update_user_config_in_db(
     user: UserModel,
     user_config: UserConfigSchema
 ) -> None:
+    username_changed = user.username != user_config.username
+
     user.first_name = user_config.first_name
     user.last_name = user_config.last_name
     user.username = user_config.username
@@ -23,56 +23,21 @@ async def update_user_config_in_db(
     user.is_visible = user_config.is_visible
     user.is_open_for_messages = user_config.is_open_for_messages
     # not avatar
-    await db.commit()
 
+    sync_user_to_elastic(db, user)
+    if username_changed:
+        # private chats are searchable by the usernames
+        normal_chat_uuids = await db.scalars(
+            select(ChatModel.uuid)
+            .join(UserChatAssociationModel, ChatModel.id == UserChatAssociationModel.chat_id)
+            .where(
+                UserChatAssociationModel.user_id == user.id,
+                ChatModel.chat_type == ChatType.NORMAL,
+            )
+        )
+        sync_chat_to_elastic(db, *normal_chat_uuids)
 
-async def update_user_config_in_elastic(
-    es: AsyncElasticsearch,
-    user_config: UserConfigSchema,
-    old_username: str,
-    user_uuid: UUID,
-) -> None:
-    await es.update(
-        index=ELASTIC_USERS_INDEX_NAME,
-        id=str(user_uuid),
-        doc={
-            "first_name": user_config.first_name,
-            "last_name": user_config.last_name,
-            "username": user_config.username,
-            "description": user_config.description,
-            "is_visible": user_config.is_visible,
-            "is_open_for_messages": user_config.is_open_for_messages,
-            # not avatar
-        },
-    )
-
-    if old_username == user_config.username:
-        return
-    
-    # for private chats to
-    await es.update_by_query(
-        index=ELASTIC_CHATS_INDEX_NAME,
-        query={
-            "term": {
-                "user_names.keyword": old_username
-            }
-        },
-        script={
-            "source": """
-                if (ctx._source.user_names != null) {
-                    for (int i = 0; i < ctx._source.user_names.size(); i++) {
-                        if (ctx._source.user_names[i] == params.old) {
-                            ctx._source.user_names[i] = params.new;
-                        }
-                    }
-                }
-            """,
-            "params": {
-                "old": old_username,
-                "new": user_config.username,
-            }
-        }
-    )
+    await db.commit()
 
 async def update_group_config_in_db(
     db: AsyncSession,
@@ -92,20 +57,5 @@ async def update_group_config_in_db(
     group.is_open_for_messages = group_config.is_open_for_messages
     group.is_visible = group_config.is_visible
     # not avatar
+    sync_chat_to_elastic(db, group.uuid)
     await db.commit()
-
-async def update_group_config_in_elastic(
-    es: AsyncElasticsearch,
-    group_config: GroupConfigSchema
-) -> None:
-    await es.update(
-        index=ELASTIC_CHATS_INDEX_NAME,
-        id=str(group_config.uuid),
-        doc={
-            "name": group_config.name,
-            "description": group_config.description,
-            "is_open_for_messages": group_config.is_open_for_messages,
-            "is_visible": group_config.is_visible,
-            # not avatar
-        }
-    )
\ No newline at end of file
@@ -1,15 +1,15 @@
 import logging
 import asyncio
 
-from sqlalchemy.orm import DeclarativeBase, selectinload
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine, AsyncSession
-from sqlalchemy import select
+from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from redis.asyncio import Redis
 from elasticsearch import AsyncElasticsearch, exceptions
-from elasticsearch.helpers import async_bulk
 
 from src.settings import DATABASE_URL, REDIS_PORT, REDIS_HOST, ELASTIC_PASSWORD, \
-    ELASTIC_CHATS_INDEX_NAME, ELASTIC_MESSAGES_INDEX_NAME, ELASTIC_USERS_INDEX_NAME, ELASTIC_HOST
+    ELASTIC_CHATS_INDEX_NAME, ELASTIC_MESSAGES_INDEX_NAME, ELASTIC_USERS_INDEX_NAME, \
+    ELASTIC_USER_SCOPES_INDEX_NAME, ELASTIC_HOST, ELASTIC_MESSAGES_ILM_POLICY, \
+    ELASTIC_MESSAGES_ROLLOVER_MAX_AGE, ELASTIC_MESSAGES_ROLLOVER_MAX_SHARD_SIZE
 
 logger = logging.getLogger(__name__)
 
@@ -60,237 +60,170 @@ async def wait_for_elasticsearch(es: AsyncElasticsearch, retries: int = 50, dela
     logger.warning("Elasticsearch did not become available in time.")
     raise RuntimeError("Elasticsearch did not become available in time.")
 
-# no need for production
-async def sync_db_to_elastic(db: AsyncSession, es: AsyncElasticsearch) -> None:
-    from src.auth.models import UserModel
-    from src.chats.models import ChatModel, UserChatAssociationModel
-    from src.chats.enums import ChatType
-    from src.messages.models import MessageModel
-    from src.chats.utils import get_group_users_uuids
-
-    logger.info("Starting full synchronization...")
-
-    result = await db.execute(select(UserModel))
-    users = result.scalars().all()
-
-    if users:
-        user_actions = [
-            {
-                "_index": ELASTIC_USERS_INDEX_NAME,
-                "_id": str(user.uuid),
-                "_source": {
-                    "first_name": user.first_name,
-                    "last_name": user.last_name,
-                    "username": user.username,
-                    "description": user.description,
-                    "avatar": user.avatar,
-                    "is_open_for_messages": user.is_open_for_messages,
-                    "is_visible": user.is_visible,
-                    "is_active": user.is_active,
-                }
-            } for user in users
-        ]
-        await async_bulk(es, user_actions)
-        logger.info(f"Synced {len(users)} users.")
-
-    result = await db.execute(
-        select(ChatModel)
-        .options(
-            selectinload(ChatModel.user_associations)
-            .selectinload(UserChatAssociationModel.user),
-        )
-    )
-    chats = result.scalars().all()
-
-    if chats:
-        chat_actions = []
-        for chat in chats:
-            user_names = None
-            if chat.chat_type == ChatType.NORMAL:
-                user_names = [assoc.user.username for assoc in chat.user_associations]
-
-            chat_actions.append({
-                "_index": ELASTIC_CHATS_INDEX_NAME,
-                "_id": str(chat.uuid),
-                "_source": {
-                    "chat_type": chat.chat_type.value,
-                    "name": chat.name if chat.chat_type == ChatType.GROUP else None,
-                    "description": chat.description,
-                    "avatar": chat.avatar, 
-                    "members": get_group_users_uuids(chat),
-                    "user_names": user_names,
-                    "is_visible": chat.is_visible,
-                    "is_open_for_messages": chat.is_open_for_messages,
-                }
-            })
-        
-        await async_bulk(es, chat_actions)
-        logger.info(f"Synced {len(chats)} chats.")
-
-    result = await db.execute(
-        select(MessageModel)
-        .options(
-            selectinload(MessageModel.user),
-            selectinload(MessageModel.chat),
-        )
-    )
-
-    messages = result.scalars().all()
-
-    if messages:
-        message_actions = [
-            {
-                "_index": ELASTIC_MESSAGES_INDEX_NAME,
-                "_id": str(message.uuid),
-                "_source": {
-                    "content": message.content,
-                    "chat": str(message.chat.uuid),
-                    "user": str(message.user.uuid),
-                }
+ELASTIC_INDEX_SETTINGS = {
+    "analysis": {
+        "tokenizer": {
+            "autocomplete_tokenizer": {
+                "type": "edge_ngram",
+                "min_gram": 1,
+                "max_gram": 20,
+                "token_chars": ["letter", "digit"]
             }
-            for message in messages
-        ]
-
-        await async_bulk(es, message_actions)
-        logger.info(f"Synced {len(messages)} messages.")
-
-    logger.info("Full synchronization complete!")
-
-
-async def create_indices(es: AsyncElasticsearch):
-    common_settings = {
-        "settings": {
-            "analysis": {
-                "tokenizer": {
-                    "autocomplete_tokenizer": {
-                        "type": "edge_ngram",
-                        "min_gram": 1,
-                        "max_gram": 20,
-                        "token_chars": ["letter", "digit"]
+        },
+        "analyzer": {
+            "autocomplete": {
+                "type": "custom",
+                "tokenizer": "autocomplete_tokenizer",
+                "filter": ["lowercase"]
+            }
+        }
+    }
+}
+
+ELASTIC_INDEX_MAPPINGS = {
+    ELASTIC_CHATS_INDEX_NAME: {
+        "properties": {
+            "name": {
+                "type": "text",
+                "fields": {
+                    "autocomplete": {
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "standard"
                     }
-                },
-                "analyzer": {
+                }
+            },
+            "user_names": { # only for normal chats
+                "type": "text",
+                "fields": {
                     "autocomplete": {
-                        "type": "custom",
-                        "tokenizer": "autocomplete_tokenizer",
-                        "filter": ["lowercase"]
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "standard"
                     }
                 }
-            }
+            },
+            "description": {"type": "text"},
+            "chat_type": {"type": "keyword"},
+            "members": {"type": "keyword"}, # users in chat
+            "is_visible": {"type": "boolean"}, # always false in normal chats
+            "is_open_for_messages": {"type": "boolean"}, # always false in normal chats
+            "avatar": {"type": "keyword", "index": False},
         }
-    }
-
-    # chats
-    if not await es.indices.exists(index=ELASTIC_CHATS_INDEX_NAME):
-        await es.indices.create(
-            index=ELASTIC_CHATS_INDEX_NAME,
-            body={
-                **common_settings,
-                "mappings": {
-                    "properties": {
-                        "name": {
-                            "type": "text",
-                            "fields": {
-                                "autocomplete": {
-                                    "type": "text",
-                                    "analyzer": "autocomplete",
-                                    "search_analyzer": "standard"
-                                }
-                            }
-                        },
-                        "user_names": { # only for normal chats
-                            "type": "text",
-                            "fields": {
-                                "autocomplete": {
-                                    "type": "text",
-                                    "analyzer": "autocomplete",
-                                    "search_analyzer": "standard"
-                                }
-                            }
-                        },
-                        "description": {"type": "text"},
-                        "chat_type": {"type": "keyword"},
-                        "members": {"type": "keyword"}, # users in chat
-                        "is_visible": {"type": "boolean"}, # always false in normal chats
-                        "is_open_for_messages": {"type": "boolean"}, # always false in normal chats
-                        "avatar": {"type": "keyword", "index": False},
+    },
+    ELASTIC_USERS_INDEX_NAME: {
+        "properties": {
+            "first_name": {
+                "type": "text",
+                "fields": {
+                    "autocomplete": {
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "standard"
                     }
                 }
-            }
-        )
-        logger.info(f"Elasticsearch index '{ELASTIC_CHATS_INDEX_NAME}' created")
-
-    # users
-    if not await es.indices.exists(index=ELASTIC_USERS_INDEX_NAME):
-        await es.indices.create(
-            index=ELASTIC_USERS_INDEX_NAME,
-            body={
-                **common_settings,
-                "mappings": {
-                    "properties": {
-                        "first_name": {
-                            "type": "text",
-                            "fields": {
-                                "autocomplete": {
-                                    "type": "text",
-                                    "analyzer": "autocomplete",
-                                    "search_analyzer": "standard"
-                                }
-                            }
-                        },
-                        "last_name": {
-                            "type": "text",
-                            "fields": {
-                                "autocomplete": {
-                                    "type": "text",
-                                    "analyzer": "autocomplete",
-                                    "search_analyzer": "standard"
-                                }
-                            }
-                        },
-                        "username": {
-                            "type": "text",
-                            "fields": {
-                                "autocomplete": {
-                                    "type": "text",
-                                    "analyzer": "autocomplete",
-                                    "search_analyzer": "standard"
-                                }
-                            }
-                        },
-                        "description": {"type": "text"},
-                        "avatar": {"type": "keyword", "index": False},
-                        "is_open_for_messages": {"type": "boolean"},
-                        "is_visible": {"type": "boolean"},
-                        "is_active": {"type": "boolean"},
+            },
+            "last_name": {
+                "type": "text",
+                "fields": {
+                    "autocomplete": {
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "standard"
                     }
                 }
-            }
-        )
-        logger.info(f"Elasticsearch index '{ELASTIC_USERS_INDEX_NAME}' created")
-
-    # messages
-    if not await es.indices.exists(index=ELASTIC_MESSAGES_INDEX_NAME):
-        await es.indices.create(
-            index=ELASTIC_MESSAGES_INDEX_NAME,
-            body={
-                **common_settings,
-                "mappings": {
-                    "properties": {
-                        "content": {
-                            "type": "text",
-                            "fields": {
-                                "autocomplete": {
-                                    "type": "text",
-                                    "analyzer": "autocomplete",
-                                    "search_analyzer": "standard"
-                                }
-                            }
-                        },
-                        "chat": {"type": "keyword"}, # chat uuid
-                        "user": {"type": "keyword"}, # user uuid
+            },
+            "username": {
+                "type": "text",
+                "fields": {
+                    "autocomplete": {
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "standard"
                     }
                 }
+            },
+            "description": {"type": "text"},
+            "avatar": {"type": "keyword", "index": False},
+            "is_open_for_messages": {"type": "boolean"},
+            "is_visible": {"type": "boolean"},
+            "is_active": {"type": "boolean"},
+        }
+    },
+    ELASTIC_MESSAGES_INDEX_NAME: {
+        "_routing": {"required": True}, # routed by chat uuid
+        "properties": {
+            # no edge ngrams, they multiply the size of the biggest index.
+            # short prefixes are indexed for prefix queries
+            "content": {
+                "type": "text",
+                "index_prefixes": {"min_chars": 2, "max_chars": 5}
+            },
+            "chat": {"type": "keyword"}, # chat uuid
+            "user": {"type": "keyword"}, # user uuid
+            "created_at": {"type": "date"},
+        }
+    },
+    ELASTIC_USER_SCOPES_INDEX_NAME: { # id: user uuid
+        "properties": {
+            "chats": {"type": "keyword", "index": False}, # only read by terms lookups
+        }
+    },
+}
+
+# written through a write alias, ILM rolls it over to '<alias>-000002' and so on
+ELASTIC_ROLLOVER_ALIASES = {ELASTIC_MESSAGES_INDEX_NAME: ELASTIC_MESSAGES_ILM_POLICY}
+
+ELASTIC_MESSAGES_ILM = {
+    "phases": {
+        "hot": {
+            "actions": {
+                "rollover": {
+                    "max_age": ELASTIC_MESSAGES_ROLLOVER_MAX_AGE,
+                    "max_primary_shard_size": ELASTIC_MESSAGES_ROLLOVER_MAX_SHARD_SIZE,
+                }
             }
+        },
+        # no longer written, only deleted from with their chats
+        "warm": {
+            "min_age": "7d",
+            "actions": {"forcemerge": {"max_num_segments": 1}}
+        },
+    }
+}
+
+def get_index_settings(index: str) -> dict:
+    """ Settings for a new index behind the 'index' alias """
+    if index in ELASTIC_ROLLOVER_ALIASES: # only names are autocompleted
+        return {
+            "index.lifecycle.name": ELASTIC_ROLLOVER_ALIASES[index],
+            "index.lifecycle.rollover_alias": index,
+        }
+    return ELASTIC_INDEX_SETTINGS
+
+async def create_indices(es: AsyncElasticsearch):
+    # every generation of a rolled over index gets the mapping from the template
+    await es.ilm.put_lifecycle(name=ELASTIC_MESSAGES_ILM_POLICY, policy=ELASTIC_MESSAGES_ILM)
+    for alias in ELASTIC_ROLLOVER_ALIASES:
+        await es.indices.put_index_template(
+            name=alias,
+            index_patterns=[f"{alias}-*"],
+            template={"settings": get_index_settings(alias), "mappings": ELASTIC_INDEX_MAPPINGS[alias]},
         )
-        logger.info(f"Elasticsearch index '{ELASTIC_MESSAGES_INDEX_NAME}' created")
+
+    for index, mappings in ELASTIC_INDEX_MAPPINGS.items():
+        # also true for an alias
+        if await es.indices.exists(index=index):
+            continue
+
+        if index in ELASTIC_ROLLOVER_ALIASES:
+            await es.indices.create(
+                index=f"{index}-000001",
+                aliases={index: {"is_write_index": True}}
+            )
+        else:
+            await es.indices.create(
+                index=index,
+                body={"settings": ELASTIC_INDEX_SETTINGS, "mappings": mappings}
+            )
+        logger.info(f"Elasticsearch index '{index}' created")
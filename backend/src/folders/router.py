@@ -1,15 +1,15 @@
 from uuid import UUID
 from typing import Annotated
 import logging
-import json
 
 from fastapi import APIRouter, Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 from redis.asyncio import Redis
 
-from src.settings import REDIS_FOLDERS_KEY, REDIS_CACHE_EXPIRE_SECONDS
+from src.settings import REDIS_FOLDERS_KEY
 from src.database import get_db, get_redis
-from src.utils import invalidate_cache, get_object_or_404, wrap_list_response
+from src.utils import get_object_or_404, wrap_list_response
+from src.cache import cached_hash, patch_hash_cache, drop_hash_cache, set_fields
 from src.dependencies import get_active_current_user
 from src.auth.models import UserModel
 from src.folders.models import FolderModel
@@ -29,24 +29,19 @@ async def get_all_folders(
     r: Annotated[Redis, Depends(get_redis)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
 ):
-    redis_key = REDIS_FOLDERS_KEY.format(current_user.uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-
-    folder_models = await get_folders_list(db, current_user)
-    folders = [
-        folder_model_to_schema(folder).model_dump()
-        for folder in folder_models
-    ]
-    data = wrap_list_response(folders)
+    async def load():
+        folder_models = await get_folders_list(db, current_user)
+        folders = [
+            folder_model_to_schema(folder).model_dump(mode='json')
+            for folder in folder_models
+        ]
+        return folders, {}
 
-    await r.set(
-        redis_key,
-        json.dumps(data, default=str),
-        REDIS_CACHE_EXPIRE_SECONDS
-    )
+    # a hash by folder uuid, patched in place by chat and folder changes
+    folders, _ = await cached_hash(r, REDIS_FOLDERS_KEY.format(current_user.uuid), load)
+    folders.sort(key=lambda folder: folder['position'])
 
-    return data
+    return wrap_list_response(folders)
 
 # @router.get('/{folder_uuid}/')
 # async def get_chats_from_folder(
@@ -80,7 +75,7 @@ async def create_folder(
     folder_info: CreateFolderSchema,
 ):
     folder = await create_folder_in_db(db, current_user, folder_info)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+    await drop_hash_cache(r, REDIS_FOLDERS_KEY.format(current_user.uuid))
     logger.info(f'Folder {folder.name} created by {current_user.username}')
     return FolderSchema.model_validate(folder)
 
@@ -98,7 +93,7 @@ async def delete_folder(
     )
 
     await delete_folder_in_db(db, current_user, folder)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+    await drop_hash_cache(r, REDIS_FOLDERS_KEY.format(current_user.uuid))
     return {'success': True}
 
 # only for custom
@@ -116,7 +111,9 @@ async def rename_folder(
     )
 
     await rename_folder_in_db(db, current_user, folder, folder_info.name)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+    await patch_hash_cache(r, [
+        (REDIS_FOLDERS_KEY.format(current_user.uuid), str(folder_uuid), set_fields(name=folder_info.name))
+    ])
     return {'success': True}
 
 # only for custom
@@ -133,8 +130,11 @@ async def replace_chats(
         detail='Folder not found'
     )
     
-    await replace_chats_in_db(db, current_user, folder, chat_uuids.uuids)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+    folder_chat_uuids = [str(uuid) for uuid in await replace_chats_in_db(db, current_user, folder, chat_uuids.uuids)]
+    await patch_hash_cache(r, [(
+        REDIS_FOLDERS_KEY.format(current_user.uuid), str(folder_uuid),
+        set_fields(chat_uuids=folder_chat_uuids) + [['keep', 'pinned_chats', folder_chat_uuids]]
+    )])
     logger.info(f'Chats of the folder {folder_uuid} were replaced')
     return {'success': True}
 
@@ -146,6 +146,12 @@ async def order_folders(
     folders: FolderOrderListSchema
 ):
     await order_folders_in_db(db, current_user, folders.folders)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+
+    positions = {str(f.uuid): f.position for f in folders.folders}
+    redis_key = REDIS_FOLDERS_KEY.format(current_user.uuid)
+    await patch_hash_cache(r, [
+        (redis_key, folder_uuid, set_fields(position=position))
+        for folder_uuid, position in positions.items()
+    ])
     logger.info(f'Folder order from user {current_user.uuid} was changed')
     return {'success': True}
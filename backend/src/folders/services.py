@@ -159,7 +159,8 @@ async def rename_folder_in_db(
 
 async def replace_chats_in_db(
     db: AsyncSession, user: UserModel, folder: FolderModel, chat_uuids: list[UUID]
-) -> None:
+) -> list[UUID]:
+    """ Returns the uuids of the chats that are in the folder now """
     if folder.user_id != user.id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Not your folder"
@@ -181,9 +182,10 @@ async def replace_chats_in_db(
 
     # get ids from chat uuids
     result = await db.execute(
-        select(ChatModel.id).where(ChatModel.uuid.in_(chat_uuids))
+        select(ChatModel.id, ChatModel.uuid).where(ChatModel.uuid.in_(chat_uuids))
     )
-    new_chat_ids = {i[0] for i in result.all()}
+    new_chat_uuids = dict(result.all())
+    new_chat_ids = set(new_chat_uuids)
 
     # calculates diff
     to_add = new_chat_ids - current_chat_ids
@@ -204,6 +206,7 @@ async def replace_chats_in_db(
         )
 
     await db.commit()
+    return list(new_chat_uuids.values())
 
 async def delete_chat_from_folder(
     db: AsyncSession,
@@ -1,3 +1,5 @@
+from uuid import UUID
+
 from src.folders.models import FolderModel
 from src.folders.schemas import FolderSchema
 
@@ -20,3 +22,17 @@ def folder_model_to_schema(folder: FolderModel) -> FolderSchema:
         pinned_chats=pinned_chats,
         chat_uuids=chat_uuids,
     )
+
+# patches of a folder in the folders hash cache, see patch_hash_cache
+
+def add_chat_to_cached_folder(chat_uuid: UUID) -> list[list]:
+    return [['add', 'chat_uuids', str(chat_uuid)]]
+
+def remove_chat_from_cached_folder(chat_uuid: UUID) -> list[list]:
+    return [['remove', 'chat_uuids', str(chat_uuid)], ['remove', 'pinned_chats', str(chat_uuid)]]
+
+def pin_chat_in_cached_folder(chat_uuid: UUID, is_pinned: bool) -> list[list]:
+    patch = [['remove', 'pinned_chats', str(chat_uuid)]]
+    if is_pinned: # moves to the end
+        patch.append(['add', 'pinned_chats', str(chat_uuid)])
+    return patch
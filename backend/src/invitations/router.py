@@ -1,4 +1,3 @@
-import json
 import logging
 from typing import Annotated
 from uuid import UUID
@@ -7,16 +6,15 @@ from fastapi import APIRouter, Depends
 from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
-from elasticsearch import AsyncElasticsearch
 
-from src.settings import REDIS_CACHE_EXPIRE_SECONDS, REDIS_USER_INVITATION_KEY,\
-    REDIS_GROUP_INVITATION_KEY
-from src.database import get_db, get_redis, get_es
+from src.settings import REDIS_USER_INVITATION_KEY, REDIS_GROUP_INVITATION_KEY
+from src.database import get_db, get_redis
 from src.dependencies import get_active_current_user
-from src.utils import get_all_objects, get_object_or_404, wrap_list_response, \
-    invalidate_cache
+from src.utils import get_all_objects, wrap_list_response, invalidate_cache
+from src.cache import cached_json
 from src.auth.models import UserModel
-from src.chats.models import ChatModel
+from src.chats.utils import invalidate_user_chat_uuids
+from src.chats.services import get_slim_chat_or_404, ensure_chat_member_or_403
 from src.invitations.models import InvitationModel
 from src.invitations.enums import InvitationType
 from src.invitations.utils import get_invitation_or_404, invitation_model_to_schema
@@ -34,28 +32,18 @@ async def get_all_user_invitations(
     r: Annotated[Redis, Depends(get_redis)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
 ):
-    redis_key = REDIS_USER_INVITATION_KEY.format(current_user.uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-
-    invitation_models = await get_all_objects(
-        db, InvitationModel, InvitationModel.user_id == current_user.id,
-        options=[selectinload(InvitationModel.group)]
-    )
-    invitations = [
-        invitation_model_to_schema(i).model_dump(mode="json")
-        for i in invitation_models
-    ]
-
-    data = wrap_list_response(invitations)
-
-    await r.set(
-        redis_key,
-        json.dumps(data),
-        ex=REDIS_CACHE_EXPIRE_SECONDS
-    )
-
-    return data
+    async def load():
+        invitation_models = await get_all_objects(
+            db, InvitationModel, InvitationModel.user_id == current_user.id,
+            options=[selectinload(InvitationModel.group)]
+        )
+        invitations = [
+            invitation_model_to_schema(i).model_dump(mode="json")
+            for i in invitation_models
+        ]
+        return wrap_list_response(invitations)
+
+    return await cached_json(r, REDIS_USER_INVITATION_KEY.format(current_user.uuid), load)
 
 @router.get('/group')
 async def get_all_group_invitations(
@@ -64,29 +52,19 @@ async def get_all_group_invitations(
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     group_uuid: UUID
 ):
-    redis_key = REDIS_GROUP_INVITATION_KEY.format(group_uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-
-    group = await get_object_or_404(
-        db, ChatModel, ChatModel.uuid == group_uuid, detail='Group not found',
-        options=[selectinload(ChatModel.user_associations)]
-    )
-    invitation_models = await get_all_group_invitations_list(db, current_user, group)
-    invitations = [
-        invitation_model_to_schema(i).model_dump(mode="json")
-        for i in invitation_models
-    ]
-
-    data = wrap_list_response(invitations)
-
-    await r.set(
-        redis_key,
-        json.dumps(data),
-        ex=REDIS_CACHE_EXPIRE_SECONDS
-    )
-
-    return data
+    # the cache is per group, so the membership is checked before it
+    group = await get_slim_chat_or_404(db, group_uuid)
+    await ensure_chat_member_or_403(db, current_user, group, 'Only group members can see invitations')
+
+    async def load():
+        invitation_models = await get_all_group_invitations_list(db, current_user, group)
+        invitations = [
+            invitation_model_to_schema(i).model_dump(mode="json")
+            for i in invitation_models
+        ]
+        return wrap_list_response(invitations)
+
+    return await cached_json(r, REDIS_GROUP_INVITATION_KEY.format(group_uuid), load)
 
 @router.post('/')
 async def create_invitation(
@@ -129,15 +107,16 @@ async def delete_invitation(
 async def join_via_invitation(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     invitation_uuid: UUID
 ):
     invitation = await get_invitation_or_404(db, invitation_uuid)
-    await use_invitation(db, es, current_user, invitation)
+    await use_invitation(db, current_user, invitation)
+    await invalidate_user_chat_uuids(r, current_user.uuid)
 
     if invitation.invitation_type == InvitationType.USER:
         await invalidate_cache(r, REDIS_USER_INVITATION_KEY, current_user.uuid)
+        await invalidate_user_chat_uuids(r, invitation.user.uuid)
         logger.info(f'{current_user.username} created a chat via invitation with {invitation.user.username}')
     elif invitation.invitation_type == InvitationType.GROUP:
         await invalidate_cache(r, REDIS_GROUP_INVITATION_KEY, invitation.group.uuid)
@@ -6,7 +6,6 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload, joinedload
 from sqlalchemy import select
 from redis.asyncio import Redis
-from elasticsearch import AsyncElasticsearch
 
 from src.utils import save_to_db, get_object_or_404, get_all_objects
 from src.auth.models import UserModel
@@ -14,7 +13,7 @@ from src.chats.models import ChatModel, UserChatAssociationModel
 from src.chats.schemas import CreateChatSchema
 from src.chats.enums import ChatType
 from src.chats.utils import ensure_user_in_chat_or_403
-from src.chats.services import create_chat_in_db, add_user_to_group_in_db
+from src.chats.services import create_chat_in_db, add_user_to_group_in_db, ensure_chat_member_or_403
 from src.invitations.models import InvitationModel
 from src.invitations.enums import InvitationType
 from src.invitations.schemas import InvitationSchema
@@ -27,7 +26,7 @@ async def get_all_group_invitations_list(
     user: UserModel,
     group: ChatModel
 ) -> list[InvitationModel]:
-    ensure_user_in_chat_or_403(user, group, 'Only group members can see invitations')
+    await ensure_chat_member_or_403(db, user, group, 'Only group members can see invitations')
 
     invitations = await get_all_objects(
         db, InvitationModel, InvitationModel.group_id == group.id,
@@ -87,7 +86,6 @@ async def delete_invitation_in_db(
 
 async def use_invitation(
     db: AsyncSession,
-    es: AsyncElasticsearch,
     user: UserModel,
     invitation: InvitationModel
 ) -> None:
@@ -123,4 +121,4 @@ async def use_invitation(
             .where(ChatModel.uuid == invitation.group.uuid)
         )
         group = result.scalar_one_or_none()
-        await add_user_to_group_in_db(db, es, group, user)
+        await add_user_to_group_in_db(db, group, user)
@@ -1,4 +1,3 @@
-import json
 import logging
 from uuid import UUID
 from typing import Annotated
@@ -7,15 +6,15 @@ from fastapi import APIRouter, Depends
 from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
-from elasticsearch import AsyncElasticsearch
 
-from src.settings import REDIS_USER_JOIN_REQUESTS_KEY, REDIS_GROUP_JOIN_REQUESTS_KEY, REDIS_CACHE_EXPIRE_SECONDS
-from src.database import get_db, get_redis, get_es
+from src.settings import REDIS_USER_JOIN_REQUESTS_KEY, REDIS_GROUP_JOIN_REQUESTS_KEY
+from src.database import get_db, get_redis
 from src.dependencies import get_active_current_user
-from src.utils import get_all_objects, get_object_or_404, wrap_list_response, \
-    invalidate_cache
+from src.utils import get_all_objects, wrap_list_response, invalidate_cache
+from src.cache import cached_json
 from src.auth.models import UserModel
-from src.chats.models import ChatModel
+from src.chats.utils import invalidate_user_chat_uuids
+from src.chats.services import get_slim_chat_or_404, ensure_chat_member_or_403
 from src.join_requests.models import JoinRequestModel
 from src.join_requests.enums import JoinRequestType
 from src.join_requests.utils import serialize_join_request_model_list, get_join_request_or_404
@@ -33,23 +32,14 @@ async def get_all_user_join_requests(
     r: Annotated[Redis, Depends(get_redis)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
 ):
-    redis_key = REDIS_USER_JOIN_REQUESTS_KEY.format(current_user.uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-
-    join_request_models = await get_all_objects(
-        db, JoinRequestModel, JoinRequestModel.receiver_user_id == current_user.id,
-        options=[selectinload(JoinRequestModel.sender_user), selectinload(JoinRequestModel.receiver_user)]
-    )
-    join_requests = serialize_join_request_model_list(join_request_models)
-    data = wrap_list_response(join_requests)
-
-    await r.set(
-        redis_key,
-        json.dumps(data),
-        REDIS_CACHE_EXPIRE_SECONDS
-    )
-    return data
+    async def load():
+        join_request_models = await get_all_objects(
+            db, JoinRequestModel, JoinRequestModel.receiver_user_id == current_user.id,
+            options=[selectinload(JoinRequestModel.sender_user), selectinload(JoinRequestModel.receiver_user)]
+        )
+        return wrap_list_response(serialize_join_request_model_list(join_request_models))
+
+    return await cached_json(r, REDIS_USER_JOIN_REQUESTS_KEY.format(current_user.uuid), load)
 
 @router.get('/group')
 async def get_all_group_join_requests(
@@ -58,24 +48,15 @@ async def get_all_group_join_requests(
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     group_uuid: UUID
 ):
-    redis_key = REDIS_GROUP_JOIN_REQUESTS_KEY.format(group_uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-
-    group = await get_object_or_404(
-        db, ChatModel, ChatModel.uuid == group_uuid, detail='Group not found',
-        options=[selectinload(ChatModel.user_associations)]
-    )
-    join_request_models = await get_all_group_join_requests_list(db, current_user, group)
-    join_requests = serialize_join_request_model_list(join_request_models)
-    data = wrap_list_response(join_requests)
-
-    await r.set(
-        redis_key,
-        json.dumps(data),
-        REDIS_CACHE_EXPIRE_SECONDS
-    )
-    return data
+    # the cache is per group, so the membership is checked before it
+    group = await get_slim_chat_or_404(db, group_uuid)
+    await ensure_chat_member_or_403(db, current_user, group, 'Only group members can get join requests')
+
+    async def load():
+        join_request_models = await get_all_group_join_requests_list(db, current_user, group)
+        return wrap_list_response(serialize_join_request_model_list(join_request_models))
+
+    return await cached_json(r, REDIS_GROUP_JOIN_REQUESTS_KEY.format(group_uuid), load)
 
 @router.post('/')
 async def create_join_request(
@@ -106,14 +87,15 @@ async def create_join_request(
 async def approve_join_request(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     join_request_uuid: UUID,
 ):
     join_request = await get_join_request_or_404(db, join_request_uuid)
     sender_username = join_request.sender_user.username
+    sender_uuid = join_request.sender_user.uuid
     
-    await approve_join_request_in_db(db, es, current_user, join_request)
+    await approve_join_request_in_db(db, current_user, join_request)
+    await invalidate_user_chat_uuids(r, current_user.uuid, sender_uuid)
 
     if join_request.join_request_type == JoinRequestType.USER:
         await invalidate_cache(r, REDIS_USER_JOIN_REQUESTS_KEY, current_user.uuid)
@@ -2,7 +2,6 @@ from fastapi import HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 from redis.asyncio import Redis
-from elasticsearch import AsyncElasticsearch
 
 from src.utils import save_to_db, get_object_or_404, get_all_objects
 from src.auth.models import UserModel
@@ -10,7 +9,7 @@ from src.chats.models import ChatModel
 from src.chats.schemas import CreateChatSchema
 from src.chats.enums import ChatType
 from src.chats.utils import is_user_in_chat, ensure_no_normal_chat_or_403, ensure_user_in_chat_or_403
-from src.chats.services import user_add_user_to_group_in_db, create_chat_in_db
+from src.chats.services import user_add_user_to_group_in_db, create_chat_in_db, ensure_chat_member_or_403
 from src.join_requests.models import JoinRequestModel
 from src.join_requests.enums import JoinRequestType
 from src.join_requests.schemas import CreateJoinRequestSchema
@@ -20,7 +19,7 @@ async def get_all_group_join_requests_list(
     user: UserModel,
     group: ChatModel
 ) -> list[JoinRequestModel]:
-    ensure_user_in_chat_or_403(user, group, 'Only group members can get join requests')
+    await ensure_chat_member_or_403(db, user, group, 'Only group members can get join requests')
 
     join_requests = await get_all_objects(
         db, JoinRequestModel, JoinRequestModel.group_id == group.id,
@@ -79,7 +78,6 @@ async def create_join_request_in_db(
 
 async def approve_join_request_in_db(
     db: AsyncSession,
-    es: AsyncElasticsearch,
     user: UserModel,
     join_request: JoinRequestModel,
 ) -> None:
@@ -96,7 +94,7 @@ async def approve_join_request_in_db(
         ))
     elif join_request.join_request_type == JoinRequestType.GROUP:
         # already checks if receiver in the group
-        await user_add_user_to_group_in_db(db, es, join_request.group, join_request.sender_user, user)
+        await user_add_user_to_group_in_db(db, join_request.group, join_request.sender_user, user)
     
     await db.delete(join_request)
     await db.commit()
@@ -9,10 +9,12 @@ from starlette.middleware.sessions import SessionMiddleware
 from src.routers import main_router
 from src.settings import SECRET_KEY, FRONTEND_HOST
 from src.logger import setup_logging
-from src.database import create_indices, wait_for_elasticsearch, sync_db_to_elastic,\
-    es, async_session
+from src.database import create_indices, wait_for_elasticsearch, es
 from src.invitations.background import periodic_invitation_cleaner
 from src.messages.handlers import connection_manager
+from src.messages.background import periodic_ws_stats_logger
+from src.search.outbox import outbox_replicator
+from src.search.background import periodic_outbox_stats_logger
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -22,16 +24,17 @@ async def lifespan(app: FastAPI):
     # elasticsearch
     await wait_for_elasticsearch(es)
     await create_indices(es)
-
-    # async with async_session() as db:
-    #     await sync_db_to_elastic(db, es)
+    outbox_replicator.start() # postgres -> elasticsearch
+    asyncio.create_task(periodic_outbox_stats_logger())
 
     # invitation cleaner
     asyncio.create_task(periodic_invitation_cleaner()) # deletes old invitations
 
     # pubsub
+    asyncio.create_task(periodic_ws_stats_logger()) # delivery metrics
     yield
     await connection_manager.close()
+    await outbox_replicator.close()
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(main_router)
@@ -0,0 +1,15 @@
+import asyncio
+import logging
+
+from src.settings import STATS_LOG_INTERVAL
+from src.messages.handlers import connection_manager
+
+logger = logging.getLogger(__name__)
+
+async def periodic_ws_stats_logger():
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        try:
+            logger.info(f'Websocket stats: {connection_manager.stats()}')
+        except Exception as e:
+            logger.error(f'Failed to collect websocket stats: {e}')
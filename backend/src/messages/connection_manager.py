@@ -3,8 +3,10 @@ import json
 import logging
 
 from fastapi import WebSocket
+from redis.asyncio.client import Pipeline
 
 from src.messages.pubsub_manager import PubSubManager
+from src.messages.socket_writer import SocketWriter
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +15,8 @@ class ConnectionManager:
         self.handlers: dict = {}
         self.chats: dict[UUID, set[WebSocket]] = {}
         self.user_uuid_to_ws: dict[UUID, set[WebSocket]] = {}
+        self.writers: dict[WebSocket, SocketWriter] = {}
+        self.ws_to_chats: dict[WebSocket, set[UUID]] = {}
         self.pubsub = PubSubManager()
 
     def handler(self, message_type):
@@ -23,19 +27,41 @@ class ConnectionManager:
     
     async def connect_socket(self, ws: WebSocket):
         await ws.accept()
+        self.writers[ws] = SocketWriter(ws)
+    
+    async def disconnect_socket(self, ws: WebSocket):
+        writer = self.writers.pop(ws, None)
+        if writer:
+            await writer.stop()
+
+        # also chats joined after the handshake
+        chat_uuids = self.ws_to_chats.pop(ws, set())
+        await self.remove_user_from_chats(list(chat_uuids), ws)
     
     async def close(self):
+        for writer in self.writers.values():
+            await writer.stop()
         await self.pubsub.close()
 
     async def add_user_socket_connection(self, user_uuid: UUID, ws: WebSocket):
         self.user_uuid_to_ws.setdefault(user_uuid, set()).add(ws)
     
     async def add_user_to_chat(self, chat_uuid: UUID, ws: WebSocket):
-        if chat_uuid in self.chats: # a.k.a. already subscribed
-            self.chats[chat_uuid].add(ws)
-        else:
-            self.chats[chat_uuid] = {ws}
-            await self.pubsub.subscribe(chat_uuid, self._on_pubsub_message)
+        await self.add_user_to_chats([chat_uuid], ws)
+    
+    async def add_user_to_chats(self, chat_uuids: list[UUID], ws: WebSocket):
+        """ All new channels are subscribed with one SUBSCRIBE command """
+        new_chat_uuids = []
+        self.ws_to_chats.setdefault(ws, set()).update(chat_uuids)
+        for chat_uuid in chat_uuids:
+            if chat_uuid in self.chats: # a.k.a. already subscribed
+                self.chats[chat_uuid].add(ws)
+            else:
+                self.chats[chat_uuid] = {ws}
+                new_chat_uuids.append(chat_uuid)
+        
+        if new_chat_uuids:
+            await self.pubsub.subscribe(new_chat_uuids, self._on_pubsub_message)
     
     def remove_user(self, user_uuid: UUID, ws: WebSocket):
         if user_uuid in self.user_uuid_to_ws:
@@ -45,25 +71,55 @@ class ConnectionManager:
                 self.user_uuid_to_ws.pop(user_uuid)
     
     async def remove_user_from_chat(self, chat_uuid: UUID, ws: WebSocket):
-        if chat_uuid in self.chats:
-            self.chats[chat_uuid].discard(ws) # remove if exists, else NO error
+        await self.remove_user_from_chats([chat_uuid], ws)
+    
+    async def remove_user_from_chats(self, chat_uuids: list[UUID], ws: WebSocket):
+        """ Channels without sockets left are unsubscribed with one command """
+        empty_chat_uuids = []
+        self.ws_to_chats.get(ws, set()).difference_update(chat_uuids)
+        for chat_uuid in chat_uuids:
+            if chat_uuid in self.chats:
+                self.chats[chat_uuid].discard(ws) # remove if exists, else NO error
 
-            if len(self.chats[chat_uuid]) == 0:
-                self.chats.pop(chat_uuid)
-                await self.pubsub.unsubscribe(chat_uuid)
+                if len(self.chats[chat_uuid]) == 0:
+                    self.chats.pop(chat_uuid)
+                    empty_chat_uuids.append(chat_uuid)
+        
+        if empty_chat_uuids:
+            await self.pubsub.unsubscribe(empty_chat_uuids)
 
     async def _on_pubsub_message(self, message):
         chat_uuid = UUID(message["channel"])
         data = message["data"]
 
-        sockets = self.chats.get(chat_uuid, set())
-        for ws in sockets:
-            await ws.send_text(data)
+        # only enqueues, a slow socket can not stall the reader
+        for ws in self.chats.get(chat_uuid, set()):
+            self.send_to_socket(ws, data)
+
+    def send_to_socket(self, ws: WebSocket, data: str) -> bool:
+        writer = self.writers.get(ws)
+        return writer.send(data) if writer else False
 
     async def send_error(self, message: str, websocket: WebSocket):
-        await websocket.send_json({"status": "error", "message": message})
+        self.send_to_socket(websocket, json.dumps({"status": "error", "message": message}))
+
+    def stats(self) -> dict:
+        queued = [w.queue.qsize() for w in self.writers.values()]
+        return {
+            "sockets": len(self.writers),
+            "chats": len(self.chats),
+            "queued_messages": sum(queued),
+            "max_socket_queue": max(queued, default=0),
+            "closed_sockets": sum(w.closed for w in self.writers.values()),
+            "pubsub": self.pubsub.stats(),
+        }
     
-    async def broadcast_to_chat(self, chat_uuid: UUID, message: str | dict) -> None:
+    async def broadcast_to_chat(
+        self,
+        chat_uuid: UUID,
+        message: str | dict,
+        pipe: Pipeline | None = None
+    ) -> None:
         if isinstance(message, dict):
             message = json.dumps(message)
-        await self.pubsub.publish(chat_uuid, message)
\ No newline at end of file
+        await self.pubsub.publish(chat_uuid, message, pipe)
\ No newline at end of file
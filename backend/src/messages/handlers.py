@@ -3,19 +3,18 @@ import logging
 from fastapi import WebSocket
 from sqlalchemy.ext.asyncio import AsyncSession
 from redis.asyncio import Redis
-from elasticsearch import AsyncElasticsearch
 
-from src.settings import REDIS_MESSAGES_KEY, REDIS_FOLDERS_KEY
-from src.utils import invalidate_cache
+from src.settings import REDIS_FOLDERS_KEY
+from src.cache import patch_hash_cache
 from src.auth.models import UserModel
-from src.chats.services import get_chat_or_none
-from src.chats.utils import is_user_in_chat
+from src.chats.services import get_slim_chat_or_none, is_chat_member
+from src.folders.utils import remove_chat_from_cached_folder
 from src.messages.connection_manager import ConnectionManager
-from src.messages.schemas import ReceiveMessageSchema, SendMessageSchema, \
-    ChatActionSchema, ChatActionSchema
+from src.messages.schemas import ReceiveMessageSchema, ChatActionSchema
 from src.messages.services import create_message_in_db, add_chat_to_new_folder_for_all, \
-    mark_chat_read, remove_chat_from_new_folder
-from src.messages.utils import add_message_to_elastic, delete_cache_for_users
+    mark_chat_read, remove_chat_from_new_folder, get_members_new_folders
+from src.messages.utils import sync_message_to_elastic, patch_caches_for_new_message, \
+    new_message_to_schema, append_message_to_cache
 
 logger = logging.getLogger(__name__)
 connection_manager = ConnectionManager()
@@ -24,18 +23,18 @@ connection_manager = ConnectionManager()
 async def new_message_handler(
     db: AsyncSession,
     r: Redis,
-    es: AsyncElasticsearch,
     ws: WebSocket,
     current_user: UserModel,
     incomming_message: dict,
     **kwargs,
 ):
     message_schema = ReceiveMessageSchema(**incomming_message)
-    chat = await get_chat_or_none(db, message_schema.chat_uuid)
+    chat = await get_slim_chat_or_none(db, message_schema.chat_uuid)
     if not chat:
         await connection_manager.send_error("Chat not found", ws)
         return
     
+    # one transaction: the message, the NEW folders of the other members and the outbox
     message = await create_message_in_db(
         db, current_user, chat, message_schema.content
     )
@@ -43,22 +42,22 @@ async def new_message_handler(
         await connection_manager.send_error("Message not created", ws)
         return
     
-    await invalidate_cache(r, REDIS_MESSAGES_KEY, chat.uuid)
-    await add_message_to_elastic(
-        es, message.uuid, current_user.uuid, chat.uuid, message.content
-    )
+    await add_chat_to_new_folder_for_all(db, current_user, chat)
+    sync_message_to_elastic(db, message)
+    members_new_folders = await get_members_new_folders(db, chat)
+    await db.commit()
 
-    await add_chat_to_new_folder_for_all(db, current_user, chat) 
-    await delete_cache_for_users(r, chat, current_user)
+    send_message_schema = new_message_to_schema(message, current_user, chat)
+    cached_message: dict = send_message_schema.model_dump(mode="json")
+    outgoing_message = {**cached_message, "type": "new_message"}
 
-    send_message_schema = SendMessageSchema(
-        uuid=message.uuid, user_uuid=current_user.uuid,
-        chat_uuid=chat.uuid, content=message.content,
-        created_at=message.created_at, updated_at=message.updated_at
-    )
-    outgoing_message: dict = send_message_schema.model_dump(mode="json")
-    outgoing_message["type"] = "new_message"
-    await connection_manager.broadcast_to_chat(chat.uuid, outgoing_message)
+    # cache append, cache patches and publish in one round trip
+    async with r.pipeline(transaction=True) as pipe:
+        append_message_to_cache(pipe, chat.uuid, message.id, cached_message)
+        # the chat and folder lists of the members are patched, not rebuilt
+        patch_caches_for_new_message(pipe, cached_message, members_new_folders, current_user)
+        await connection_manager.broadcast_to_chat(chat.uuid, outgoing_message, pipe)
+        await pipe.execute()
 
     logger.info(f"Message was sent ({message.uuid})")
 
@@ -74,15 +73,19 @@ async def read_message_handler(
     message_read_schema = ChatActionSchema(**incomming_message)
 
     # checks if chat exists
-    chat = await get_chat_or_none(db, message_read_schema.chat_uuid)
-    if not chat:
+    chat = await get_slim_chat_or_none(db, message_read_schema.chat_uuid)
+    if not chat or not await is_chat_member(db, current_user, chat):
         await connection_manager.send_error("Chat not found", ws)
         return
 
     await mark_chat_read(db, current_user, chat)
 
-    await remove_chat_from_new_folder(db, current_user, chat)
-    await invalidate_cache(r, REDIS_FOLDERS_KEY, current_user.uuid)
+    new_folder_uuid = await remove_chat_from_new_folder(db, current_user, chat)
+    if new_folder_uuid is not None:
+        await patch_hash_cache(r, [(
+            REDIS_FOLDERS_KEY.format(current_user.uuid), str(new_folder_uuid),
+            remove_chat_from_cached_folder(chat.uuid)
+        )])
 
     outgoing_message: dict = message_read_schema.model_dump(mode="json")
     outgoing_message["user_uuid"] = str(current_user.uuid)
@@ -101,12 +104,12 @@ async def join_chat_handler(
     """ Updates websockets connected to chat. E.g. user joins a new chat. """
     join_chat_schema = ChatActionSchema(**incomming_message)
     
-    chat = await get_chat_or_none(db, join_chat_schema.chat_uuid)
+    chat = await get_slim_chat_or_none(db, join_chat_schema.chat_uuid)
     if not chat:
         await connection_manager.send_error("Chat not found", ws)
         return
     
-    if not is_user_in_chat(current_user, chat):
+    if not await is_chat_member(db, current_user, chat):
         await connection_manager.send_error("Chat not found", ws)
         return
     
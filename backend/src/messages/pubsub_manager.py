@@ -1,7 +1,11 @@
 from uuid import UUID
 import asyncio
 import logging
+import time
 
+from redis.asyncio.client import Pipeline
+
+from src.settings import PUBSUB_RECONNECT_MIN_DELAY, PUBSUB_RECONNECT_MAX_DELAY
 from src.database import redis_client
 
 logger = logging.getLogger(__name__)
@@ -11,31 +15,118 @@ class PubSubManager:
         self.redis = redis_client
         self.pubsub = redis_client.pubsub()
         self.reader_task: asyncio.Task | None = None
+
+        # metrics
+        self.received = 0
+        self.reconnects = 0
+        self.last_lag = 0.0 # seconds between publish and receive
+        self.max_lag = 0.0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self.messages_per_second = 0.0
     
     async def _reader_loop(self, on_message):
+        delay = PUBSUB_RECONNECT_MIN_DELAY
+
+        while True:
+            try:
+                # blocks until a message arrives, an idle worker does not spin
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=None
+                )
+                delay = PUBSUB_RECONNECT_MIN_DELAY
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # a lost connection, but also e.g. a ResponseError, the reader must not end
+                logger.warning(f"Pubsub reader failed, reconnecting in {delay}s: {e!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, PUBSUB_RECONNECT_MAX_DELAY)
+                await self._reconnect()
+                continue
+            
+            if not message:
+                continue
+
+            try:
+                message["data"] = self._unwrap(message["data"])
+                await on_message(message)
+            except Exception as e:
+                logger.exception(f"Exception occurred: {e}")
+
+    async def _reconnect(self):
+        """ Resubscribes to every channel, redis-py does it in the connect callback """
+        try:
+            if self.pubsub.connection is not None:
+                await self.pubsub.connection.disconnect()
+            await self.pubsub.connect()
+            self.reconnects += 1
+            logger.info(f"Pubsub reconnected, {len(self.pubsub.channels)} channels resubscribed")
+        except Exception as e: # the reader retries with the next delay
+            logger.warning(f"Pubsub reconnect failed: {e}")
+
+    def _unwrap(self, data: str) -> str:
+        """ Strips the publish timestamp and records the lag """
+        published_at, _, msg = data.partition("|")
+        now = time.time()
+
         try:
-            while True:
-                message = await self.pubsub.get_message(ignore_subscribe_messages=True)
-                if message:
-                    await on_message(message)
-        except Exception as e:
-            logger.exception(f"Exception occurred: {e}")
+            self.last_lag = max(now - float(published_at), 0.0)
+            self.max_lag = max(self.max_lag, self.last_lag)
+        except ValueError:
+            msg = data # published without a timestamp
+
+        self.received += 1
+        self._window_count += 1
+
+        elapsed = time.monotonic() - self._window_start
+        if elapsed >= 1:
+            self.messages_per_second = self._window_count / elapsed
+            self._window_start = time.monotonic()
+            self._window_count = 0
+        
+        return msg
+
+    def stats(self) -> dict:
+        # the rate is only refreshed by incoming messages
+        idle = time.monotonic() - self._window_start > 2
+        return {
+            "subscribed_channels": len(self.pubsub.channels),
+            "received": self.received,
+            "messages_per_second": 0.0 if idle else round(self.messages_per_second, 2),
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "reconnects": self.reconnects,
+        }
     
     async def close(self):
         if self.reader_task:
             self.reader_task.cancel()
-        await self.pubsub.close()
+        await self.pubsub.aclose()
 
-    async def subscribe(self, chat_uuid: UUID, on_message):
-        await self.pubsub.subscribe(str(chat_uuid))
+    async def subscribe(self, chat_uuids: list[UUID], on_message):
+        await self.pubsub.subscribe(*[str(chat_uuid) for chat_uuid in chat_uuids])
 
         if self.reader_task is None:
             self.reader_task = asyncio.create_task(
                 self._reader_loop(on_message)
             )
+            self.reader_task.add_done_callback(self._on_reader_done)
+
+    def _on_reader_done(self, task: asyncio.Task):
+        """ Should never happen, the next subscribe starts a new reader """
+        if self.reader_task is task:
+            self.reader_task = None
+        if not task.cancelled() and task.exception():
+            logger.error("Pubsub reader ended", exc_info=task.exception())
 
-    async def unsubscribe(self, chat_uuid: UUID):
-        await self.pubsub.unsubscribe(str(chat_uuid))
+    async def unsubscribe(self, chat_uuids: list[UUID]):
+        await self.pubsub.unsubscribe(*[str(chat_uuid) for chat_uuid in chat_uuids])
     
-    async def publish(self, chat_uuid: UUID, msg: str):
+    async def publish(self, chat_uuid: UUID, msg: str, pipe: Pipeline | None = None):
+        """ With 'pipe' the publish is only queued, the caller executes it """
+        msg = f"{time.time()}|{msg}" # lets the readers measure the lag
+        if pipe is not None:
+            pipe.publish(str(chat_uuid), msg)
+            return
         await self.redis.publish(str(chat_uuid), msg)
@@ -5,18 +5,20 @@ from uuid import UUID
 
 from sqlalchemy.ext.asyncio import AsyncSession
 from redis.asyncio import Redis
-from elasticsearch import AsyncElasticsearch
-from fastapi import APIRouter, WebSocket, Depends, WebSocketDisconnect, Query, status
+from fastapi import APIRouter, WebSocket, Depends, WebSocketDisconnect, Query, status, \
+    HTTPException
 
-from src.settings import REDIS_MESSAGES_KEY, REDIS_CACHE_EXPIRE_SECONDS
-from src.database import get_db, get_redis, get_es
-from src.utils import wrap_list_response
+from src.settings import MESSAGES_PAGE_SIZE, MESSAGES_MAX_PAGE_SIZE, REDIS_MESSAGES_CACHE_SIZE, REDIS_MESSAGES_KEY
+from src.database import get_db, get_redis, async_session
+from src.utils import wrap_page_response, wrap_list_response
+from src.cache import read_through
 from src.dependencies import get_active_current_user, get_active_user_from_token
 from src.auth.models import UserModel
-from src.chats.services import get_all_chats_with_last_message, get_chat_or_404
+from src.chats.services import get_user_chat_uuids, get_slim_chat_or_404, ensure_chat_member_or_403
 from src.messages.handlers import connection_manager
-from src.messages.services import get_all_messages
-from src.messages.utils import message_model_to_schema
+from src.messages.services import get_messages_page, get_read_statuses, get_unread_counts
+from src.messages.schemas import ReadStatusSchema, UnreadCountSchema
+from src.messages.utils import message_model_to_schema, get_cached_messages, cache_messages
 
 logger = logging.getLogger(__name__)
 
@@ -24,17 +26,19 @@ router = APIRouter()
 
 @router.websocket("/ws")
 async def websocket_endpoint(
-    db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
-    es: Annotated[AsyncElasticsearch, Depends(get_es)],
     ws: WebSocket,
     token: str = Query(...)
 ):
-    try:
-        current_user = await get_active_user_from_token(db, token)
-    except:
-        await ws.close(code=status.WS_1008_POLICY_VIOLATION)
-        return
+    # no session is held while the socket is idle, every event opens its own
+    async with async_session() as db:
+        try:
+            current_user = await get_active_user_from_token(db, token)
+        except:
+            await ws.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+
+        chat_uuids = await get_user_chat_uuids(db, r, current_user)
     
     # accept websocket
     await connection_manager.connect_socket(ws)
@@ -44,9 +48,7 @@ async def websocket_endpoint(
     await connection_manager.add_user_socket_connection(current_user.uuid, ws)
 
     # add to chats
-    chats = await get_all_chats_with_last_message(db, current_user)
-    for chat, _ in chats:
-        await connection_manager.add_user_to_chat(chat.uuid, ws)
+    await connection_manager.add_user_to_chats(chat_uuids, ws)
 
     try:
         while True:
@@ -63,11 +65,13 @@ async def websocket_endpoint(
                     await connection_manager.send_error(f"Type: {message_type} was not found", ws)
                     continue
 
-                await handler(
-                    db=db, r=r, es=es, ws=ws,
-                    current_user=current_user,
-                    incomming_message=incoming_message
-                )
+                # current_user is detached, handlers only read its columns
+                async with async_session() as db:
+                    await handler(
+                        db=db, r=r, ws=ws,
+                        current_user=current_user,
+                        incomming_message=incoming_message
+                    )
 
             except (json.JSONDecodeError, AttributeError) as excinfo:
                 logger.exception(f"Websocket error, detail: {excinfo}")
@@ -78,36 +82,90 @@ async def websocket_endpoint(
 
     except WebSocketDisconnect:
         logger.info(f"{current_user.uuid} websocket disconnected")
-        
-        # remove from chats
-        for chat, _ in chats:
-            await connection_manager.remove_user_from_chat(chat.uuid, ws)
+    finally:
+        # stops the writer and removes the socket from all its chats
+        await connection_manager.disconnect_socket(ws)
         
         # remove from connection manager
         connection_manager.remove_user(current_user.uuid, ws)
 
-# no lazy loading
+# must be declared before /messages/{chat_uuid}
+@router.get('/messages/unread')
+async def get_unread_counts_of_chats(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    current_user: Annotated[UserModel, Depends(get_active_current_user)],
+):
+    """ Unread messages per chat, derived from the read watermarks """
+    rows = await get_unread_counts(db, current_user)
+    counts = [
+        UnreadCountSchema(chat_uuid=chat_uuid, unread_count=count).model_dump(mode='json')
+        for chat_uuid, count in rows
+    ]
+    return wrap_list_response(counts)
+
+@router.get('/messages/{chat_uuid}/read_statuses')
+async def get_chat_read_statuses(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    current_user: Annotated[UserModel, Depends(get_active_current_user)],
+    chat_uuid: UUID
+):
+    """ Read receipts: a message is read by a member if it is not newer than his watermark """
+    chat = await get_slim_chat_or_404(db, chat_uuid)
+    rows = await get_read_statuses(db, current_user, chat)
+    read_statuses = [
+        ReadStatusSchema(
+            user_uuid=user_uuid,
+            last_read_message_uuid=message_uuid,
+            updated_at=last_read_at
+        ).model_dump(mode='json')
+        for user_uuid, message_uuid, last_read_at in rows
+    ]
+    return wrap_list_response(read_statuses)
+
+# keyset pagination: before / after are message uuids
 @router.get('/messages/{chat_uuid}')
-async def get_all_chat_messages(
+async def get_chat_messages(
     db: Annotated[AsyncSession, Depends(get_db)],
     r: Annotated[Redis, Depends(get_redis)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
-    chat_uuid: UUID
-): 
-    redis_key = REDIS_MESSAGES_KEY.format(chat_uuid)
-    if data := await r.get(redis_key):
-        return json.loads(data)
-    
-    chat = await get_chat_or_404(db, chat_uuid)
-    messages = await get_all_messages(db, current_user, chat)
-    message_schemas = [message_model_to_schema(m) for m in messages]
-    messages = [m.model_dump() for m in message_schemas]
-    data = wrap_list_response(messages)
-
-    await r.set(
-        redis_key,
-        json.dumps(data, default=str),
-        REDIS_CACHE_EXPIRE_SECONDS
-    )
+    chat_uuid: UUID,
+    before: UUID | None = None,
+    after: UUID | None = None,
+    limit: int = Query(MESSAGES_PAGE_SIZE, ge=1, le=MESSAGES_MAX_PAGE_SIZE),
+):
+    if before is not None and after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either 'before' or 'after'"
+        )
+
+    # membership first, the cache is per chat, not per user
+    chat = await get_slim_chat_or_404(db, chat_uuid)
+    await ensure_chat_member_or_403(db, current_user, chat)
 
-    return data
\ No newline at end of file
+    # the newest messages are served from the per chat cache
+    is_newest_page = before is None and after is None
+
+    if is_newest_page:
+        async def read():
+            cached = await get_cached_messages(r, chat_uuid, limit)
+            return (cached, True) if cached is not None else None # new messages are added, it never goes stale
+
+        async def rebuild():
+            # fills the whole cache at once, later pages come from the db on demand
+            message_models, has_more = await get_messages_page(
+                db, current_user, chat, limit=REDIS_MESSAGES_CACHE_SIZE
+            )
+            messages = [message_model_to_schema(m).model_dump(mode='json') for m in message_models]
+            await cache_messages(r, chat_uuid, list(zip([m.id for m in message_models], messages)))
+            return messages[-limit:], has_more or len(messages) > limit
+
+        # one request per chat fills a cold cache, the others wait for it
+        messages, has_more = await read_through(r, REDIS_MESSAGES_KEY.format(chat_uuid), read, rebuild)
+        return wrap_page_response(messages, has_more)
+
+    message_models, has_more = await get_messages_page(
+        db, current_user, chat, before=before, after=after, limit=limit
+    )
+    messages = [message_model_to_schema(m).model_dump(mode='json') for m in message_models]
+    return wrap_page_response(messages, has_more)
@@ -22,9 +22,11 @@ class ChatActionSchema(BaseModel):
     chat_uuid: UUID
 
 class ReadStatusSchema(BaseModel):
-    updated_at: datetime
-    is_read: bool
+    """ Read watermark of a chat member, a message is read if it is not newer """
     user_uuid: UUID
+    last_read_message_uuid: UUID | None = Field(default=None) # None = nothing read yet
+    updated_at: datetime | None = Field(default=None) # when the chat was read last time
 
-class MessageSchema(SendMessageSchema):
-    read_statuses: list[ReadStatusSchema]
\ No newline at end of file
+class UnreadCountSchema(BaseModel):
+    chat_uuid: UUID
+    unread_count: int
@@ -1,17 +1,18 @@
+from datetime import datetime
 from uuid import UUID
 
+from fastapi import HTTPException, status
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, insert, exists, and_, delete, update
-from sqlalchemy.orm import selectinload
+from sqlalchemy import select, insert, exists, and_, or_, delete, update, tuple_, func
+from sqlalchemy.orm import selectinload, aliased
 
-from src.utils import get_all_objects
+from src.settings import MESSAGES_PAGE_SIZE
 from src.auth.models import UserModel
 from src.chats.models import ChatModel, UserChatAssociationModel
-from src.chats.utils import is_user_in_chat, ensure_user_in_chat_or_403
+from src.chats.services import is_chat_member, ensure_chat_member_or_403, newest_message_id_subquery
 from src.folders.models import FolderChatAssociationModel, FolderModel
 from src.folders.enums import FolderType
-from src.messages.models import MessageModel, ReadStatusModel
-from src.messages.utils import create_read_statuses_for_all_chat_users
+from src.messages.models import MessageModel
 
 async def get_message_or_none(
     db: AsyncSession,
@@ -20,44 +21,131 @@ async def get_message_or_none(
     result = await db.execute(
         select(MessageModel)
         .where(MessageModel.uuid == message_uuid)
-        .options(selectinload(MessageModel.read_statuses))
     )
     return result.scalar_one_or_none()
 
-async def get_all_messages(
+async def get_message_position_or_404(
+    db: AsyncSession,
+    chat: ChatModel,
+    message_uuid: UUID,
+) -> tuple[datetime, int]:
+    """ Returns (created_at, id) of the message, used as a keyset cursor """
+    result = await db.execute(
+        select(MessageModel.created_at, MessageModel.id)
+        .where(
+            MessageModel.uuid == message_uuid,
+            MessageModel.chat_id == chat.id
+        )
+    )
+    row = result.one_or_none()
+
+    if row is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Message not found')
+
+    return row.created_at, row.id
+
+async def get_messages_page(
     db: AsyncSession,
     user: UserModel,
-    chat: ChatModel
-) -> list[MessageModel]:
-    
-    ensure_user_in_chat_or_403(user, chat)
-    
-    messages = await get_all_objects(
-        db, MessageModel,
-        MessageModel.chat_id == chat.id,
-        options=[
-            selectinload(MessageModel.read_statuses)
-            .selectinload(ReadStatusModel.user)
-        ]
+    chat: ChatModel,
+    *,
+    before: UUID | None = None,
+    after: UUID | None = None,
+    limit: int = MESSAGES_PAGE_SIZE,
+) -> tuple[list[MessageModel], bool]:
+    """
+    Returns up to 'limit' messages in chronological order and whether
+    there are more messages in the requested direction.
+    'before' / 'after' are message uuids, without them the newest page is returned.
+    Ordered by (created_at, id), so it uses ix_messages_chat_id_created_at_id.
+    """
+
+    await ensure_chat_member_or_403(db, user, chat)
+
+    position = tuple_(MessageModel.created_at, MessageModel.id)
+    stmt = (
+        select(MessageModel)
+        .where(MessageModel.chat_id == chat.id)
+        .options(selectinload(MessageModel.user))
     )
 
-    return messages
+    if after is not None:
+        cursor = await get_message_position_or_404(db, chat, after)
+        stmt = (
+            stmt.where(position > tuple_(*cursor))
+            .order_by(MessageModel.created_at, MessageModel.id)
+        )
+    else:
+        if before is not None:
+            cursor = await get_message_position_or_404(db, chat, before)
+            stmt = stmt.where(position < tuple_(*cursor))
+        stmt = stmt.order_by(MessageModel.created_at.desc(), MessageModel.id.desc())
+
+    result = await db.execute(stmt.limit(limit + 1)) # +1 to know if there is more
+    messages = list(result.scalars().all())
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if after is None:
+        messages.reverse() # newest first -> chronological
+
+    return messages, has_more
+
+async def get_read_statuses(
+    db: AsyncSession,
+    user: UserModel,
+    chat: ChatModel
+) -> list[tuple[UUID, UUID | None, datetime | None]]:
+    """ Returns (user_uuid, last_read_message_uuid, last_read_at) for every chat member """
+
+    await ensure_chat_member_or_403(db, user, chat)
+
+    result = await db.execute(
+        select(
+            UserModel.uuid,
+            MessageModel.uuid,
+            UserChatAssociationModel.last_read_at
+        )
+        .join(UserChatAssociationModel, UserChatAssociationModel.user_id == UserModel.id)
+        .outerjoin(
+            MessageModel,
+            MessageModel.id == UserChatAssociationModel.last_read_message_id
+        )
+        .where(UserChatAssociationModel.chat_id == chat.id)
+    )
+    return result.all()
 
-async def get_read_status_or_none(
+async def get_unread_counts(
     db: AsyncSession,
-    user_uuid: UUID,
-    message_uuid: UUID
-) -> ReadStatusModel | None:
+    user: UserModel
+) -> list[tuple[UUID, int]]:
+    """
+    Returns (chat_uuid, unread_count) for every chat with unread messages.
+    Messages after the watermark in the (created_at, id) order of mark_chat_read.
+    """
+    ChatAssoc = UserChatAssociationModel
+    Watermark = aliased(MessageModel)
     result = await db.execute(
-        select(ReadStatusModel)
-        .join(ReadStatusModel.message)
-        .join(ReadStatusModel.user)
+        select(ChatModel.uuid, func.count(MessageModel.id))
+        .join(ChatAssoc, ChatAssoc.chat_id == ChatModel.id)
+        .join(MessageModel, MessageModel.chat_id == ChatModel.id)
+        .outerjoin(Watermark, Watermark.id == ChatAssoc.last_read_message_id)
         .where(
-            UserModel.uuid == user_uuid,
-            MessageModel.uuid == message_uuid
+            ChatAssoc.user_id == user.id,
+            MessageModel.user_id != user.id,
+            or_(
+                and_(
+                    Watermark.id.is_not(None),
+                    tuple_(MessageModel.created_at, MessageModel.id) > tuple_(Watermark.created_at, Watermark.id)
+                ),
+                # the watermark message was deleted (or the chat was empty), read up to last_read_at
+                and_(Watermark.id.is_(None), MessageModel.created_at > ChatAssoc.last_read_at),
+                ChatAssoc.last_read_at.is_(None), # never read
+            )
         )
+        .group_by(ChatModel.uuid)
     )
-    return result.scalar_one_or_none()
+    return result.all()
 
 async def create_message_in_db(
     db: AsyncSession,
@@ -66,11 +154,11 @@ async def create_message_in_db(
     content: str
 ) -> MessageModel | None:
     """
-    Creates message in DB and read statuses for all chat users.
-    Returns MessageModel or None if user not in chat.
+    Creates message in DB and moves the last message pointer of the chat,
+    nothing is written per chat member. Only flushes, the caller commits. Returns MessageModel or None if user not in chat.
     """
     
-    if not is_user_in_chat(user, chat):
+    if not await is_chat_member(db, user, chat):
         return None
     
     message = MessageModel(
@@ -80,17 +168,21 @@ async def create_message_in_db(
     )
 
     db.add(message)
-    await db.flush()  # to get message.id
+    await db.flush()
 
-    statuses = create_read_statuses_for_all_chat_users(
-        sender_user=user,
-        chat=chat,
-        message=message,
+    # only moves forward in (created_at, id) order, if concurrent messages commit out of order
+    await db.execute(
+        update(ChatModel)
+        .where(
+            ChatModel.id == chat.id,
+            or_(
+                ChatModel.last_message_id.is_(None),
+                tuple_(ChatModel.last_message_at, ChatModel.last_message_id) < tuple_(message.created_at, message.id)
+            )
+        )
+        .values(last_message_id=message.id, last_message_at=message.created_at)
+        .execution_options(synchronize_session=False)
     )
-    db.add_all(statuses)
-
-    await db.commit()
-    await db.refresh(message)
     return message
     
 async def add_chat_to_new_folder_for_all(
@@ -99,7 +191,7 @@ async def add_chat_to_new_folder_for_all(
     chat: ChatModel,
 ) -> None:
     """
-    Add chat to NEW folder for all chat users except sender
+    Add chat to NEW folder for all chat users except sender. The caller commits.
     """
 
     subq = (
@@ -129,47 +221,64 @@ async def add_chat_to_new_folder_for_all(
     )
 
     await db.execute(stmt)
-    await db.commit()
+
+async def get_members_new_folders(
+    db: AsyncSession,
+    chat: ChatModel
+) -> list[tuple[UUID, UUID | None]]:
+    """ (user_uuid, uuid of his NEW folder) for every chat member """
+    result = await db.execute(
+        select(UserModel.uuid, FolderModel.uuid)
+        .join(UserChatAssociationModel, UserChatAssociationModel.user_id == UserModel.id)
+        .outerjoin(
+            FolderModel,
+            and_(FolderModel.user_id == UserModel.id, FolderModel.folder_type == FolderType.NEW)
+        )
+        .where(UserChatAssociationModel.chat_id == chat.id)
+    )
+    return result.all()
 
 async def remove_chat_from_new_folder(
     db: AsyncSession,
     user: UserModel,
     chat: ChatModel,
-) -> None:
-    """Remove chat from user's NEW folder"""
+) -> UUID | None:
+    """Remove chat from user's NEW folder, returns the folder uuid"""
+
+    folder = (await db.execute(
+        select(FolderModel.id, FolderModel.uuid).where(
+            FolderModel.user_id == user.id,
+            FolderModel.folder_type == FolderType.NEW,
+        )
+    )).one_or_none()
+    if folder is None:
+        return None
 
     stmt = delete(FolderChatAssociationModel).where(
         FolderChatAssociationModel.chat_id == chat.id,
-        FolderChatAssociationModel.folder_id.in_(
-            select(FolderModel.id).where(
-                FolderModel.user_id == user.id,
-                FolderModel.folder_type == FolderType.NEW,
-            )
-        )
+        FolderChatAssociationModel.folder_id == folder.id
     )
 
     await db.execute(stmt)
     await db.commit()
+    return folder.uuid
 
 async def mark_chat_read(
     db: AsyncSession,
     user: UserModel,
     chat: ChatModel,
 ) -> None:
+    """ Moves the read watermark of the user to the newest message of the chat """
     await db.execute(
-        update(ReadStatusModel)
+        update(UserChatAssociationModel)
         .where(
-            ReadStatusModel.user_id == user.id,
-            ReadStatusModel.is_read == False,
-            ReadStatusModel.message_id.in_(
-                select(MessageModel.id)
-                .where(MessageModel.chat_id == chat.id)
-            )
+            UserChatAssociationModel.user_id == user.id,
+            UserChatAssociationModel.chat_id == chat.id,
         )
         .values(
-            is_read=True
+            last_read_message_id=newest_message_id_subquery(chat.id),
+            last_read_at=func.now()
         )
         .execution_options(synchronize_session=False)
     )
     await db.commit()
-    
\ No newline at end of file
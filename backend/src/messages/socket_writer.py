@@ -0,0 +1,68 @@
+import asyncio
+import logging
+
+from fastapi import WebSocket, status
+
+from src.settings import WS_SEND_QUEUE_SIZE, WS_SEND_TIMEOUT
+from src.utils import run_in_background
+
+logger = logging.getLogger(__name__)
+
+class SocketWriter:
+    """ Bounded outgoing queue of one websocket, drained by its own task """
+
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.sent = 0
+        self.closed = False
+        self.task = asyncio.create_task(self._writer_loop())
+
+    def send(self, data: str) -> bool:
+        """ Never waits for the client, a full queue disconnects it """
+        if self.closed:
+            return False
+
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Websocket send queue is full, disconnecting slow consumer")
+            self._close_in_background()
+            return False
+
+    async def _writer_loop(self):
+        try:
+            while True:
+                data = await self.queue.get()
+                await asyncio.wait_for(self.ws.send_text(data), WS_SEND_TIMEOUT)
+                self.sent += 1
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning("Websocket send timed out, disconnecting slow consumer")
+            await self._close_socket()
+        except Exception as e:
+            # socket is already gone, the receive loop cleans up
+            logger.info(f"Websocket writer stopped: {e}")
+            self.closed = True
+    
+    def _close_in_background(self):
+        self.closed = True
+        self.task.cancel()
+        run_in_background(self._close_socket(), name="Closing slow websocket")
+
+    async def _close_socket(self):
+        self.closed = True
+        try:
+            await self.ws.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        except Exception:
+            pass # already closed
+
+    async def stop(self):
+        self.closed = True
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, Exception):
+            pass
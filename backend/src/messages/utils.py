@@ -1,89 +1,133 @@
+from datetime import datetime
 from uuid import UUID
+import json
 
-from elasticsearch import AsyncElasticsearch
 from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.settings import ELASTIC_MESSAGES_INDEX_NAME, REDIS_FOLDERS_KEY
-from src.messages.models import MessageModel, ReadStatusModel
-from src.messages.schemas import MessageSchema, ReadStatusSchema
+from src.settings import ELASTIC_MESSAGES_INDEX_NAME, REDIS_FOLDERS_KEY, REDIS_MESSAGES_KEY, \
+    REDIS_MESSAGES_CACHE_SIZE, REDIS_CHATS_KEY
+from src.cache import queue_hash_cache_patch, set_fields, jittered_ttl
+from src.search.utils import add_to_elastic_outbox
+from src.folders.utils import add_chat_to_cached_folder
+from src.messages.models import MessageModel
+from src.messages.schemas import SendMessageSchema
 from src.chats.models import ChatModel
 from src.auth.models import UserModel
 
-def read_status_model_to_schema(read_status: ReadStatusModel) -> ReadStatusSchema:
-    return ReadStatusSchema(
-        updated_at=read_status.updated_at,
-        is_read=read_status.is_read,
-        user_uuid=read_status.user.uuid
-    )
-
-def message_model_to_schema(message: MessageModel) -> MessageSchema:
-    read_statuses = [read_status_model_to_schema(r) for r in message.read_statuses]
-
-    return MessageSchema(
+def message_model_to_schema(message: MessageModel) -> SendMessageSchema:
+    return SendMessageSchema(
         uuid=message.uuid,
         created_at=message.created_at,
         updated_at=message.updated_at,
         user_uuid=message.user.uuid,
         chat_uuid=message.chat.uuid,
         content=message.content,
-        read_statuses=read_statuses
     )
 
-def create_read_statuses_for_all_chat_users(
-    sender_user: UserModel,
-    chat: ChatModel,
+def new_message_to_schema(
     message: MessageModel,
-) -> list[ReadStatusModel]:
+    sender_user: UserModel,
+    chat: ChatModel
+) -> SendMessageSchema:
+    """ Same as message_model_to_schema, but without loading relationships """
+    return SendMessageSchema(
+        uuid=message.uuid,
+        created_at=message.created_at,
+        updated_at=message.updated_at,
+        user_uuid=sender_user.uuid,
+        chat_uuid=chat.uuid,
+        content=message.content,
+    )
+
+def sync_message_to_elastic(db: AsyncSession, message: MessageModel) -> None:
+    """ The message must be flushed, so it has an uuid """
+    add_to_elastic_outbox(db, ELASTIC_MESSAGES_INDEX_NAME, message.uuid)
+
+def message_to_elastic_doc(message: MessageModel) -> dict:
+    """ user and chat must be loaded """
+    return {
+        "user": str(message.user.uuid),
+        "chat": str(message.chat.uuid),
+        "content": message.content,
+        "created_at": message.created_at.isoformat(),
+    }
+
+def patch_caches_for_new_message(
+    pipe: Pipeline,
+    message: dict,
+    members_new_folders: list[tuple[UUID, UUID | None]],
+    sender_user: UserModel
+) -> None:
     """
-    Creates ReadStatus rows for every user in chat except sender.
+    Queues the patches on 'pipe'. 'message' is a SendMessageSchema dump. The chat gets
+    the last message in the chat lists of all members and joins the NEW folders of the others.
     """
+    chat_uuid = message['chat_uuid']
+    last_message = set_fields(last_message=message['content'], last_message_at=message['created_at'])
 
-    statuses: list[ReadStatusModel] = []
+    # a chat that was not on the cached first page moves onto it, that page is rebuilt
+    queue_hash_cache_patch(
+        pipe, [(REDIS_CHATS_KEY.format(user_uuid), chat_uuid, last_message) for user_uuid, _ in members_new_folders],
+        drop_missing=True
+    )
+    queue_hash_cache_patch(pipe, [
+        (REDIS_FOLDERS_KEY.format(user_uuid), str(folder_uuid), add_chat_to_cached_folder(chat_uuid))
+        for user_uuid, folder_uuid in members_new_folders
+        if folder_uuid is not None and user_uuid != sender_user.uuid
+    ])
 
-    for assoc in chat.user_associations:
-        user = assoc.user
+# The messages cache is a sorted set per chat with the newest REDIS_MESSAGES_CACHE_SIZE
+# messages, in the keyset order of the db: scored by created_at, equal scores are
+# ordered by the member, that starts with the zero padded id. It is never invalidated.
+# Messages are added even to a cold cache, the fill merges them with the db snapshot,
+# so a message sent while the cache is filled is not lost. Only a filled cache has
+# MESSAGES_CACHE_FILLED (below every message) and is served.
+MESSAGES_CACHE_FILLED = ''
 
-        if user.id == sender_user.id:
-            continue
+def message_to_cache_entry(message_id: int, message: dict) -> tuple[str, float]:
+    """ 'message' is a SendMessageSchema dump, the same message is always the same member """
+    member = f"{message_id:020d}:{json.dumps(message, default=str)}"
+    return member, datetime.fromisoformat(message['created_at']).timestamp()
 
-        status = ReadStatusModel(
-            user_id=user.id,
-            message_id=message.id,
-            is_read=False,
-        )
+def queue_messages_cache_add(pipe: Pipeline, chat_uuid: UUID, entries: dict[str, float]) -> None:
+    key = REDIS_MESSAGES_KEY.format(chat_uuid)
+    pipe.zadd(key, entries)
+    pipe.zremrangebyrank(key, 1, -REDIS_MESSAGES_CACHE_SIZE - 1) # the marker and the newest stay
+    pipe.expire(key, jittered_ttl(), nx=True) # appends do not refresh the ttl
 
-        statuses.append(status)
+async def get_cached_messages(
+    r: Redis,
+    chat_uuid: UUID,
+    limit: int
+) -> tuple[list[dict], bool] | None:
+    """ Returns the newest 'limit' messages and has_more, or None on a cache miss """
+    key = REDIS_MESSAGES_KEY.format(chat_uuid)
 
-    return statuses
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.zscore(key, MESSAGES_CACHE_FILLED)
+        pipe.zcard(key)
+        pipe.zrange(key, -limit, -1)
+        filled, size, members = await pipe.execute()
 
-async def add_message_to_elastic(
-    es: AsyncElasticsearch,
-    message_uuid: UUID,
-    user_uuid: UUID,
-    chat_uuid: UUID,
-    content: str   
-) -> None:
-    await es.index(
-        index=ELASTIC_MESSAGES_INDEX_NAME,
-        id=str(message_uuid),
-        document={
-            "user": str(user_uuid),
-            "chat": str(chat_uuid),
-            "content": content,
-        }
-    )
+    if filled is None:
+        return None
 
-async def delete_cache_for_users(
-    r: Redis,
-    chat: ChatModel,
-    sender_user: UserModel
-) -> None:
-    user_uuids = [
-        assoc.user.uuid
-        for assoc in chat.user_associations
-        if assoc.user.uuid != sender_user.uuid
-    ]
-
-    keys = [REDIS_FOLDERS_KEY.format(u) for u in user_uuids]
-    if keys:
-        await r.delete(*keys)
\ No newline at end of file
+    # as long as the set is not full, it holds the whole chat history
+    size -= 1 # the marker
+    has_more = size > limit or size >= REDIS_MESSAGES_CACHE_SIZE
+    messages = [json.loads(member.split(':', 1)[1]) for member in members if member != MESSAGES_CACHE_FILLED]
+    return messages, has_more
+
+async def cache_messages(r: Redis, chat_uuid: UUID, messages: list[tuple[int, dict]]) -> None:
+    """ Fills the cache with the newest (id, message) of the chat, keeps the ones added meanwhile """
+    entries = dict(message_to_cache_entry(message_id, message) for message_id, message in messages)
+
+    async with r.pipeline(transaction=True) as pipe:
+        queue_messages_cache_add(pipe, chat_uuid, {MESSAGES_CACHE_FILLED: float('-inf'), **entries})
+        await pipe.execute()
+
+def append_message_to_cache(pipe: Pipeline, chat_uuid: UUID, message_id: int, message: dict) -> None:
+    """ Queues the append on 'pipe' """
+    queue_messages_cache_add(pipe, chat_uuid, dict([message_to_cache_entry(message_id, message)]))
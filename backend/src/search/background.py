@@ -0,0 +1,21 @@
+import asyncio
+import logging
+
+from src.settings import STATS_LOG_INTERVAL
+from src.database import async_session
+from src.search.outbox import outbox_replicator, get_outbox_backlog
+
+logger = logging.getLogger(__name__)
+
+async def periodic_outbox_stats_logger():
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        try:
+            async with async_session() as db:
+                backlog, oldest_age = await get_outbox_backlog(db)
+            logger.info(
+                f'Elastic outbox stats: {outbox_replicator.stats()}, '
+                f'backlog: {backlog}, oldest: {oldest_age:.1f}s'
+            )
+        except Exception as e:
+            logger.error(f'Failed to collect outbox stats: {e}')
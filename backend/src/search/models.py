@@ -0,0 +1,24 @@
+from datetime import datetime
+from uuid import UUID as PyUUID
+
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy import String, DateTime, UUID, Integer, func
+
+from src.database import Base
+
+
+class ElasticOutboxModel(Base):
+    """
+    Documents changed in a transaction, written in the same transaction.
+    The replicator re-reads them from the db, a missing row means delete.
+    """
+    __tablename__ = 'elastic_outbox'
+
+    id: Mapped[int] = mapped_column(primary_key=True) # replication order
+    index: Mapped[str] = mapped_column(String(50))
+    doc_uuid: Mapped[PyUUID] = mapped_column(UUID(as_uuid=True))
+    attempts: Mapped[int] = mapped_column(Integer, default=0, server_default='0') # failed replications
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True),
+        server_default=func.now()
+    )
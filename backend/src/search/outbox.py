@@ -0,0 +1,267 @@
+from uuid import UUID
+import asyncio
+import json
+import logging
+import time
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk
+from redis.asyncio import Redis
+from sqlalchemy import select, delete, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from src.settings import ELASTIC_USERS_INDEX_NAME, ELASTIC_CHATS_INDEX_NAME, \
+    ELASTIC_MESSAGES_INDEX_NAME, ELASTIC_USER_SCOPES_INDEX_NAME, ELASTIC_OUTBOX_BATCH_SIZE, ELASTIC_OUTBOX_POLL_INTERVAL, \
+    ELASTIC_OUTBOX_MAX_RETRY_DELAY, ELASTIC_OUTBOX_LOCK_ID, ELASTIC_OUTBOX_MAX_ATTEMPTS, REDIS_ELASTIC_REINDEX_TARGETS_KEY, \
+    REDIS_ELASTIC_REINDEX_DELETES_KEY
+from src.database import es, redis_client, async_session
+from src.search.models import ElasticOutboxModel
+from src.auth.models import UserModel
+from src.auth.utils import user_to_elastic_doc
+from src.chats.models import ChatModel, UserChatAssociationModel
+from src.chats.utils import chat_to_elastic_doc, user_scope_to_elastic_doc
+from src.messages.models import MessageModel
+from src.messages.utils import message_to_elastic_doc
+
+logger = logging.getLogger(__name__)
+
+# model, eager loads and document builder of every index
+ELASTIC_SOURCES = {
+    ELASTIC_USERS_INDEX_NAME: (UserModel, (), user_to_elastic_doc),
+    ELASTIC_CHATS_INDEX_NAME: (
+        ChatModel,
+        (selectinload(ChatModel.user_associations).selectinload(UserChatAssociationModel.user),),
+        chat_to_elastic_doc,
+    ),
+    ELASTIC_MESSAGES_INDEX_NAME: (
+        MessageModel,
+        (selectinload(MessageModel.user), selectinload(MessageModel.chat)),
+        message_to_elastic_doc,
+    ),
+    ELASTIC_USER_SCOPES_INDEX_NAME: (
+        UserModel,
+        (
+            selectinload(UserModel.chat_associations)
+            .selectinload(UserChatAssociationModel.chat)
+            .load_only(ChatModel.uuid),
+        ),
+        user_scope_to_elastic_doc,
+    ),
+}
+
+# routed indices, the field of the document that is its routing
+ELASTIC_ROUTING_FIELDS = {
+    ELASTIC_MESSAGES_INDEX_NAME: "chat", # a chat search touches one shard
+}
+
+def to_elastic_action(op_type: str, index: str, doc_uuid: UUID, doc: dict) -> dict:
+    action = {"_op_type": op_type, "_index": index, "_id": str(doc_uuid), "_source": doc}
+    if index in ELASTIC_ROUTING_FIELDS:
+        action["_routing"] = doc[ELASTIC_ROUTING_FIELDS[index]]
+    return action
+
+async def load_elastic_docs(db: AsyncSession, index: str, uuids: set[UUID]) -> dict[UUID, dict]:
+    model, options, to_doc = ELASTIC_SOURCES[index]
+    objects = await db.scalars(select(model).where(model.uuid.in_(uuids)).options(*options))
+    return {obj.uuid: to_doc(obj) for obj in objects}
+
+class OutboxReplicator:
+    """
+    Drains elastic_outbox in id order. The current db state is indexed, so
+    rows of the same document collapse and a row can be replayed safely.
+    Processed rows are deleted in the same transaction, that is the checkpoint.
+    A row elastic rejects for good, or that failed ELASTIC_OUTBOX_MAX_ATTEMPTS times,
+    is logged and dropped, so it can not block the head of the outbox.
+    """
+
+    def __init__(self, es: AsyncElasticsearch, r: Redis | None = None):
+        self.es = es
+        self.r = r
+        self.task: asyncio.Task | None = None
+
+        # metrics
+        self.replicated = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_batch_seconds = 0.0
+        self.retrying = False # the last batch kept failed rows
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._replication_loop())
+            self.task.add_done_callback(self._on_loop_done)
+
+    async def close(self):
+        if self.task:
+            task, self.task = self.task, None
+            task.cancel()
+
+    def _on_loop_done(self, task: asyncio.Task):
+        """ Should never happen, the loop is started again so the index still converges """
+        if self.task is not task: # closed
+            return
+        self.task = None
+        if not task.cancelled():
+            logger.error("Outbox replication ended, restarting it", exc_info=task.exception())
+            self.start()
+
+    async def _replication_loop(self):
+        delay = ELASTIC_OUTBOX_POLL_INTERVAL
+
+        while True:
+            try:
+                async with async_session() as db:
+                    processed = await self.replicate_batch(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e: # asyncpg connect errors are plain OSErrors
+                # rows stay in the outbox, the index converges after the outage
+                logger.warning(f"Outbox replication failed, retrying in {delay}s: {e!r}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, ELASTIC_OUTBOX_MAX_RETRY_DELAY)
+                continue
+
+            if self.retrying: # the failed rows are picked first again, give elastic time
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, ELASTIC_OUTBOX_MAX_RETRY_DELAY)
+                continue
+            delay = ELASTIC_OUTBOX_POLL_INTERVAL
+
+            if processed < ELASTIC_OUTBOX_BATCH_SIZE: # else there is a backlog
+                await asyncio.sleep(ELASTIC_OUTBOX_POLL_INTERVAL)
+
+    async def replicate_batch(self, db: AsyncSession) -> int:
+        """ Returns the number of processed outbox rows """
+        started = time.monotonic()
+        self.retrying = False
+
+        # one replicator across all workers, released with the transaction
+        if db.bind.dialect.name == 'postgresql':
+            if not await db.scalar(select(func.pg_try_advisory_xact_lock(ELASTIC_OUTBOX_LOCK_ID))):
+                return 0
+
+        rows = (await db.execute(
+            select(
+                ElasticOutboxModel.id, ElasticOutboxModel.index,
+                ElasticOutboxModel.doc_uuid, ElasticOutboxModel.attempts
+            )
+            .order_by(ElasticOutboxModel.id)
+            .limit(ELASTIC_OUTBOX_BATCH_SIZE)
+        )).all()
+        if not rows:
+            await db.commit()
+            return 0
+
+        uuids_by_index: dict[str, set[UUID]] = {}
+        for _, index, doc_uuid, _ in rows:
+            uuids_by_index.setdefault(index, set()).add(doc_uuid)
+
+        actions = []
+        deleted_chat_uuids = []
+        deleted_routed_uuids: dict[str, list[str]] = {} # by index
+        for index, uuids in uuids_by_index.items():
+            docs = await load_elastic_docs(db, index, uuids)
+            for doc_uuid in uuids:
+                if doc_uuid in docs:
+                    actions.append(to_elastic_action("index", index, doc_uuid, docs[doc_uuid]))
+                elif index in ELASTIC_ROUTING_FIELDS: # the routing of a deleted row is unknown
+                    deleted_routed_uuids.setdefault(index, []).append(str(doc_uuid))
+                else: # deleted in the db
+                    actions.append({"_op_type": "delete", "_index": index, "_id": str(doc_uuid)})
+                    if index == ELASTIC_CHATS_INDEX_NAME:
+                        deleted_chat_uuids.append(str(doc_uuid))
+
+        # an index that is being rebuilt gets the changes as well, see src.search.reindex
+        reindex_targets = await self.r.hgetall(REDIS_ELASTIC_REINDEX_TARGETS_KEY) if self.r else {}
+        deleted_for_reindex: dict[str, list[str]] = {} # by alias
+        for action in actions:
+            if action["_op_type"] == "delete" and action["_index"] in reindex_targets:
+                deleted_for_reindex.setdefault(action["_index"], []).append(action["_id"])
+        for alias, doc_uuids in deleted_for_reindex.items():
+            await self._record_reindex_delete(alias, {"ids": {"values": doc_uuids}})
+
+        actions += [
+            {**action, "_index": reindex_targets[action["_index"]]}
+            for action in actions if action["_index"] in reindex_targets
+        ]
+
+        _, errors = await async_bulk(self.es, actions, raise_on_error=False, max_retries=3)
+
+        failed: dict[str, bool] = {} # _id -> can succeed later
+        for error in errors:
+            op_type, item = next(iter(error.items()))
+            status = item.get("status")
+            if op_type == "delete" and status == 404:
+                continue # was never indexed
+            # _index is the concrete index behind the alias
+            retryable = status is None or status == 429 or status >= 500
+            failed[item["_id"]] = failed.get(item["_id"], False) or retryable
+            logger.warning(f"Outbox replication of {item['_id']} failed: {item.get('error')}")
+
+        # messages of deleted chats are deleted in the db by cascade
+        if deleted_chat_uuids:
+            await self._delete_by_query(
+                ELASTIC_MESSAGES_INDEX_NAME, {"terms": {"chat": deleted_chat_uuids}}, reindex_targets
+            )
+        for index, doc_uuids in deleted_routed_uuids.items():
+            await self._delete_by_query(index, {"ids": {"values": doc_uuids}}, reindex_targets)
+
+        # documents that can succeed later stay in the outbox for the next batch
+        processed_ids, retried_ids = [], []
+        for id, index, doc_uuid, attempts in rows:
+            if str(doc_uuid) not in failed:
+                processed_ids.append(id)
+            elif failed[str(doc_uuid)] and attempts + 1 < ELASTIC_OUTBOX_MAX_ATTEMPTS:
+                retried_ids.append(id)
+            else: # dead letter
+                processed_ids.append(id)
+                self.dropped += 1
+                logger.error(f"Outbox row {id} ({index} {doc_uuid}) dropped after {attempts + 1} attempts")
+        if processed_ids:
+            await db.execute(delete(ElasticOutboxModel).where(ElasticOutboxModel.id.in_(processed_ids)))
+        if retried_ids:
+            await db.execute(
+                update(ElasticOutboxModel)
+                .where(ElasticOutboxModel.id.in_(retried_ids))
+                .values(attempts=ElasticOutboxModel.attempts + 1)
+            )
+        await db.commit()
+
+        self.replicated += len(actions) - len(failed)
+        self.failed += len(failed)
+        self.retrying = bool(retried_ids)
+        self.last_batch_seconds = time.monotonic() - started
+        return len(rows)
+
+    async def _delete_by_query(self, index: str, query: dict, reindex_targets: dict[str, str]):
+        indices = [index]
+        if index in reindex_targets:
+            indices.append(reindex_targets[index])
+            await self._record_reindex_delete(index, query)
+        await self.es.delete_by_query(index=indices, query=query, conflicts="proceed")
+
+    async def _record_reindex_delete(self, alias: str, query: dict):
+        """
+        The build may have read a row before its delete and create it in the new index
+        after the delete, so the reindexer replays the deletes before the swap
+        """
+        await self.r.rpush(REDIS_ELASTIC_REINDEX_DELETES_KEY.format(alias), json.dumps(query))
+
+    def stats(self) -> dict:
+        return {
+            "replicated": self.replicated,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_batch_ms": round(self.last_batch_seconds * 1000, 2),
+        }
+
+async def get_outbox_backlog(db: AsyncSession) -> tuple[int, float]:
+    """ Pending rows and the age of the oldest one in seconds """
+    count, oldest = (await db.execute(
+        select(func.count(ElasticOutboxModel.id), func.min(ElasticOutboxModel.created_at))
+    )).one()
+    age = time.time() - oldest.timestamp() if oldest else 0.0
+    return count, age
+
+outbox_replicator = OutboxReplicator(es, redis_client)
@@ -0,0 +1,246 @@
+"""
+Rebuilds Elasticsearch indices from the db without downtime:
+
+    python -m src.search.reindex [users chats messages] [--swap] [--restart]
+
+Every index is built as '<alias>_<timestamp>' while searches keep using the
+current one, the outbox replicator writes changes into both. Rows are streamed
+in id order, the last indexed id is checkpointed in redis, so an interrupted
+run continues where it stopped. Deletes that happened during the build are
+replayed before the swap. --swap moves the alias to the new index.
+"""
+from typing import AsyncIterator
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_streaming_bulk
+from redis.asyncio import Redis
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.settings import REDIS_ELASTIC_REINDEX_TARGETS_KEY, REDIS_ELASTIC_REINDEX_CHECKPOINT_KEY, \
+    REDIS_ELASTIC_REINDEX_DELETES_KEY, ELASTIC_REINDEX_CHUNK_SIZE, ELASTIC_REINDEX_CONCURRENCY, \
+    ELASTIC_REINDEX_DELETES_CHUNK_SIZE
+from src.logger import setup_logging
+from src.database import es, redis_client, async_session, ELASTIC_INDEX_MAPPINGS, \
+    ELASTIC_ROLLOVER_ALIASES, get_index_settings
+from src.search.outbox import ELASTIC_SOURCES, to_elastic_action
+
+logger = logging.getLogger(__name__)
+
+async def stream_elastic_actions(
+    db: AsyncSession,
+    alias: str,
+    after_id: int,
+    chunk_size: int = ELASTIC_REINDEX_CHUNK_SIZE
+) -> AsyncIterator[tuple[int, list[dict]]]:
+    """ Yields (last id, actions) per chunk, rows come from a server side cursor """
+    model, options, to_doc = ELASTIC_SOURCES[alias]
+
+    result = await db.stream_scalars(
+        select(model)
+        .where(model.id > after_id)
+        .order_by(model.id)
+        .options(*options)
+        .execution_options(yield_per=chunk_size)
+    )
+    async for objects in result.partitions():
+        # create: a newer version written by the replicator meanwhile wins
+        actions = [to_elastic_action("create", alias, obj.uuid, to_doc(obj)) for obj in objects]
+        yield objects[-1].id, actions
+        db.expunge_all() # memory stays bounded by one chunk
+
+class Reindexer:
+    def __init__(
+        self,
+        es: AsyncElasticsearch,
+        r: Redis,
+        alias: str,
+        concurrency: int = ELASTIC_REINDEX_CONCURRENCY
+    ):
+        self.es = es
+        self.r = r
+        self.alias = alias
+        self.concurrency = concurrency
+        self.checkpoint_key = REDIS_ELASTIC_REINDEX_CHECKPOINT_KEY.format(alias)
+        self.deletes_key = REDIS_ELASTIC_REINDEX_DELETES_KEY.format(alias)
+
+        # progress
+        self.indexed = 0
+        self.failed = 0
+        self.total = 0
+
+    async def build(self, restart: bool = False) -> str:
+        """ Fills a new index or continues the last one, returns its name """
+        checkpoint = await self.r.get(self.checkpoint_key)
+        if checkpoint and restart: # the unfinished index is dropped
+            await self.es.indices.delete(index=json.loads(checkpoint)["index"], ignore_unavailable=True)
+            checkpoint = None
+
+        if checkpoint:
+            checkpoint = json.loads(checkpoint)
+            index, after_id = checkpoint["index"], checkpoint["last_id"]
+            logger.info(f"Continuing '{index}' after id {after_id}")
+        else:
+            index, after_id = self.new_index_name(), 0
+            settings = {**get_index_settings(self.alias), "refresh_interval": "-1"} # no refreshes while bulk loading
+            if self.alias in ELASTIC_ROLLOVER_ALIASES:
+                settings["index.lifecycle.name"] = None # ILM can not roll over before the swap
+            await self.es.indices.create(
+                index=index,
+                settings=settings,
+                mappings=ELASTIC_INDEX_MAPPINGS[self.alias],
+            )
+            await self.save_checkpoint(index, after_id)
+            await self.r.delete(self.deletes_key) # recorded for an older build
+            logger.info(f"Created '{index}' for '{self.alias}'")
+
+        # changes made during the build reach the new index through the outbox
+        await self.r.hset(REDIS_ELASTIC_REINDEX_TARGETS_KEY, self.alias, index)
+
+        model = ELASTIC_SOURCES[self.alias][0]
+        async with async_session() as db:
+            self.total = await db.scalar(select(func.count(model.id)).where(model.id > after_id))
+
+        await self.copy_rows(index, after_id)
+
+        await self.es.indices.put_settings(index=index, settings={"refresh_interval": None})
+        await self.es.indices.refresh(index=index)
+        await self.replay_deletes(index)
+        logger.info(f"Built '{index}': {self.indexed} documents, {self.failed} failed")
+        return index
+
+    async def replay_deletes(self, index: str):
+        """
+        Deletes recorded by the outbox replicator during the build: a row read before
+        its delete was created after the delete reached the new index. After the
+        refresh, delete_by_query only sees searchable documents.
+        """
+        queries = [json.loads(query) for query in await self.r.lrange(self.deletes_key, 0, -1)]
+        for start in range(0, len(queries), ELASTIC_REINDEX_DELETES_CHUNK_SIZE):
+            await self.es.delete_by_query(
+                index=index,
+                query={"bool": {"should": queries[start:start + ELASTIC_REINDEX_DELETES_CHUNK_SIZE]}},
+                conflicts="proceed",
+                refresh=True,
+            )
+        await self.r.ltrim(self.deletes_key, len(queries), -1) # the ones recorded meanwhile stay
+        logger.info(f"Replayed {len(queries)} deletes in '{index}'")
+
+    async def copy_rows(self, index: str, after_id: int):
+        """
+        Bulk requests run concurrently, so chunks can finish out of order.
+        The checkpoint only moves past a chunk when all earlier ones are done.
+        """
+        queue: asyncio.Queue[tuple[int, int, list[dict]] | None] = asyncio.Queue(self.concurrency)
+        finished: dict[int, int] = {} # chunk number -> last id
+        next_chunk = 0
+        started = time.monotonic()
+
+        async def bulk_worker():
+            nonlocal next_chunk
+
+            while (chunk := await queue.get()) is not None:
+                number, last_id, actions = chunk
+                async for ok, item in async_streaming_bulk(
+                    self.es, actions, chunk_size=len(actions),
+                    max_retries=3, raise_on_error=False
+                ):
+                    result = item["create"]
+                    if ok or result.get("status") == 409: # 409: already indexed by the replicator
+                        self.indexed += 1
+                    else:
+                        self.failed += 1
+                        logger.warning(f"Indexing of {result['_id']} failed: {result.get('error')}")
+
+                finished[number] = last_id
+                if next_chunk in finished:
+                    while next_chunk in finished:
+                        last_id = finished.pop(next_chunk)
+                        next_chunk += 1
+                    await self.save_checkpoint(index, last_id)
+
+                rate = self.indexed / (time.monotonic() - started)
+                logger.info(f"'{self.alias}': {self.indexed}/{self.total} ({rate:.0f} docs/s)")
+
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(self.concurrency):
+                tg.create_task(bulk_worker())
+
+            async with async_session() as db:
+                number = 0
+                async for last_id, actions in stream_elastic_actions(db, self.alias, after_id):
+                    for action in actions:
+                        action["_index"] = index # the new index, not the alias
+                    await queue.put((number, last_id, actions))
+                    number += 1
+
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+    def new_index_name(self) -> str:
+        if self.alias in ELASTIC_ROLLOVER_ALIASES: # the rollover increments the last number
+            return f"{self.alias}-{int(time.time())}-000001"
+        return f"{self.alias}_{int(time.time())}"
+
+    async def save_checkpoint(self, index: str, last_id: int):
+        await self.r.set(self.checkpoint_key, json.dumps({"index": index, "last_id": last_id}))
+
+    async def swap(self, index: str):
+        """ Points the alias at the new index in one atomic request and drops the old ones """
+        actions = [{"add": {"index": index, "alias": self.alias, "is_write_index": True}}]
+        old_indices = []
+
+        if await self.es.indices.exists_alias(name=self.alias):
+            old_indices = [name for name in await self.es.indices.get_alias(name=self.alias) if name != index]
+            actions += [{"remove": {"index": name, "alias": self.alias}} for name in old_indices]
+        elif await self.es.indices.exists(index=self.alias):
+            # created by create_indices before the first reindex
+            actions.insert(0, {"remove_index": {"index": self.alias}})
+
+        await self.es.indices.update_aliases(actions=actions)
+        for name in old_indices:
+            await self.es.indices.delete(index=name)
+
+        if self.alias in ELASTIC_ROLLOVER_ALIASES:
+            await self.es.indices.put_settings(
+                index=index,
+                settings={"index.lifecycle.name": ELASTIC_ROLLOVER_ALIASES[self.alias]}
+            )
+
+        await self.r.hdel(REDIS_ELASTIC_REINDEX_TARGETS_KEY, self.alias)
+        await self.r.delete(self.checkpoint_key, self.deletes_key)
+        logger.info(f"'{self.alias}' now points to '{index}'")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Rebuild Elasticsearch indices from the db")
+    parser.add_argument("aliases", nargs="*", default=list(ELASTIC_SOURCES),
+                        help=f"any of {', '.join(ELASTIC_SOURCES)}, all by default")
+    parser.add_argument("--swap", action="store_true", help="move the aliases to the new indices")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoints")
+    parser.add_argument("--concurrency", type=int, default=ELASTIC_REINDEX_CONCURRENCY)
+    args = parser.parse_args()
+
+    unknown = set(args.aliases) - set(ELASTIC_SOURCES)
+    if unknown:
+        parser.error(f"unknown indices: {', '.join(unknown)}")
+
+    setup_logging()
+    try:
+        for alias in args.aliases:
+            reindexer = Reindexer(es, redis_client, alias, args.concurrency)
+            index = await reindexer.build(restart=args.restart)
+            if args.swap:
+                await reindexer.swap(index)
+            else:
+                logger.info(f"'{alias}' still points to the old index, run again with --swap")
+    finally:
+        await es.close()
+        await redis_client.aclose()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,23 +1,28 @@
 from typing import Annotated
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, Query, HTTPException, status
 from redis.asyncio import Redis
-from elasticsearch import AsyncElasticsearch
+from elasticsearch import AsyncElasticsearch, NotFoundError, BadRequestError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.settings import ELASTIC_PAGE_SIZE, REDIS_SEARCH_HISTORY_KEY, \
+from src.settings import ELASTIC_PAGE_SIZE, ELASTIC_SUGGEST_SIZE, ELASTIC_PIT_KEEP_ALIVE, \
+    REDIS_SEARCH_SUGGEST_KEY, SEARCH_SUGGEST_CACHE_SECONDS, ELASTIC_SECTION_SIZES, \
+    ELASTIC_SECTION_TIMEOUTS, ELASTIC_SECTIONS_REQUEST_TIMEOUT, \
     ELASTIC_CHATS_INDEX_NAME, ELASTIC_USERS_INDEX_NAME, ELASTIC_MESSAGES_INDEX_NAME
 from src.database import get_db, get_es, get_redis
 from src.dependencies import get_active_current_user
 from src.auth.models import UserModel
-from src.auth.services import get_all_users_connected_by_normal_chat
-from src.search.utils import add_query_to_history, parse_elastic_response
-from src.chats.services import get_all_chats_with_last_message
+from src.search.utils import add_query_to_history, parse_elastic_response, build_search_filter, \
+    normalize_query, encode_search_cursor, decode_search_cursor, \
+    SEARCH_SECTION_QUERIES, parse_msearch_sections, get_search_history
+from src.chats.services import get_user_chat_uuids, get_user_chat_partner_uuids
+from src.cache import coalesce, cached_json
 
 router = APIRouter(prefix='/search', tags=['search'])
 
 # users, groups, messages + own chats
+# a committed search, the query is added to the history
 @router.get('/global')
 async def search_global(
     db: Annotated[AsyncSession, Depends(get_db)],
@@ -25,159 +30,243 @@ async def search_global(
     es: Annotated[AsyncElasticsearch, Depends(get_es)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
     q: str = Query(..., min_length=1, max_length=100),
-    page: int = Query(1, ge=1),
+    cursor: str | None = Query(None, description="From the previous page, none for the first one"),
+):
+    if cursor is None:
+        await add_query_to_history(r, current_user.uuid, q)
+
+        # a point in time keeps the pages consistent while documents are indexed
+        pit = await es.open_point_in_time(
+            index=f'{ELASTIC_USERS_INDEX_NAME},{ELASTIC_CHATS_INDEX_NAME},{ELASTIC_MESSAGES_INDEX_NAME}',
+            keep_alive=ELASTIC_PIT_KEEP_ALIVE,
+        )
+        pit_id, search_after = pit['id'], None
+    else:
+        pit_id, search_after = decode_search_cursor(cursor)
+
+    # cached scope, the db is only hit after a membership change
+    existing_chat_partners_uuids = [str(u) for u in await get_user_chat_partner_uuids(db, r, current_user)]
+    existing_chat_partners_uuids.append(str(current_user.uuid)) # workaround: do not show you to yourself
+
+    body = {
+        "query": {
+            "bool": {
+                "must": {
+                    "multi_match": {
+                        "query": q,
+                        "fields": [
+                            'name^5', 'name.autocomplete^3', 'user_names^5',
+                            'username^4', 'username.autocomplete^2',
+                            'first_name^2', 'first_name.autocomplete',
+                            'last_name^2', 'last_name.autocomplete',
+                            'description^0.5',
+                            'content',
+                        ],
+                        "type": "best_fields",
+                        "fuzziness": "AUTO"
+                    }
+                },
+                # built for every page, a cursor can not widen it
+                "filter": build_search_filter(current_user.uuid, existing_chat_partners_uuids)
+            }
+        },
+        "pit": {"id": pit_id, "keep_alive": ELASTIC_PIT_KEEP_ALIVE},
+        # the point in time adds _shard_doc as the tiebreaker
+        "sort": [{"_score": "desc"}],
+        "size": ELASTIC_PAGE_SIZE,
+        # only the first page counts the hits
+        "track_total_hits": search_after is None,
+    }
+    if search_after is not None: # constant cost per page, unlike from
+        body["search_after"] = search_after
+
+    try:
+        response = await es.search(body=body)
+    except NotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="The search expired, start it again"
+        )
+    except BadRequestError: # a malformed pit id or sort values in the cursor
+        if cursor is None:
+            await es.close_point_in_time(id=pit_id)
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+    hits = response['hits']['hits']
+    total, items = parse_elastic_response(response, current_user.uuid)
+
+    next_cursor = None
+    if len(hits) == ELASTIC_PAGE_SIZE:
+        next_cursor = encode_search_cursor(response['pit_id'], hits[-1]['sort'])
+    else: # the last page
+        await es.close_point_in_time(id=response['pit_id'])
+
+    return {
+        "total": total,
+        "page_size": ELASTIC_PAGE_SIZE,
+        "items": items,
+        "cursor": next_cursor,
+    }
+
+# users, groups and messages searched in parallel, grouped by type
+# slow messages do not delay the people and groups
+@router.get('/sections')
+async def search_sections(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    r: Annotated[Redis, Depends(get_redis)],
+    es: Annotated[AsyncElasticsearch, Depends(get_es)],
+    current_user: Annotated[UserModel, Depends(get_active_current_user)],
+    q: str = Query(..., min_length=1, max_length=100),
 ):
     await add_query_to_history(r, current_user.uuid, q)
 
-    existing_chat_partners_uuids = [u.uuid for u in await get_all_users_connected_by_normal_chat(db, current_user)]
-    existing_chat_partners_uuids.append(current_user.uuid) # workaround: do not show you to yourself
+    hidden_user_uuids = [str(u) for u in await get_user_chat_partner_uuids(db, r, current_user)]
+    hidden_user_uuids.append(str(current_user.uuid))
+    search_filter = build_search_filter(current_user.uuid, hidden_user_uuids)
 
-    allowed_chat_uuids = [str(c.uuid) for c, _ in await get_all_chats_with_last_message(db, current_user)]
+    searches = []
+    for index, section_query in SEARCH_SECTION_QUERIES.items():
+        searches.append({"index": index})
+        searches.append({
+            "query": {
+                "bool": {
+                    "must": {"multi_match": {"query": q, "type": "best_fields", **section_query}},
+                    "filter": search_filter,
+                }
+            },
+            "size": ELASTIC_SECTION_SIZES[index],
+            "timeout": ELASTIC_SECTION_TIMEOUTS[index],
+        })
+
+    response = await es.options(request_timeout=ELASTIC_SECTIONS_REQUEST_TIMEOUT).msearch(
+        searches=searches,
+        max_concurrent_searches=len(SEARCH_SECTION_QUERIES),
+    )
+
+    return parse_msearch_sections(response['responses'], list(SEARCH_SECTION_QUERIES), current_user.uuid)
+
+# search as you type: prefix matches only, not added to the history
+@router.get('/suggest')
+async def search_suggest(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    r: Annotated[Redis, Depends(get_redis)],
+    es: Annotated[AsyncElasticsearch, Depends(get_es)],
+    current_user: Annotated[UserModel, Depends(get_active_current_user)],
+    q: str = Query(..., min_length=1, max_length=100),
+):
+    prefix = normalize_query(q)
+    redis_key = REDIS_SEARCH_SUGGEST_KEY.format(current_user.uuid, prefix)
+
+    hidden_user_uuids = [str(u) for u in await get_user_chat_partner_uuids(db, r, current_user)]
+    hidden_user_uuids.append(str(current_user.uuid))
+
+    async def suggest() -> dict:
+        response = await es.search(
+            index=f'{ELASTIC_USERS_INDEX_NAME},{ELASTIC_CHATS_INDEX_NAME},{ELASTIC_MESSAGES_INDEX_NAME}',
+            query={
+                "bool": {
+                    "must": {
+                        # the edge ngram subfields already hold every prefix
+                        "multi_match": {
+                            "query": prefix,
+                            "fields": [
+                                'name.autocomplete^3', 'user_names.autocomplete^3',
+                                'username.autocomplete^2', 'first_name.autocomplete',
+                                'last_name.autocomplete', 'content^0.5', # prefixes of content are indexed
+                            ],
+                            "type": "bool_prefix",
+                        }
+                    },
+                    "filter": build_search_filter(current_user.uuid, hidden_user_uuids)
+                }
+            },
+            size=ELASTIC_SUGGEST_SIZE,
+        )
+        total, items = parse_elastic_response(response, current_user.uuid)
+        return {"total": total, "items": items}
+
+    # a burst of the same prefix, e.g. from several tabs, runs one search:
+    # coalesced in this worker, locked across workers. Never served stale.
+    return await coalesce(redis_key, lambda: cached_json(
+        r, redis_key, suggest, ttl=SEARCH_SUGGEST_CACHE_SECONDS, stale=0
+    ))
+
+# messages of one chat, with highlighted fragments to jump to
+@router.get('/messages')
+async def search_messages(
+    db: Annotated[AsyncSession, Depends(get_db)],
+    r: Annotated[Redis, Depends(get_redis)],
+    es: Annotated[AsyncElasticsearch, Depends(get_es)],
+    current_user: Annotated[UserModel, Depends(get_active_current_user)],
+    chat_uuid: UUID,
+    q: str = Query(..., min_length=1, max_length=100),
+    page: int = Query(1, ge=1),
+):
+    if chat_uuid not in await get_user_chat_uuids(db, r, current_user):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You must be in the chat"
+        )
+
+    if page == 1:
+        await add_query_to_history(r, current_user.uuid, q)
 
     response = await es.search(
-        index=f'{ELASTIC_USERS_INDEX_NAME},{ELASTIC_CHATS_INDEX_NAME},{ELASTIC_MESSAGES_INDEX_NAME}',
+        index=ELASTIC_MESSAGES_INDEX_NAME,
+        routing=str(chat_uuid), # the messages of a chat are on one shard
         body={
             "query": {
                 "bool": {
                     "must": {
                         "multi_match": {
                             "query": q,
-                            "fields": [
-                                'name^5', 'name.autocomplete^3', 'user_names^5',
-                                'username^4', 'username.autocomplete^2',
-                                'first_name^2', 'first_name.autocomplete',
-                                'last_name^2', 'last_name.autocomplete',
-                                'description^0.5',
-                                'content', 'content.autocomplete',
-                            ],
+                            "fields": ['content'],
                             "type": "best_fields",
                             "fuzziness": "AUTO"
                         }
                     },
-                    "filter": {
-                        "bool": {
-                            "should": [
-                                {
-                                  "bool": {
-                                    "must": [
-                                      { "term": { "_index": ELASTIC_USERS_INDEX_NAME } },
-                                      { "term": { "is_visible": True } }
-                                    ],
-                                    # do not show, if already in a normal chat
-                                    "must_not": [
-                                      {
-                                        "ids": {
-                                          "values": existing_chat_partners_uuids
-                                        }
-                                      }
-                                    ]
-                                  }
-                                },
-
-                                # Chats: show if is_visible OR user is a member
-                                {
-                                    "bool": {
-                                        "must": [
-                                            { "term": { "_index": ELASTIC_CHATS_INDEX_NAME } },
-                                            {
-                                                "bool": {
-                                                    "should": [
-                                                        { "term": { "is_visible": True } },
-                                                        { "term": { "members": str(current_user.uuid) } }
-                                                    ]
-                                                }
-                                            }
-                                        ]
-                                    }
-                                },
-
-                                # Messages: only visible to participants
-                                {
-                                    "bool": {
-                                        "must": [
-                                            { "term": { "_index": ELASTIC_MESSAGES_INDEX_NAME } },
-                                            { "terms": { "chat": allowed_chat_uuids } }
-                                        ]
-                                    }
-                                }
-                            ]
-                        }
-                    }
+                    "filter": {"term": {"chat": str(chat_uuid)}}
                 }
             },
+            "highlight": {
+                "fields": {
+                    "content": {"number_of_fragments": 3, "fragment_size": 100},
+                },
+                "pre_tags": ["<mark>"],
+                "post_tags": ["</mark>"],
+            },
+            "_source": ["user", "created_at"], # the content comes as fragments
             "from": (page - 1) * ELASTIC_PAGE_SIZE,
             "size": ELASTIC_PAGE_SIZE
         }
     )
 
-    total, items = parse_elastic_response(response, current_user.uuid)
-    
+    items = [
+        {
+            "uuid": hit['_id'],
+            "user": hit['_source']['user'],
+            "created_at": hit['_source'].get('created_at'), # missing before a reindex
+            "highlights": hit.get('highlight', {}).get('content', []),
+        }
+        for hit in response['hits']['hits']
+    ]
+
     return {
-        "total": total,
+        "total": response['hits']['total']['value'],
         "page": page,
         "page_size": ELASTIC_PAGE_SIZE,
         "items": items
     }
 
-# @router.get('/messages')
-# async def search_messages(
-#     db: Annotated[AsyncSession, Depends(get_db)],
-#     r: Annotated[Redis, Depends(get_redis)],
-#     es: Annotated[AsyncElasticsearch, Depends(get_es)],
-#     current_user: Annotated[UserModel, Depends(get_active_current_user)],
-#     chat_uuid: UUID,
-#     q: str = Query(..., min_length=1, max_length=100),
-#     page: int = Query(1, ge=1),
-# ):
-#     chat = await get_chat_or_404(db, chat_uuid)
-#     ensure_user_in_chat_or_403(current_user, chat)
-# 
-#     await add_query_to_history(r, current_user.uuid, q)
-# 
-#     response = await es.search(
-#         index=f'{ELASTIC_MESSAGES_INDEX_NAME}',
-#         body={
-#             "query": {
-#                 "bool": {
-#                     "must": {
-#                         "multi_match": {
-#                             "query": q,
-#                             "fields": [
-#                                 'text', 'text.autocomplete',
-#                             ],
-#                             "type": "best_fields",
-#                             "fuzziness": "AUTO"
-#                         }
-#                     },
-#                     "filter": {
-#                         # Messages: only visible to participants
-#                         "bool": {
-#                             "must": [
-#                                 { "term": { "chat": chat_uuid } },
-#                             ]
-#                         }
-#                     }
-#                 }
-#             },
-#             "from": (page - 1) * ELASTIC_PAGE_SIZE,
-#             "size": ELASTIC_PAGE_SIZE
-#         }
-#     )
-# 
-#     total, items = parse_elastic_response(response)
-#     
-#     return {
-#         "total": total,
-#         "page": page,
-#         "page_size": ELASTIC_PAGE_SIZE,
-#         "items": items
-#     }
-
 # last search queries
 @router.get('/history')
-async def get_search_history(
+async def search_history(
     r: Annotated[Redis, Depends(get_redis)],
     current_user: Annotated[UserModel, Depends(get_active_current_user)],
+    prefix: str | None = Query(None, max_length=100, description="Only queries starting with it"),
 ):
-    history = await r.lrange(REDIS_SEARCH_HISTORY_KEY.format(current_user.uuid), 0, -1)
-    return {'items': history}
+    return {'items': await get_search_history(r, current_user.uuid, prefix)}
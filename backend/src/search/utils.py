@@ -1,29 +1,180 @@
 from uuid import UUID
+import base64
+import binascii
+import json
+import re
+import time
+
+from fastapi import HTTPException, status
 
 from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.settings import REDIS_SEARCH_HISTORY_KEY, SEARCH_HISTORY_SIZE, ELASTIC_CHATS_INDEX_NAME, \
+    ELASTIC_USERS_INDEX_NAME, ELASTIC_MESSAGES_INDEX_NAME, ELASTIC_USER_SCOPES_INDEX_NAME
+from src.search.models import ElasticOutboxModel
 
-from src.settings import REDIS_SEARCH_HISTORY_KEY, SEARCH_HISTORY_SIZE, ELASTIC_CHATS_INDEX_NAME
+# fields of every index, fuzziness is left out for the big messages index
+SEARCH_SECTION_QUERIES = {
+    ELASTIC_USERS_INDEX_NAME: {
+        "fields": [
+            'username^4', 'username.autocomplete^2',
+            'first_name^2', 'first_name.autocomplete',
+            'last_name^2', 'last_name.autocomplete',
+            'description^0.5',
+        ],
+        "fuzziness": "AUTO",
+    },
+    ELASTIC_CHATS_INDEX_NAME: {
+        "fields": ['name^5', 'name.autocomplete^3', 'user_names^5', 'description^0.5'],
+        "fuzziness": "AUTO",
+    },
+    ELASTIC_MESSAGES_INDEX_NAME: {
+        "fields": ['content'],
+    },
+}
+
+def add_to_elastic_outbox(db: AsyncSession, index: str, *doc_uuids: UUID) -> None:
+    """ Committed together with the change, replicated by the outbox worker """
+    db.add_all([ElasticOutboxModel(index=index, doc_uuid=doc_uuid) for doc_uuid in doc_uuids])
 
 async def add_query_to_history(r: Redis, user_uuid: UUID, q: str) -> None:
+    """ One round trip, a repeated query only moves to the top """
     key = REDIS_SEARCH_HISTORY_KEY.format(user_uuid)
-    await r.lrem(key, 0, q)
-    await r.lpush(key, q)
-    await r.ltrim(key, 0, SEARCH_HISTORY_SIZE - 1)
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.zadd(key, {q: time.time()})
+        pipe.zremrangebyrank(key, 0, -SEARCH_HISTORY_SIZE - 1) # keeps the newest
+        await pipe.execute()
+
+async def get_search_history(r: Redis, user_uuid: UUID, prefix: str | None = None) -> list[str]:
+    """ Newest first, the history is short enough to filter here """
+    history = await r.zrevrange(REDIS_SEARCH_HISTORY_KEY.format(user_uuid), 0, -1)
+    if prefix:
+        prefix = prefix.lower()
+        history = [q for q in history if q.lower().startswith(prefix)]
+    return history
+
+def normalize_query(q: str) -> str:
+    """ 'Foo  bar ' and 'foo bar' share a cache entry """
+    return ' '.join(q.lower().split())
+
+def encode_search_cursor(pit_id: str, search_after: list) -> str:
+    """ Opaque for the client: the point in time and the sort values of the last hit """
+    data = json.dumps({"pit": pit_id, "after": search_after}).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+def decode_search_cursor(cursor: str) -> tuple[str, list]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(data["pit"], str) or not isinstance(data["after"], list):
+            raise ValueError
+        return data["pit"], data["after"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+def build_search_filter(user_uuid: UUID, hidden_user_uuids: list[str]) -> dict:
+    """ What 'user_uuid' may find in the users, chats and messages indices """
+    return {
+        "bool": {
+            "should": [
+                {
+                  "bool": {
+                    "must": [
+                      { "term": { "_index": ELASTIC_USERS_INDEX_NAME } },
+                      { "term": { "is_visible": True } }
+                    ],
+                    # do not show, if already in a normal chat
+                    "must_not": [
+                      {
+                        "ids": {
+                          "values": hidden_user_uuids
+                        }
+                      }
+                    ]
+                  }
+                },
+
+                # Chats: show if is_visible OR user is a member
+                {
+                    "bool": {
+                        "must": [
+                            { "term": { "_index": ELASTIC_CHATS_INDEX_NAME } },
+                            {
+                                "bool": {
+                                    "should": [
+                                        { "term": { "is_visible": True } },
+                                        { "term": { "members": str(user_uuid) } }
+                                    ]
+                                }
+                            }
+                        ]
+                    }
+                },
+
+                # Messages: only visible to participants
+                {
+                    "bool": {
+                        "must": [
+                            { "term": { "_index": ELASTIC_MESSAGES_INDEX_NAME } },
+                            # the chats are looked up in the scope document of the user,
+                            # so the filter is the same for every query and is cached
+                            {
+                                "terms": {
+                                    "chat": {
+                                        "index": ELASTIC_USER_SCOPES_INDEX_NAME,
+                                        "id": str(user_uuid),
+                                        "path": "chats"
+                                    }
+                                }
+                            }
+                        ]
+                    }
+                }
+            ]
+        }
+    }
+
+def index_to_alias(index: str) -> str:
+    """
+    Hits name the concrete index: 'chats_1760000000' from src.search.reindex,
+    'messages-000002' from a rollover -> 'chats', 'messages'
+    """
+    return re.sub(r'([_-]\d+)+$', '', index)
+
+def parse_msearch_sections(responses: list[dict], indices: list[str], user_uuid: UUID) -> dict:
+    """ One section per index, a failed sub search does not fail the others """
+    sections = {}
+    for index, response in zip(indices, responses):
+        if 'error' in response:
+            sections[index] = {"total": 0, "items": [], "timed_out": False, "failed": True}
+            continue
+
+        total, items = parse_elastic_response(response, user_uuid)
+        sections[index] = {
+            "total": total,
+            "items": items,
+            "timed_out": response.get('timed_out', False), # partial hits
+            "failed": False,
+        }
+    return sections
 
-def parse_elastic_response(response: dict, user_uuid: UUID = None) -> tuple[int, list[dict]]:
-    total = response['hits']['total']['value']
+def parse_elastic_response(response: dict, user_uuid: UUID = None) -> tuple[int | None, list[dict]]:
+    """ total is None, if the hits were not tracked """
+    total = response['hits']['total']['value'] if 'total' in response['hits'] else None
 
     items: list[dict] = []
     for hit in response['hits']['hits']:
         doc = hit['_source']
         doc['uuid'] = hit['_id']
-        doc['type'] = hit['_index']
+        doc['type'] = index_to_alias(hit['_index'])
 
         # Indicates if current user is a member of the chat (for UI purposes)
-        if user_uuid is not None and hit['_index'] == ELASTIC_CHATS_INDEX_NAME:
+        if user_uuid is not None and doc['type'] == ELASTIC_CHATS_INDEX_NAME:
             doc['is_yours'] = str(user_uuid) in doc.get('members', [])
 
         items.append(doc)
     
     return total, items
-    
\ No newline at end of file
@@ -11,28 +11,74 @@ DATABASE_URL = (
 
 INVITATION_CLEANING_SLEEP_TIME = 5 * 60 # 5 minutes
 
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 100
+
+CHATS_PAGE_SIZE = 30
+CHATS_MAX_PAGE_SIZE = 100
+CHATS_MAX_MEMBERS_PREVIEW = 20
+
+WS_SEND_QUEUE_SIZE = 256 # outgoing frames buffered per socket
+WS_SEND_TIMEOUT = 10 # seconds, a slower client gets disconnected
+STATS_LOG_INTERVAL = 60 # seconds, websocket and indexer metrics
+PUBSUB_RECONNECT_MIN_DELAY = 0.5 # seconds, doubled after every failure
+PUBSUB_RECONNECT_MAX_DELAY = 30
+
 REDIS_HOST = 'redis'
 REDIS_PORT = 6379
-REDIS_CACHE_EXPIRE_SECONDS = 60 * 60 # 1 hour
+REDIS_CACHE_EXPIRE_SECONDS = 60 * 60 # 1 hour, fresh for that long +-REDIS_CACHE_TTL_JITTER
+REDIS_CACHE_TTL_JITTER = 0.1 # keys filled together do not expire together
+REDIS_CACHE_STALE_SECONDS = 5 * 60 # served stale for that long while one request rebuilds it
+REDIS_CACHE_LOCK_KEY = 'cache_lock_{}' # 'cache_lock_{key}', held by the request that rebuilds the key
+REDIS_CACHE_LOCK_TIMEOUT = 10 # seconds
+REDIS_CACHE_LOCK_WAIT = 2 # seconds a miss waits for the rebuild of another request
+REDIS_CACHE_LOCK_POLL_INTERVAL = 0.05 # seconds
+REDIS_CACHE_VERSION_KEY = 'cache_version_{}' # 'cache_version_{key}', bumped by every change of a hash cache
 REDIS_FOLDERS_KEY = 'folders_{}' # 'folders_{user_uuid}'
 REDIS_CHATS_KEY = 'chats_{}' # 'chats_{user_uuid}'
+REDIS_USER_CHAT_UUIDS_KEY = 'user_chat_uuids_{}' # 'user_chat_uuids_{user_uuid}'
+REDIS_USER_CHAT_PARTNERS_KEY = 'user_chat_partners_{}' # 'user_chat_partners_{user_uuid}'
 REDIS_USERS_KEY = 'users_{}' # 'users_{user_uuid}'
 REDIS_USER_JOIN_REQUESTS_KEY = 'user_join_requests_{}' # 'user_join_requests_{user_uuid}'
 REDIS_GROUP_JOIN_REQUESTS_KEY = 'group_join_requests_{}' # 'group_join_requests_{group_uuid}'
 REDIS_USER_INVITATION_KEY = 'user_invitation_{}' # 'user_invitation_{user_uuid}'
 REDIS_GROUP_INVITATION_KEY = 'group_invitation_{}' # 'group_invitation_{group_uuid}'
-REDIS_MESSAGES_KEY = 'messages_{}' # 'messages_{chat_uuid}'
+REDIS_MESSAGES_KEY = 'chat_messages_{}' # 'chat_messages_{chat_uuid}', a sorted set
+REDIS_MESSAGES_CACHE_SIZE = 200 # newest messages kept per chat
 REDIS_GOOGLE_STATE_KEY = 'google_state_{}' # 'google_state_{state}'
 GOOGLE_STATE_LIFETIME = 60 * 5 # 5 minutes
-REDIS_SEARCH_HISTORY_KEY = 'search_history_{}' # 'history_{user_uuid}'
+REDIS_SEARCH_HISTORY_KEY = 'search_queries_{}' # 'search_queries_{user_uuid}', sorted set by time
+REDIS_ELASTIC_REINDEX_TARGETS_KEY = 'elastic_reindex_targets' # {alias: index being built}
+REDIS_ELASTIC_REINDEX_CHECKPOINT_KEY = 'elastic_reindex_checkpoint_{}' # 'elastic_reindex_checkpoint_{alias}'
+REDIS_ELASTIC_REINDEX_DELETES_KEY = 'elastic_reindex_deletes_{}' # 'elastic_reindex_deletes_{alias}', delete queries during a build
 SEARCH_HISTORY_SIZE = 100
+REDIS_SEARCH_SUGGEST_KEY = 'search_suggest_{}_{}' # 'search_suggest_{user_uuid}_{prefix}'
+SEARCH_SUGGEST_CACHE_SECONDS = 30 # short, memberships and names change
 
 ELASTIC_HOST = 'http://elasticsearch:9200'
 ELASTIC_PASSWORD = os.environ['ELASTIC_PASSWORD']
 ELASTIC_CHATS_INDEX_NAME = 'chats'
 ELASTIC_USERS_INDEX_NAME = 'users'
 ELASTIC_MESSAGES_INDEX_NAME = 'messages'
+ELASTIC_USER_SCOPES_INDEX_NAME = 'user_scopes' # chats of every user, for terms lookups
+ELASTIC_MESSAGES_ILM_POLICY = 'messages_policy'
+ELASTIC_MESSAGES_ROLLOVER_MAX_AGE = '30d'
+ELASTIC_MESSAGES_ROLLOVER_MAX_SHARD_SIZE = '25gb'
 ELASTIC_PAGE_SIZE = 20
+ELASTIC_SUGGEST_SIZE = 10
+ELASTIC_PIT_KEEP_ALIVE = '30s' # between two pages of a search, short as an abandoned search holds it that long
+# /search/sections: hits and time budget of every index, a late one returns what it has
+ELASTIC_SECTION_SIZES = {ELASTIC_USERS_INDEX_NAME: 5, ELASTIC_CHATS_INDEX_NAME: 5, ELASTIC_MESSAGES_INDEX_NAME: 20}
+ELASTIC_SECTION_TIMEOUTS = {ELASTIC_USERS_INDEX_NAME: '100ms', ELASTIC_CHATS_INDEX_NAME: '100ms', ELASTIC_MESSAGES_INDEX_NAME: '300ms'}
+ELASTIC_SECTIONS_REQUEST_TIMEOUT = 2 # seconds, the whole msearch
+ELASTIC_OUTBOX_BATCH_SIZE = 500
+ELASTIC_OUTBOX_POLL_INTERVAL = 1 # seconds, doubled after every failure
+ELASTIC_OUTBOX_MAX_RETRY_DELAY = 60
+ELASTIC_OUTBOX_LOCK_ID = 726_001 # postgres advisory lock of the replicator
+ELASTIC_OUTBOX_MAX_ATTEMPTS = 10 # a row failing that often is dropped, a reindex restores it
+ELASTIC_REINDEX_CHUNK_SIZE = 1000 # rows per db fetch and bulk request
+ELASTIC_REINDEX_CONCURRENCY = 4 # bulk requests in flight
+ELASTIC_REINDEX_DELETES_CHUNK_SIZE = 500 # replayed delete queries per request, below the max clause count
 
 SECRET_KEY = os.environ['SECRET_KEY']
 
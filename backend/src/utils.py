@@ -1,5 +1,7 @@
-from typing import Iterable, Sequence
+from typing import Iterable, Sequence, Coroutine
+import asyncio
 import json
+import logging
 from uuid import uuid4
 
 from pydantic import BaseModel
@@ -11,6 +13,11 @@ from fastapi import HTTPException, status, UploadFile
 
 from src.settings import MAX_AVATAR_SIZE, ALLOWED_CONTENT_TYPES
 
+logger = logging.getLogger(__name__)
+
+# strong references, otherwise running tasks may be garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
 async def save_to_db(db: AsyncSession, instances: Iterable[object]):
     db.add_all(instances)
     await db.commit()
@@ -55,6 +62,19 @@ async def get_all_objects(
     objects = result.scalars().all()
     return objects
 
+def run_in_background(coro: Coroutine, name: str = 'background task') -> asyncio.Task:
+    """ Fire and forget, failures are only logged """
+    async def runner():
+        try:
+            await coro
+        except Exception as e:
+            logger.exception(f'{name} failed: {e}')
+
+    task = asyncio.create_task(runner())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 async def invalidate_cache(r: Redis, key: str, *args) -> None:
     key = key.format(*args)
     await r.delete(key)
@@ -72,6 +92,14 @@ def wrap_list_response(items: list) -> dict:
         'items': items
     }
 
+def wrap_page_response(items: list, has_more: bool) -> dict:
+    """ has_more - there are more items in the requested direction """
+    return {
+        'total': len(items),
+        'has_more': has_more,
+        'items': items
+    }
+
 def validate_avatar(file: UploadFile) -> str:
     if file.content_type not in ALLOWED_CONTENT_TYPES:
         raise HTTPException(
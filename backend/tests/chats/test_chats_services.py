@@ -1,14 +1,19 @@
 from unittest.mock import AsyncMock
+from datetime import datetime, timedelta
 
 import pytest
 from sqlalchemy import select
+from sqlalchemy.exc import InvalidRequestError
 
 from tests.utils import create_user1, create_user2
 from src.auth.schemas import UserRegisterSchema
 from src.chats.schemas import CreateChatSchema
 from src.chats.enums import ChatType
-from src.chats.models import ChatModel
-from src.chats.services import create_chat_in_db, delete_chat_in_db
+from src.chats.models import ChatModel, UserChatAssociationModel
+from src.chats.services import create_chat_in_db, delete_chat_in_db, get_chat_schemas, \
+    get_slim_chat_or_none, is_chat_member, get_chat_member_uuids, get_user_chat_uuids, \
+    get_user_chat_partner_uuids
+from src.chats.utils import encode_chat_cursor, decode_chat_cursor
 
 @pytest.mark.asyncio
 async def test_create_chat_in_db_with_chat(get_db):
@@ -60,4 +65,73 @@ async def test_delete_chat_in_db(get_db):
 
     # checks if the chat exists
     result = await get_db.execute(select(ChatModel).where(ChatModel.id == chat.id))
-    assert result.scalar_one_or_none() is None
\ No newline at end of file
+    assert result.scalar_one_or_none() is None
+
+@pytest.mark.asyncio
+async def test_get_chat_schemas_pages_by_activity(get_db):
+    user = await create_user1(get_db)
+    other = await create_user2(get_db)
+
+    start = datetime(2026, 1, 1)
+    chats = [
+        ChatModel(chat_type=ChatType.GROUP, name=f'Group {i}', description='', created_at=start)
+        for i in range(5)
+    ]
+    for i, chat in enumerate(chats[:3]): # the other two have no messages
+        chat.last_message_at = start + timedelta(minutes=i)
+    get_db.add_all(chats)
+    get_db.add_all([UserChatAssociationModel(user=user, chat=chat) for chat in chats])
+    get_db.add(UserChatAssociationModel(user=other, chat=chats[0]))
+    await get_db.commit()
+
+    names, after = [], None
+    while True:
+        page, last_chat = await get_chat_schemas(get_db, user, after=after, limit=2, members_preview=1)
+        names += [chat.name for chat in page]
+        if last_chat is None:
+            break
+        after = decode_chat_cursor(encode_chat_cursor(last_chat))
+
+    assert names[:3] == ['Group 2', 'Group 1', 'Group 0']
+    assert sorted(names[3:]) == ['Group 3', 'Group 4'] # chats without messages last
+
+    page, _ = await get_chat_schemas(get_db, user, limit=5, members_preview=1)
+    group = next(chat for chat in page if chat.name == 'Group 0')
+    assert group.members_count == 2
+    assert len(group.user_uuids) == 1
+
+@pytest.mark.asyncio
+async def test_membership_check_without_loading_members(get_db):
+    user = await create_user1(get_db)
+    other = await create_user2(get_db)
+
+    chat = ChatModel(chat_type=ChatType.GROUP, name='Group', description='')
+    get_db.add_all([chat, UserChatAssociationModel(user=user, chat=chat)])
+    await get_db.commit()
+    get_db.expunge_all()
+
+    slim_chat = await get_slim_chat_or_none(get_db, chat.uuid)
+    assert await is_chat_member(get_db, user, slim_chat)
+    assert not await is_chat_member(get_db, other, slim_chat)
+    assert await get_chat_member_uuids(get_db, slim_chat) == [user.uuid]
+
+    with pytest.raises(InvalidRequestError): # members are never loaded on the hot path
+        slim_chat.user_associations
+
+@pytest.mark.asyncio
+async def test_get_user_chat_uuids_caches_an_empty_result(get_db, get_redis):
+    user = await create_user1(get_db)
+
+    assert await get_user_chat_uuids(get_db, get_redis, user) == []
+
+    get_db.scalars = AsyncMock(side_effect=AssertionError('db was queried'))
+    assert await get_user_chat_uuids(get_db, get_redis, user) == []
+
+@pytest.mark.asyncio
+async def test_get_user_chat_partner_uuids_caches_an_empty_result(get_db, get_redis):
+    user = await create_user1(get_db)
+
+    assert await get_user_chat_partner_uuids(get_db, get_redis, user) == []
+
+    get_db.scalars = AsyncMock(side_effect=AssertionError('db was queried'))
+    assert await get_user_chat_partner_uuids(get_db, get_redis, user) == []
@@ -0,0 +1,33 @@
+import pytest
+
+from src.cache import set_hash_cache, get_hash_cache, patch_hash_cache
+from src.chats.utils import chat_activity_key
+from src.folders.utils import add_chat_to_cached_folder, remove_chat_from_cached_folder, \
+    pin_chat_in_cached_folder
+
+def test_chat_activity_key_matches_the_chat_page_order():
+    chats = [
+        {'uuid': 'a', 'last_message_at': None, 'created_at': '2026-01-03T00:00:00Z'},
+        {'uuid': 'b', 'last_message_at': '2026-01-02T00:00:00Z', 'created_at': '2026-01-01T00:00:00Z'},
+        {'uuid': 'c', 'last_message_at': None, 'created_at': '2026-01-04T00:00:00Z'},
+        {'uuid': 'd', 'last_message_at': '2026-01-05T00:00:00+00:00', 'created_at': '2026-01-01T00:00:00Z'},
+    ]
+    chats.sort(key=chat_activity_key, reverse=True)
+    assert [chat['uuid'] for chat in chats] == ['d', 'b', 'c', 'a'] # without messages last
+
+@pytest.mark.asyncio
+async def test_cached_folder_patches(get_redis):
+    await set_hash_cache(get_redis, 'folders', [{'uuid': 'f', 'chat_uuids': ['a'], 'pinned_chats': []}], version='')
+
+    for patch in [
+        add_chat_to_cached_folder('b'),
+        add_chat_to_cached_folder('b'),
+        pin_chat_in_cached_folder('b', True),
+    ]:
+        await patch_hash_cache(get_redis, [('folders', 'f', patch)])
+    (folder,), _ = await get_hash_cache(get_redis, 'folders')
+    assert folder == {'uuid': 'f', 'chat_uuids': ['a', 'b'], 'pinned_chats': ['b']}
+
+    await patch_hash_cache(get_redis, [('folders', 'f', remove_chat_from_cached_folder('b'))])
+    (folder,), _ = await get_hash_cache(get_redis, 'folders')
+    assert folder == {'uuid': 'f', 'chat_uuids': ['a'], 'pinned_chats': []}
@@ -6,6 +6,7 @@ import pytest
 import pytest_asyncio
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from fastapi.testclient import TestClient
+from fakeredis import FakeAsyncRedis
 
 from src.database import Base
 from src.auth.models import *
@@ -14,6 +15,7 @@ from src.folders.models import *
 from src.messages.models import *
 from src.join_requests.models import *
 from src.invitations.models import *
+from src.search.models import *
 from src.main import app
 
 DATABASE_URL = 'sqlite+aiosqlite:///:memory:'
@@ -32,6 +34,13 @@ async def get_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
 
+@pytest_asyncio.fixture
+async def get_redis():
+    r = FakeAsyncRedis(decode_responses=True)
+    yield r
+    await r.flushall()
+    await r.aclose()
+
 @pytest.fixture(scope='module')
 def client():
     with TestClient(app) as client:
@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select, update
+
+from tests.utils import create_user1, create_user2
+from src.chats.enums import ChatType
+from src.chats.models import ChatModel, UserChatAssociationModel
+from src.chats.services import get_chat_or_404, add_user_to_group_in_db
+from src.messages.models import MessageModel
+from src.messages.services import get_messages_page, get_unread_counts, mark_chat_read, \
+    get_read_statuses, create_message_in_db
+
+async def create_chat_with_messages(db, count: int):
+    user = await create_user1(db)
+
+    chat = ChatModel(chat_type=ChatType.GROUP, name='Group')
+    db.add_all([chat, UserChatAssociationModel(user=user, chat=chat)])
+    await db.flush()
+
+    start = datetime(2026, 1, 1)
+    db.add_all([
+        MessageModel(
+            user_id=user.id, chat_id=chat.id, content=str(i),
+            created_at=start + timedelta(minutes=i)
+        )
+        for i in range(count)
+    ])
+    await db.commit()
+
+    return user, await get_chat_or_404(db, chat.uuid)
+
+@pytest.mark.asyncio
+async def test_get_messages_page_newest(get_db):
+    user, chat = await create_chat_with_messages(get_db, 5)
+
+    messages, has_more = await get_messages_page(get_db, user, chat, limit=3)
+
+    assert [m.content for m in messages] == ['2', '3', '4']
+    assert has_more is True
+
+@pytest.mark.asyncio
+async def test_get_messages_page_before_and_after(get_db):
+    user, chat = await create_chat_with_messages(get_db, 5)
+    newest, _ = await get_messages_page(get_db, user, chat, limit=3)
+
+    older, has_more = await get_messages_page(get_db, user, chat, before=newest[0].uuid, limit=3)
+    assert [m.content for m in older] == ['0', '1']
+    assert has_more is False
+
+    newer, has_more = await get_messages_page(get_db, user, chat, after=older[0].uuid, limit=2)
+    assert [m.content for m in newer] == ['1', '2']
+    assert has_more is True
+
+@pytest.mark.asyncio
+async def test_get_messages_page_not_a_member(get_db):
+    _, chat = await create_chat_with_messages(get_db, 1)
+    other_user = await create_user2(get_db)
+
+    with pytest.raises(HTTPException) as excinfo:
+        await get_messages_page(get_db, other_user, chat)
+    assert excinfo.value.status_code == 403
+
+@pytest.mark.asyncio
+async def test_unread_counts_follow_the_read_watermark(get_db):
+    user, chat = await create_chat_with_messages(get_db, 3)
+    other_user = await create_user2(get_db)
+    get_db.add(UserChatAssociationModel(user=other_user, chat=chat))
+    await get_db.commit()
+
+    assert await get_unread_counts(get_db, user) == [] # own messages are never unread
+    assert await get_unread_counts(get_db, other_user) == [(chat.uuid, 3)]
+
+    await mark_chat_read(get_db, other_user, chat)
+    assert await get_unread_counts(get_db, other_user) == []
+
+    chat = await get_chat_or_404(get_db, chat.uuid)
+    newest, _ = await get_messages_page(get_db, user, chat, limit=1)
+    read_statuses = {u: m for u, m, _ in await get_read_statuses(get_db, user, chat)}
+    assert read_statuses == {user.uuid: None, other_user.uuid: newest[0].uuid}
+
+@pytest.mark.asyncio
+async def test_unread_counts_use_the_message_order_and_survive_a_deleted_watermark(get_db):
+    user, chat = await create_chat_with_messages(get_db, 2)
+    other_user = await create_user2(get_db)
+    get_db.add(UserChatAssociationModel(user=other_user, chat=chat))
+    # a higher id, but created before the newest message (committed later)
+    get_db.add(MessageModel(user_id=user.id, chat_id=chat.id, content='late', created_at=datetime(2026, 1, 1)))
+    await get_db.commit()
+
+    await mark_chat_read(get_db, other_user, chat)
+    assert await get_unread_counts(get_db, other_user) == []
+
+    # the watermark message is deleted, ON DELETE SET NULL by hand (no foreign keys in sqlite)
+    newest, _ = await get_messages_page(get_db, user, chat, limit=1)
+    await get_db.execute(
+        update(UserChatAssociationModel)
+        .where(UserChatAssociationModel.user_id == other_user.id)
+        .values(last_read_message_id=None, last_read_at=datetime(2026, 1, 1, 0, 0, 30))
+    )
+    await get_db.delete(newest[0])
+    await get_db.commit()
+    assert await get_unread_counts(get_db, other_user) == []
+
+    get_db.add(MessageModel(user_id=user.id, chat_id=chat.id, content='new', created_at=datetime(2026, 1, 2)))
+    await get_db.commit()
+    assert await get_unread_counts(get_db, other_user) == [(chat.uuid, 1)]
+
+@pytest.mark.asyncio
+async def test_create_message_in_db_only_flushes(get_db):
+    user, chat = await create_chat_with_messages(get_db, 0)
+
+    message = await create_message_in_db(get_db, user, chat, 'hello')
+    assert get_db.in_transaction() # not committed yet
+    assert message.created_at is not None # returned by the insert, no refresh
+
+@pytest.mark.asyncio
+async def test_create_message_in_db_moves_last_message_pointer(get_db):
+    user, chat = await create_chat_with_messages(get_db, 0)
+
+    first = await create_message_in_db(get_db, user, chat, 'first')
+    second = await create_message_in_db(get_db, user, chat, 'second')
+
+    last_message_id, last_message_at = (await get_db.execute(
+        select(ChatModel.last_message_id, ChatModel.last_message_at).where(ChatModel.id == chat.id)
+    )).one()
+    assert last_message_id == second.id != first.id
+    assert last_message_at == second.created_at
+
+    # a concurrent message that is newer in (created_at, id) order was committed first
+    await get_db.execute(
+        update(ChatModel).where(ChatModel.id == chat.id)
+        .values(last_message_id=first.id, last_message_at=datetime(2100, 1, 1))
+    )
+    await create_message_in_db(get_db, user, chat, 'third')
+    assert await get_db.scalar(select(ChatModel.last_message_id).where(ChatModel.id == chat.id)) == first.id
+
+@pytest.mark.asyncio
+async def test_history_before_joining_a_group_is_not_unread(get_db):
+    user, chat = await create_chat_with_messages(get_db, 3)
+    other_user = await create_user2(get_db)
+
+    await add_user_to_group_in_db(get_db, chat, other_user)
+    assert await get_unread_counts(get_db, other_user) == []
+
+    get_db.add(MessageModel(user_id=user.id, chat_id=chat.id, content='new', created_at=datetime(2026, 1, 2)))
+    await get_db.commit()
+    assert await get_unread_counts(get_db, other_user) == [(chat.uuid, 1)]
@@ -0,0 +1,41 @@
+import pytest
+
+from src.messages.utils import get_cached_messages, cache_messages, append_message_to_cache
+
+CHAT_UUID = 'b3f1c6a2-5d8e-4f7a-9c1b-2e4d6f8a0c3e'
+
+def make_message(message_id: int, second: int) -> dict:
+    return {'uuid': f'message-{message_id}', 'created_at': f'2026-01-01T00:00:{second:02d}+00:00'}
+
+async def append(r, message_id: int, second: int):
+    async with r.pipeline(transaction=True) as pipe:
+        append_message_to_cache(pipe, CHAT_UUID, message_id, make_message(message_id, second))
+        await pipe.execute()
+
+@pytest.mark.asyncio
+async def test_message_sent_while_the_cache_is_filled_is_kept(get_redis):
+    # the fill read messages 1 and 2 from the db, then 3 was sent before the fill is written
+    snapshot = [(1, make_message(1, 1)), (2, make_message(2, 2))]
+    await append(get_redis, 3, 3)
+    assert await get_cached_messages(get_redis, CHAT_UUID, 10) is None # not filled yet
+
+    await cache_messages(get_redis, CHAT_UUID, snapshot)
+    await append(get_redis, 2, 2) # appended after the fill, already in the snapshot
+
+    messages, has_more = await get_cached_messages(get_redis, CHAT_UUID, 10)
+    assert [m['uuid'] for m in messages] == ['message-1', 'message-2', 'message-3']
+    assert not has_more
+
+@pytest.mark.asyncio
+async def test_cached_messages_keep_the_db_order(get_redis):
+    await cache_messages(get_redis, CHAT_UUID, [])
+    assert await get_cached_messages(get_redis, CHAT_UUID, 10) == ([], False) # an empty chat is cached too
+
+    # committed out of order: the later append is the older message, equal times are ordered by id
+    await append(get_redis, 12, 5)
+    await append(get_redis, 11, 4)
+    await append(get_redis, 10, 5)
+
+    messages, has_more = await get_cached_messages(get_redis, CHAT_UUID, 2)
+    assert [m['uuid'] for m in messages] == ['message-10', 'message-12']
+    assert has_more
@@ -0,0 +1,150 @@
+from unittest.mock import MagicMock
+import asyncio
+
+import pytest
+from sqlalchemy import select, update, func
+
+from src.settings import ELASTIC_USERS_INDEX_NAME, ELASTIC_USER_SCOPES_INDEX_NAME, ELASTIC_MESSAGES_INDEX_NAME, \
+    ELASTIC_OUTBOX_MAX_ATTEMPTS
+from src.chats.schemas import CreateChatSchema
+from src.chats.enums import ChatType
+from src.chats.services import create_chat_in_db
+from src.search.models import ElasticOutboxModel
+from src.search.outbox import OutboxReplicator, to_elastic_action
+from src.auth.utils import user_to_elastic_doc
+import src.search.outbox as outbox
+from tests.utils import create_user1, create_user2
+
+@pytest.mark.asyncio
+async def test_replicate_batch_indexes_and_drains_outbox(get_db, monkeypatch):
+    user1 = await create_user1(get_db)
+
+    bulk_actions = []
+    async def fake_bulk(es, actions, **kwargs):
+        bulk_actions.extend(actions)
+        return len(actions), []
+    monkeypatch.setattr(outbox, "async_bulk", fake_bulk)
+
+    processed = await OutboxReplicator(es=None).replicate_batch(get_db)
+
+    assert processed == 1
+    assert bulk_actions == [{
+        "_op_type": "index",
+        "_index": ELASTIC_USERS_INDEX_NAME,
+        "_id": str(user1.uuid),
+        "_source": user_to_elastic_doc(user1),
+    }]
+    assert await get_db.scalar(select(func.count(ElasticOutboxModel.id))) == 0
+
+@pytest.mark.asyncio
+async def test_replicate_batch_keeps_failed_rows(get_db, monkeypatch):
+    user1 = await create_user1(get_db)
+    await get_db.delete(user1)
+    await get_db.commit()
+
+    async def fake_bulk(es, actions, **kwargs):
+        return 0, [{"delete": {"_index": ELASTIC_USERS_INDEX_NAME, "_id": str(user1.uuid), "status": 503}}]
+    monkeypatch.setattr(outbox, "async_bulk", fake_bulk)
+
+    replicator = OutboxReplicator(es=None)
+    await replicator.replicate_batch(get_db)
+
+    assert await get_db.scalar(select(ElasticOutboxModel.attempts)) == 1
+    assert replicator.retrying
+
+@pytest.mark.asyncio
+async def test_replicate_batch_drops_rows_that_can_not_succeed(get_db, monkeypatch):
+    user1 = await create_user1(get_db)
+    user2 = await create_user2(get_db)
+    await get_db.execute(
+        update(ElasticOutboxModel)
+        .where(ElasticOutboxModel.doc_uuid == user2.uuid)
+        .values(attempts=ELASTIC_OUTBOX_MAX_ATTEMPTS - 1)
+    )
+    await get_db.commit()
+
+    async def fake_bulk(es, actions, **kwargs):
+        return 0, [
+            {"index": {"_index": ELASTIC_USERS_INDEX_NAME, "_id": str(user1.uuid), "status": 400}}, # mapping error
+            {"index": {"_index": ELASTIC_USERS_INDEX_NAME, "_id": str(user2.uuid), "status": 503}}, # the last attempt
+        ]
+    monkeypatch.setattr(outbox, "async_bulk", fake_bulk)
+
+    replicator = OutboxReplicator(es=None)
+    await replicator.replicate_batch(get_db)
+
+    assert await get_db.scalar(select(func.count(ElasticOutboxModel.id))) == 0
+    assert replicator.stats()["dropped"] == 2
+    assert not replicator.retrying
+
+@pytest.mark.asyncio
+async def test_replicate_batch_updates_user_scopes(get_db, monkeypatch):
+    user1 = await create_user1(get_db)
+    await get_db.refresh(user1, ['chat_associations']) # loads chat_assoc
+    user2 = await create_user2(get_db)
+    chat = await create_chat_in_db(get_db, user1, CreateChatSchema(chat_type=ChatType.NORMAL, name='user2'))
+
+    bulk_actions = []
+    async def fake_bulk(es, actions, **kwargs):
+        bulk_actions.extend(actions)
+        return len(actions), []
+    monkeypatch.setattr(outbox, "async_bulk", fake_bulk)
+
+    await OutboxReplicator(es=None).replicate_batch(get_db)
+
+    scopes = {
+        action["_id"]: action["_source"] for action in bulk_actions
+        if action["_index"] == ELASTIC_USER_SCOPES_INDEX_NAME
+    }
+    assert scopes == {
+        str(user1.uuid): {"chats": [str(chat.uuid)]},
+        str(user2.uuid): {"chats": [str(chat.uuid)]},
+    }
+
+def test_to_elastic_action_routes_messages_by_chat():
+    message = to_elastic_action("index", ELASTIC_MESSAGES_INDEX_NAME, "m1", {"chat": "c1", "content": "hi"})
+    user = to_elastic_action("index", ELASTIC_USERS_INDEX_NAME, "u1", {"username": "user1"})
+
+    assert message["_routing"] == "c1"
+    assert "_routing" not in user
+
+@pytest.mark.asyncio
+async def test_replication_loop_survives_a_db_outage(monkeypatch):
+    replicator = OutboxReplicator(es=None)
+    recovered = asyncio.Event()
+    calls = 0
+
+    async def replicate_batch(db):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise ConnectionRefusedError("postgres is down") # not wrapped by sqlalchemy
+        recovered.set()
+        return 0
+    monkeypatch.setattr(replicator, "replicate_batch", replicate_batch)
+    monkeypatch.setattr(outbox, "async_session", MagicMock())
+    monkeypatch.setattr(outbox, "ELASTIC_OUTBOX_POLL_INTERVAL", 0)
+
+    replicator.start()
+    await asyncio.wait_for(recovered.wait(), 1)
+    await replicator.close()
+
+@pytest.mark.asyncio
+async def test_replication_loop_is_restarted_when_it_ends(monkeypatch):
+    replicator = OutboxReplicator(es=None)
+    restarted = asyncio.Event()
+    calls = 0
+
+    async def replication_loop():
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            raise RuntimeError("bug")
+        restarted.set()
+        await asyncio.Event().wait()
+    monkeypatch.setattr(replicator, "_replication_loop", replication_loop)
+
+    replicator.start()
+    await asyncio.wait_for(restarted.wait(), 1)
+    await replicator.close()
+    assert replicator.task is None
@@ -0,0 +1,26 @@
+import pytest
+
+from src.settings import ELASTIC_USERS_INDEX_NAME
+from src.search.reindex import stream_elastic_actions
+from tests.utils import create_user1, create_user2
+
+@pytest.mark.asyncio
+async def test_stream_elastic_actions_in_id_chunks(get_db):
+    user1 = await create_user1(get_db)
+    user2 = await create_user2(get_db)
+
+    chunks = [
+        chunk async for chunk in
+        stream_elastic_actions(get_db, ELASTIC_USERS_INDEX_NAME, after_id=0, chunk_size=1)
+    ]
+
+    assert [last_id for last_id, _ in chunks] == [user1.id, user2.id]
+    assert chunks[0][1][0]["_id"] == str(user1.uuid)
+    assert chunks[0][1][0]["_op_type"] == "create"
+
+    # resuming from the checkpoint skips the indexed rows
+    chunks = [
+        chunk async for chunk in
+        stream_elastic_actions(get_db, ELASTIC_USERS_INDEX_NAME, after_id=user1.id)
+    ]
+    assert [action["_id"] for action in chunks[0][1]] == [str(user2.uuid)]
@@ -0,0 +1,35 @@
+from unittest.mock import AsyncMock
+
+import pytest
+from fastapi import HTTPException
+from elasticsearch import BadRequestError
+from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+
+from tests.utils import create_user1
+from src.search.router import search_global
+from src.search.utils import encode_search_cursor
+
+def bad_request() -> BadRequestError:
+    meta = ApiResponseMeta(400, '1.1', HttpHeaders(), 0.0, NodeConfig('http', 'localhost', 9200))
+    return BadRequestError('parse_exception', meta, {})
+
+@pytest.mark.asyncio
+async def test_search_global_maps_a_bad_cursor_to_400(get_db, get_redis):
+    user = await create_user1(get_db)
+    es = AsyncMock()
+    es.search.side_effect = bad_request()
+
+    with pytest.raises(HTTPException) as exc:
+        await search_global(get_db, get_redis, es, user, q='user', cursor=encode_search_cursor('bad-pit', [1.5]))
+    assert exc.value.status_code == 400
+
+@pytest.mark.asyncio
+async def test_search_global_closes_the_pit_of_a_failed_first_page(get_db, get_redis):
+    user = await create_user1(get_db)
+    es = AsyncMock()
+    es.open_point_in_time.return_value = {'id': 'pit'}
+    es.search.side_effect = bad_request()
+
+    with pytest.raises(BadRequestError): # our own query, not the client's fault
+        await search_global(get_db, get_redis, es, user, q='user', cursor=None)
+    es.close_point_in_time.assert_awaited_once_with(id='pit')
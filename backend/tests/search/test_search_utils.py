@@ -1,7 +1,9 @@
 import pytest
+from fastapi import HTTPException
 
-from src.settings import ELASTIC_CHATS_INDEX_NAME, ELASTIC_USERS_INDEX_NAME
-from src.search.utils import parse_elastic_response
+from src.settings import ELASTIC_CHATS_INDEX_NAME, ELASTIC_USERS_INDEX_NAME, ELASTIC_MESSAGES_INDEX_NAME
+from src.search.utils import parse_elastic_response, normalize_query, index_to_alias, \
+    encode_search_cursor, decode_search_cursor, parse_msearch_sections
 
 @pytest.mark.parametrize("user_uuid,index,members,expected_is_yours", [
     ("a0c1e4f1-87ca-49fd-8386-a83202cf03fe", ELASTIC_CHATS_INDEX_NAME, ["a0c1e4f1-87ca-49fd-8386-a83202cf03fe"], True),
@@ -62,3 +64,38 @@ def test_parse_elastic_response_no_user_uuid():
     assert len(items) == 2
     assert "is_yours" not in items[0]
     assert "is_yours" not in items[1]
+
+def test_normalize_query_and_index_to_alias():
+    assert normalize_query('  Foo   Bar ') == 'foo bar'
+    assert index_to_alias('chats_1760000000') == ELASTIC_CHATS_INDEX_NAME
+    assert index_to_alias(ELASTIC_USERS_INDEX_NAME) == ELASTIC_USERS_INDEX_NAME
+    assert index_to_alias('messages-000002') == ELASTIC_MESSAGES_INDEX_NAME
+    assert index_to_alias('messages-1760000000-000003') == ELASTIC_MESSAGES_INDEX_NAME
+    assert index_to_alias('user_scopes') == 'user_scopes'
+
+def test_search_cursor_round_trip_and_invalid_cursor():
+    cursor = encode_search_cursor('pit-id', [1.5, 42])
+    assert decode_search_cursor(cursor) == ('pit-id', [1.5, 42])
+
+    with pytest.raises(HTTPException) as exc:
+        decode_search_cursor('not a cursor')
+    assert exc.value.status_code == 400
+
+    with pytest.raises(HTTPException) as exc:
+        decode_search_cursor(encode_search_cursor(['pit-id'], 'not sort values'))
+    assert exc.value.status_code == 400
+
+def test_parse_msearch_sections_isolates_failed_and_late_sections():
+    user_hit = {"_id": "u1", "_index": ELASTIC_USERS_INDEX_NAME, "_source": {"username": "user1"}}
+    responses = [
+        {"timed_out": False, "hits": {"total": {"value": 1}, "hits": [user_hit]}},
+        {"error": {"type": "search_phase_execution_exception"}, "status": 500},
+        {"timed_out": True, "hits": {"total": {"value": 0}, "hits": []}},
+    ]
+    indices = [ELASTIC_USERS_INDEX_NAME, ELASTIC_CHATS_INDEX_NAME, ELASTIC_MESSAGES_INDEX_NAME]
+
+    sections = parse_msearch_sections(responses, indices, "some-user")
+
+    assert sections[ELASTIC_USERS_INDEX_NAME]["items"][0]["username"] == "user1"
+    assert sections[ELASTIC_CHATS_INDEX_NAME]["failed"] is True
+    assert sections[ELASTIC_MESSAGES_INDEX_NAME]["timed_out"] is True
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from src.settings import REDIS_CACHE_EXPIRE_SECONDS, REDIS_CACHE_TTL_JITTER
+from src.cache import coalesce, jittered_ttl, cached_hash, get_hash_cache, set_hash_cache, \
+    patch_hash_cache, set_fields
+
+@pytest.mark.asyncio
+async def test_coalesce_runs_once_for_concurrent_calls():
+    calls = 0
+
+    async def search():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    results = await asyncio.gather(*[coalesce('key', search) for _ in range(5)])
+
+    assert results == [1] * 5
+    assert await coalesce('key', search) == 2 # finished calls are not reused
+
+def test_jittered_ttl_spreads_around_the_ttl():
+    ttls = {jittered_ttl() for _ in range(100)}
+
+    assert len(ttls) > 1
+    assert all(
+        abs(ttl - REDIS_CACHE_EXPIRE_SECONDS) <= REDIS_CACHE_EXPIRE_SECONDS * REDIS_CACHE_TTL_JITTER
+        for ttl in ttls
+    )
+
+@pytest.mark.asyncio
+async def test_concurrent_patches_of_one_hash_are_not_lost(get_redis):
+    await set_hash_cache(get_redis, 'folders', [{'uuid': 'f', 'chat_uuids': [], 'pinned_chats': []}], version='')
+
+    await asyncio.gather(*[
+        patch_hash_cache(get_redis, [('folders', 'f', [['add', 'chat_uuids', chat_uuid]])])
+        for chat_uuid in ['a', 'b', 'c']
+    ])
+
+    (folder,), _ = await get_hash_cache(get_redis, 'folders')
+    assert sorted(folder['chat_uuids']) == ['a', 'b', 'c']
+
+@pytest.mark.asyncio
+async def test_rebuild_from_an_older_snapshot_is_not_written(get_redis):
+    async def load():
+        # a message arrives while the db is read, its patch finds no hash to change
+        await patch_hash_cache(get_redis, [('chats', 'c', set_fields(last_message='new'))], drop_missing=True)
+        return [{'uuid': 'c', 'last_message': 'old'}], {}
+
+    items, _ = await cached_hash(get_redis, 'chats', load)
+
+    assert items == [{'uuid': 'c', 'last_message': 'old'}]
+    assert await get_hash_cache(get_redis, 'chats') is None # the next read loads it again
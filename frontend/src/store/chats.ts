@@ -14,9 +14,11 @@ export interface ChatI {
   is_open_for_messages: boolean
   is_visible: boolean
   last_message?: string
+  last_message_at?: string
   created_at: string
   updated_at: string
   user_uuids: string[]
+  members_count: number
 }
 
 export interface GroupConfigI {
@@ -71,8 +73,23 @@ export const useChatStore = defineStore('chats', {
     async fetchChats() {
       try {
         const response = await axiosInstance.get("/chats")
-        const data = response.data // total, items->chats
+        const data = response.data // total, has_more, items->chats, cursor
         this.chats = data.items as ChatI[]
+        // the first page is enough to render, the rest loads behind it
+        if (data.cursor) this.fetchMoreChats(data.cursor)
+      } catch (error) {
+        console.error("Error fetching chats:", error)
+      }
+    },
+    async fetchMoreChats(cursor: string) {
+      try {
+        while (cursor) {
+          const response = await axiosInstance.get("/chats", { params: { cursor } })
+          const data = response.data
+          const known = new Set(this.chats.map(c => c.uuid))
+          this.chats.push(...(data.items as ChatI[]).filter(c => !known.has(c.uuid)))
+          cursor = data.cursor
+        }
       } catch (error) {
         console.error("Error fetching chats:", error)
       }
@@ -14,6 +14,13 @@ export interface ReadStatusI {
   user_uuid: string
 }
 
+// read watermark of a chat member
+export interface ChatReadStatusI {
+  user_uuid: string,
+  last_read_message_uuid: string | null,
+  updated_at: string | null
+}
+
 export interface MessageI {
   uuid: string,
   user_uuid: string,
@@ -65,10 +72,27 @@ export const useMessageStore = defineStore('messages', {
     },
     async fetchMessages(chatUuid: string) {
       try {
-        const { data } = await axiosInstance.get(`/messages/${chatUuid}`)
+        const [{ data }, { data: readData }] = await Promise.all([
+          axiosInstance.get(`/messages/${chatUuid}`),
+          axiosInstance.get(`/messages/${chatUuid}/read_statuses`)
+        ])
+        const watermarks = readData.items as ChatReadStatusI[]
+
+        // a message is read by everyone who read the chat after it was sent
+        const items = (data.items as MessageI[]).map(m => ({
+          ...m,
+          read_statuses: watermarks
+            .filter(w => w.user_uuid !== m.user_uuid)
+            .map(w => ({
+              updated_at: w.updated_at ?? m.created_at,
+              is_read: w.updated_at !== null && new Date(w.updated_at) >= new Date(m.created_at),
+              user_uuid: w.user_uuid
+            }))
+        }))
+
         this.messages = [
           ...this.messages.filter(m => m.chat_uuid !== chatUuid),
-          ...data.items
+          ...items
         ]
       } catch (error) {
         console.error("Error fetching messages:", error)
@@ -33,7 +33,7 @@ export const useSearchStore = defineStore('search', {
     query: '',
     items: [] as SearchItem[],
     queries: [] as string[], // from redis cache
-    page: 1,
+    cursor: null as string | null, // opaque, from the previous page
     pageSize: 20,
     total: 0,
     loading: false,
@@ -59,7 +59,7 @@ export const useSearchStore = defineStore('search', {
     reset(query: string) {
       this.query = query
       this.items = []
-      this.page = 1
+      this.cursor = null
       this.total = 0
       this.hasMore = true
     },
@@ -71,21 +71,30 @@ export const useSearchStore = defineStore('search', {
         const { data } = await axiosInstance.get('/search/global', {
             params: {
                 q: this.query,
-                page: this.page,
+                cursor: this.cursor ?? undefined,
             }
         })
 
         this.items.push(...data.items)
-        this.total = data.total
+        if (data.total !== null) this.total = data.total // only counted on the first page
 
-        if (this.items.length >= this.total) {
-            this.hasMore = false
-        } else {
-            this.page++
-        }
+        this.cursor = data.cursor
+        this.hasMore = data.cursor !== null
 
         this.loading = false
     },
+    // as you type: prefix matches, cached by the backend, not saved in the history
+    async fetchSuggestions(query: string) {
+        const { data } = await axiosInstance.get('/search/suggest', {
+            params: { q: query }
+        })
+
+        if (query !== this.query) return // a newer query was typed meanwhile
+
+        this.items = data.items
+        this.total = data.total
+        this.hasMore = false
+    },
     async loadHistory() {
         const { data } = await axiosInstance.get('/search/history')
         this.queries = data.items